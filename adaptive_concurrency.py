@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+自適應併發控制
+依各數據源實際的延遲與錯誤回應調整同時進行中的請求數（AIMD）：
+- 請求成功且延遲未明顯高於基準時，上限每輪加 1（每次完成加 1/上限）
+- 延遲超過基準 LATENCY_TOLERANCE 倍或發生錯誤時，上限乘以 ERROR_RATIO；被限流時乘以 THROTTLE_RATIO
+- 同一輪（約一個延遲時間）內只下修一次，避免同時失敗的請求重複下修
+上限介於 MIN_LIMIT 與各數據源的最大併發數之間，並以 concurrency_limit 指標輸出。
+上限為程序內共用，同一程序的篩選、批量分析與各 StockDataFetcher 實例共同遵守。
+"""
+
+import threading
+import time
+from metrics import set_gauge
+
+# 各數據源的最大併發數（本地儲存區不受上游限制；Shioaji 另受每 5 秒 50 次的查詢配額）
+SOURCE_MAX_CONCURRENCY = {'store': 32, 'yfinance': 8, 'shioaji': 4}
+DEFAULT_MAX_CONCURRENCY = 8
+INITIAL_LIMIT = 4
+MIN_LIMIT = 1
+
+# 延遲超過基準的倍數時視為壅塞
+LATENCY_TOLERANCE = 2.0
+# 下修比例：一般錯誤或壅塞、被限流
+ERROR_RATIO = 0.8
+THROTTLE_RATIO = 0.5
+# 短期延遲與基準延遲的指數移動平均權重
+SHORT_ALPHA = 0.3
+BASELINE_ALPHA = 0.02
+
+SUCCESS, ERROR, THROTTLED = 'success', 'error', 'throttled'
+
+
+class AdaptiveLimit:
+    """單一數據源的 AIMD 併發上限（執行緒安全）"""
+
+    def __init__(self, name, max_limit=DEFAULT_MAX_CONCURRENCY, initial=INITIAL_LIMIT, min_limit=MIN_LIMIT):
+        self.name = name
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.in_flight = 0
+        self._condition = threading.Condition()
+        self._latency = None
+        self._baseline = None
+        self._last_decrease = 0.0
+        self._publish()
+
+    def acquire(self):
+        """等待直到進行中的請求數低於目前上限"""
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            set_gauge('concurrency_in_flight', self.in_flight, source=self.name)
+
+    def release(self, latency, outcome=SUCCESS):
+        """回報請求結果並依延遲與錯誤調整上限"""
+        with self._condition:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if outcome == SUCCESS:
+                self._latency = latency if self._latency is None else self._latency + SHORT_ALPHA * (latency - self._latency)
+                self._baseline = latency if self._baseline is None else self._baseline + BASELINE_ALPHA * (latency - self._baseline)
+                if latency > self._baseline * LATENCY_TOLERANCE:
+                    self._decrease(ERROR_RATIO)
+                elif saturated:
+                    # 只有在上限實際用滿時才放寬，避免請求稀疏時上限無限制地增加
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            else:
+                self._decrease(THROTTLE_RATIO if outcome == THROTTLED else ERROR_RATIO)
+            self._publish()
+            self._condition.notify_all()
+
+    def _decrease(self, ratio):
+        now = time.monotonic()
+        if now - self._last_decrease < (self._latency or 0):
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * ratio)
+
+    def set_max_limit(self, max_limit):
+        """調整最大併發數"""
+        with self._condition:
+            self.max_limit = max(self.min_limit, max_limit)
+            self.limit = min(self.limit, self.max_limit)
+            self._publish()
+            self._condition.notify_all()
+
+    def _publish(self):
+        set_gauge('concurrency_limit', self.limit, source=self.name)
+        set_gauge('concurrency_in_flight', self.in_flight, source=self.name)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'limit': self.limit,
+                'max_limit': self.max_limit,
+                'in_flight': self.in_flight,
+                'latency_ms': (self._latency or 0) * 1000,
+                'baseline_ms': (self._baseline or 0) * 1000,
+            }
+
+
+_limits = {}
+_limits_lock = threading.Lock()
+
+
+def source_limit(name, max_limit=None):
+    """取得程序內共用的數據源併發上限；max_limit 未指定時使用 SOURCE_MAX_CONCURRENCY"""
+    with _limits_lock:
+        if name not in _limits:
+            _limits[name] = AdaptiveLimit(name, max_limit or SOURCE_MAX_CONCURRENCY.get(name, DEFAULT_MAX_CONCURRENCY))
+        elif max_limit is not None and max_limit != _limits[name].max_limit:
+            _limits[name].set_max_limit(max_limit)
+        return _limits[name]
+
+
+def limits_report():
+    """{數據源: 併發統計}"""
+    with _limits_lock:
+        limits = list(_limits.values())
+    return {limit.name: limit.stats() for limit in limits}
+
+
+def pool_size():
+    """足以讓任一數據源用滿最大併發數的執行緒數"""
+    with _limits_lock:
+        maxima = [limit.max_limit for limit in _limits.values()]
+    return max(maxima + list(SOURCE_MAX_CONCURRENCY.values()))
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+跨工作階段共用的分析結果快取
+以 (股票代碼, 期間, 週期, 轉換週期, 指標版本) 為鍵，保存已完成 analyze() 與交易信號的分析器。
+存活時間依該股票交易所的交易時段與休市日調整，超過記憶體上限時以 LRU 淘汰。
+"""
+
+import threading
+import time
+from collections import OrderedDict
+import pandas as pd
+from metrics import register_collector
+from trading_calendar import calendar_for, exchange_for, get_calendar
+
+# 指標計算邏輯變更時調高此版本，使舊快取自動失效
+INDICATOR_VERSION = 2
+
+# 盤中快取存活秒數
+INTRADAY_TTL = 30
+DAILY_TTL = 300
+MIN_CLOSED_TTL = 60
+# 真實數據源皆失敗而改用示範數據時，只短暫快取，下次查詢重新嘗試真實數據源
+DEMO_TTL = MIN_CLOSED_TTL
+
+
+def is_market_open(now=None, exchange='TWSE'):
+    """交易所是否在交易時段內（排除休市日，提前收盤日以提前的時間為準）"""
+    return get_calendar(exchange).is_open(now)
+
+
+def next_market_open(now=None, exchange='TWSE'):
+    """下一個交易時段開盤時間（跳過週末與休市日）"""
+    return get_calendar(exchange).next_open(now)
+
+
+def ttl_for(interval, now=None, exchange='TWSE'):
+    """依週期與交易時段決定快取存活秒數：盤中短、收盤後保留到下次開盤（連假期間保留整個假期）"""
+    calendar = get_calendar(exchange)
+    now = calendar.localize(now) if now is not None else calendar.now()
+    if calendar.is_open(now):
+        return INTRADAY_TTL if interval.endswith('m') or interval.endswith('h') else DAILY_TTL
+    return max((calendar.next_open(now) - now).total_seconds(), MIN_CLOSED_TTL)
+
+
+def make_key(symbol, period, interval="1d", resample_to=None):
+    """建立快取鍵"""
+    return (symbol.upper(), period, interval, resample_to or '', INDICATOR_VERSION)
+
+
+def is_demo(value):
+    """快取項目是否由示範數據計算（數據源為 demo）"""
+    if not isinstance(value, dict):
+        return False
+    holder = value.get('pyramid') or value.get('analyzer')
+    result = getattr(holder, 'fetch_result', None)
+    return getattr(result, 'source', None) == 'demo'
+
+
+def estimate_size(value):
+    """估算快取項目佔用的記憶體（位元組）"""
+    pyramid = value.get('pyramid') if isinstance(value, dict) else None
+    if pyramid is not None:
+        return pyramid.nbytes() + 4096
+    analyzer = value.get('analyzer') if isinstance(value, dict) else None
+    data = getattr(analyzer, 'data', None)
+    if isinstance(data, pd.DataFrame):
+        return int(data.memory_usage(deep=True).sum()) + 4096
+    return 4096
+
+
+class AnalysisCache:
+    """具 TTL、LRU 淘汰與記憶體上限的執行緒安全快取"""
+
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()   # key -> (value, expires_at, size)
+        self._inflight = {}             # key -> threading.Event，避免同一鍵重複計算
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def get(self, key):
+        """取得未過期的項目，不存在時回傳 None"""
+        with self._lock:
+            return self._get_locked(key)
+
+    def _get_locked(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at, size = entry
+        if time.monotonic() >= expires_at:
+            self._remove_locked(key)
+            self.counters['expirations'] += 1
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, ttl):
+        """寫入項目並在超過記憶體上限時淘汰最久未使用的項目；示範數據最多保留 DEMO_TTL 秒"""
+        if is_demo(value):
+            ttl = min(ttl, DEMO_TTL)
+        size = estimate_size(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove_locked(key)
+            self._entries[key] = (value, time.monotonic() + ttl, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and len(self._entries) > 1:
+                oldest = next(iter(self._entries))
+                self._remove_locked(oldest)
+                self.counters['evictions'] += 1
+
+    def _remove_locked(self, key):
+        _, _, size = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def get_or_compute(self, key, compute, ttl, update=None):
+        """
+        命中時直接回傳；未命中時呼叫 compute() 計算並寫入。
+        提供 update 且存在已過期的舊項目時，先以 update(舊項目) 增量更新，回傳 None 時才呼叫 compute()。
+        多個工作階段同時請求同一鍵時只計算一次，其餘等待結果。
+        """
+        stale = None
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and time.monotonic() >= entry[1]:
+                    stale = entry[0]
+                value = self._get_locked(key)
+                if value is not None:
+                    self.counters['hits'] += 1
+                    return value
+                event = self._inflight.get(key)
+                if event is None:
+                    self.counters['misses'] += 1
+                    event = threading.Event()
+                    self._inflight[key] = event
+                    break
+            # 另一個執行緒正在計算同一鍵，等待後重新查詢
+            event.wait()
+            with self._lock:
+                value = self._get_locked(key)
+                if value is not None:
+                    self.counters['hits'] += 1
+                    return value
+            # 計算失敗時重新競爭計算權
+
+        try:
+            value = update(stale) if update is not None and stale is not None else None
+            if value is None:
+                value = compute()
+            if value is not None:
+                self.put(key, value, ttl)
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            event.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """快取統計資訊"""
+        with self._lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            return {
+                **self.counters,
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hit_rate': self.counters['hits'] / lookups if lookups else 0.0,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_analysis_cache():
+    """取得程序內共用的快取實例"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = AnalysisCache()
+            register_collector('analysis_cache', _cache.stats)
+        return _cache
+
+
+def get_pyramid(symbol, period="6mo", interval="1d", refresh=False, ttl=None):
+    """
+    取得以 interval 為基礎週期的K線金字塔（BarPyramid，fetch_result 為原始獲取結果），優先使用快取。
+    同一組 (股票, 期間, 週期) 只獲取一次完整數據，各轉換週期直接取用金字塔中的對應層；
+    快取過期（或 refresh）時只補抓最近的K線並增量更新金字塔，補抓失敗時才重新獲取完整期間。
+    """
+    from bar_pyramid import BarPyramid
+    from stock_data_fetcher import request_window, shared_fetcher
+
+    def compute():
+        result = shared_fetcher().fetch(symbol, period, interval)
+        if result.empty:
+            return None
+        return {'pyramid': BarPyramid.from_result(result)}
+
+    def update(value):
+        # 過期的金字塔只補抓涵蓋最後一根K線之後的最短期間，新K線交給 BarPyramid.update 重算最新的區段
+        pyramid = value['pyramid']
+        if pyramid.fetch_result is None or pyramid.fetch_result.source == 'demo':
+            return None
+        last = pyramid.frame(pyramid.base).index[-1]
+        result = shared_fetcher().fetch(symbol, calendar_for(symbol).covering_period(last), interval)
+        if result.empty or result.source == 'demo':
+            return None
+        pyramid.update(result.data[result.data.index >= last])
+        _, requested_start, end = request_window(period, interval, result.end, symbol)
+        pyramid.fetch_result = pyramid.fetch_result._replace(
+            data=pyramid.frame(pyramid.base), requested_start=requested_start, end=end,
+            source=result.source, elapsed=result.elapsed)
+        return value
+
+    key = make_key(symbol, period, interval, 'pyramid')
+    ttl = ttl if ttl is not None else ttl_for(interval, exchange=exchange_for(symbol))
+    cache = get_analysis_cache()
+    if refresh:
+        current = cache.get(key)
+        value = (current and update(current)) or compute()
+        if value is not None:
+            cache.put(key, value, ttl)
+    else:
+        value = cache.get_or_compute(key, compute, ttl, update=update)
+    return value['pyramid'] if value else None
+
+
+def get_analysis(symbol, period="6mo", interval="1d", resample_to=None, refresh=False, ttl=None):
+    """
+    取得完成分析的結果 {'analyzer': StockAnalyzer, 'signals': dict}，優先使用快取。
+    resample_to 的K線取自快取的K線金字塔，切換轉換週期不需重新獲取或重新聚合數據。
+    refresh=True 時略過快取重新計算並覆寫（供預熱排程使用）；ttl 可覆寫預設存活時間。
+    無法獲取數據時回傳 None（不寫入快取）。
+    """
+    from stock_analyzer import StockAnalyzer
+
+    def compute():
+        analyzer = StockAnalyzer()
+        if resample_to:
+            pyramid = get_pyramid(symbol, period, interval, refresh=refresh)
+            if pyramid is None:
+                return None
+            level = resample_to if resample_to in pyramid else pyramid.base
+            if not analyzer.load(pyramid.result(level)):
+                return None
+        elif not analyzer.fetch_data(symbol, period=period, interval=interval):
+            return None
+        analyzer.analyze()
+        signals = analyzer.generate_trading_signals()
+        # 快取中的分析器僅供讀取，不保留數據獲取器（及其 API 連線）
+        analyzer.data_fetcher = None
+        return {'analyzer': analyzer, 'signals': signals}
+
+    key = make_key(symbol, period, interval, resample_to)
+    ttl = ttl if ttl is not None else ttl_for(resample_to or interval, exchange=exchange_for(symbol))
+    cache = get_analysis_cache()
+    if refresh:
+        value = compute()
+        if value is not None:
+            cache.put(key, value, ttl)
+        return value
+    return cache.get_or_compute(key, compute, ttl)
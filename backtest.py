@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+黃藍線交叉策略向量化回測
+沿用 find_crossover_points 的交叉判斷：黃金交叉後持有、死亡交叉後出場（只做多），
+信號於收盤確認、下一根開盤成交，並扣除手續費與賣出證券交易稅。
+所有計算皆為 (股票數, K線數) 的陣列運算，單檔與整個面板共用同一套流程。
+"""
+
+import numpy as np
+import pandas as pd
+from stock_analyzer import crossover_masks
+
+# 台股交易成本：手續費每邊 0.1425%，賣出證券交易稅 0.3%
+COMMISSION_RATE = 0.001425
+TRANSACTION_TAX = 0.003
+# 年化使用的每年交易日數
+BARS_PER_YEAR = 252
+# 黃線 / 藍線的 EMA 週期，與 StockAnalyzer.calculate_moving_averages 相同
+FAST_SPAN = 5
+SLOW_SPAN = 20
+
+
+def ema(values, span):
+    """沿最後一軸計算 EMA，結果與 ta.trend.ema_indicator 相同"""
+    values = np.asarray(values, dtype='float64')
+    frame = pd.DataFrame(np.atleast_2d(values).T)
+    result = frame.ewm(span=span, adjust=False, min_periods=span).mean().to_numpy().T
+    return result.reshape(values.shape)
+
+
+def crossover_positions(yellow, blue):
+    """依交叉點決定每根K線收盤後的目標持倉（黃金交叉後為 True，直到死亡交叉；首次交叉前不持倉）"""
+    golden, death = crossover_masks(yellow, blue)
+    n = golden.shape[-1]
+    # 每根K線最近一次交叉的位置；第一根恆非交叉，因此尚未交叉時指向 0（不持倉）
+    last_cross = np.where(golden | death, np.arange(n), 0)
+    np.maximum.accumulate(last_cross, axis=-1, out=last_cross)
+    return np.take_along_axis(golden, last_cross, axis=-1)
+
+
+class BacktestResult:
+    """回測結果：各陣列形狀皆為 (股票數, K線數)"""
+
+    def __init__(self, index, symbols, held, returns, equity, drawdown, trades, stats):
+        self.index = index
+        self.symbols = list(symbols)
+        self.held = held
+        self.returns = returns
+        self.equity = equity
+        self.drawdown = drawdown
+        self.trades = trades
+        self.stats = stats
+
+    def frame(self, symbol):
+        """單檔股票的持倉、報酬、權益與回撤 DataFrame（symbol 可為代碼或位置）"""
+        i = symbol if isinstance(symbol, (int, np.integer)) else self.symbols.index(symbol)
+        return pd.DataFrame({
+            'Position': self.held[i].astype(int),
+            'Return': self.returns[i],
+            'Equity': self.equity[i],
+            'Drawdown': self.drawdown[i],
+        }, index=self.index)
+
+    def portfolio(self):
+        """等權重投資組合的權益曲線（各股資金相同、互不再平衡）"""
+        equity = pd.Series(self.equity.mean(axis=0), index=self.index, name='Equity')
+        return pd.DataFrame({'Equity': equity, 'Drawdown': equity / equity.cummax() - 1})
+
+
+def _trade_table(held, entered, exited, open_, close, equity, index, symbols):
+    """配對每檔的進出場，計算每筆交易的報酬（含成本）"""
+    n_bars = held.shape[1]
+    # 期末仍持有的部位以最後收盤價結算（不扣出場成本）
+    still_open = held[:, -1]
+    exit_marks = exited.copy()
+    exit_marks[still_open, -1] = True
+
+    entry_rows, entry_cols = np.nonzero(entered)
+    exit_rows, exit_cols = np.nonzero(exit_marks)
+    # 同一檔的進出場依時間交錯，row-major 排序後第 k 個進場對應第 k 個出場
+    is_open = still_open[exit_rows] & (exit_cols == n_bars - 1) & ~exited[exit_rows, exit_cols]
+
+    trade_return = equity[exit_rows, exit_cols] / equity[entry_rows, entry_cols - 1] - 1
+    exit_price = np.where(is_open, close[exit_rows, exit_cols], open_[exit_rows, exit_cols])
+    trades = pd.DataFrame({
+        'symbol': np.asarray(symbols, dtype=object)[entry_rows],
+        'entry_date': index[entry_cols],
+        'entry_price': open_[entry_rows, entry_cols],
+        'exit_date': index[exit_cols],
+        'exit_price': exit_price,
+        'return': trade_return,
+        'bars': exit_cols - entry_cols + is_open,
+        'open': is_open,
+    })
+    return trades, entry_rows
+
+
+def _stats(symbols, held, returns, equity, drawdown, trades, trade_rows, initial_capital, bars_per_year):
+    """各檔績效統計"""
+    n_symbols, n_bars = held.shape
+    years = n_bars / bars_per_year
+    trade_return = trades['return'].to_numpy()
+
+    def per_symbol(weights=None):
+        return np.bincount(trade_rows, weights=weights, minlength=n_symbols)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        final = equity[:, -1] / initial_capital
+        std = returns.std(axis=1, ddof=1)
+        n_trades = per_symbol()
+        gross_profit = per_symbol(np.clip(trade_return, 0, None))
+        gross_loss = per_symbol(np.clip(-trade_return, 0, None))
+        stats = pd.DataFrame({
+            'total_return': final - 1,
+            'cagr': final ** (1 / years) - 1 if years > 0 else np.nan,
+            'volatility': std * np.sqrt(bars_per_year),
+            'sharpe': np.where(std > 0, returns.mean(axis=1) / std * np.sqrt(bars_per_year), np.nan),
+            'max_drawdown': drawdown.min(axis=1),
+            'exposure': held.mean(axis=1),
+            'trades': n_trades.astype(int),
+            'win_rate': np.where(n_trades > 0, per_symbol(trade_return > 0) / n_trades, np.nan),
+            'avg_trade_return': np.where(n_trades > 0, per_symbol(trade_return) / n_trades, np.nan),
+            'profit_factor': np.where(gross_loss > 0, gross_profit / gross_loss, np.nan),
+            'avg_bars_held': np.where(n_trades > 0, per_symbol(trades['bars'].to_numpy()) / n_trades, np.nan),
+        }, index=pd.Index(symbols, name='symbol'))
+    return stats
+
+
+def position_growth(open_, close, target, commission=COMMISSION_RATE, tax=TRANSACTION_TAX):
+    """
+    由收盤後的目標持倉計算逐根淨值成長倍數，回傳 (held, entered, exited, growth)。
+    第 t 根收盤的目標 → 第 t+1 根開盤成交；進場扣手續費，出場扣手續費與交易稅。
+    """
+    open_ = np.atleast_2d(np.asarray(open_, dtype='float64'))
+    close = np.atleast_2d(np.asarray(close, dtype='float64'))
+    target = np.atleast_2d(target)
+    held = np.zeros_like(target)
+    held[:, 1:] = target[:, :-1]
+    prev_held = np.zeros_like(held)
+    prev_held[:, 1:] = held[:, :-1]
+    entered = held & ~prev_held
+    exited = ~held & prev_held
+
+    prev_close = np.empty_like(close)
+    prev_close[:, 0] = open_[:, 0]
+    prev_close[:, 1:] = close[:, :-1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # 進場當根以開盤價為成本，持有中以前一收盤計算，出場當根以開盤價結算
+        base = np.where(entered, open_, prev_close)
+        gross = np.where(held, close / base, 1.0)
+        gross = np.where(exited, open_ / prev_close, gross)
+    costs = 1 - commission * entered - (commission + tax) * exited
+    growth = gross * costs
+    growth[~np.isfinite(growth)] = 1.0
+    return held, entered, exited, growth
+
+
+def backtest_positions(open_, close, target, index=None, symbols=None,
+                       commission=COMMISSION_RATE, tax=TRANSACTION_TAX,
+                       initial_capital=1.0, bars_per_year=BARS_PER_YEAR):
+    """依任意目標持倉陣列回測，可傳入 (K線數,) 或 (股票數, K線數)"""
+    open_ = np.atleast_2d(np.asarray(open_, dtype='float64'))
+    close = np.atleast_2d(np.asarray(close, dtype='float64'))
+    n_symbols, n_bars = close.shape
+    index = pd.RangeIndex(n_bars) if index is None else pd.Index(index)
+    symbols = list(symbols) if symbols is not None else [str(i) for i in range(n_symbols)]
+
+    held, entered, exited, growth = position_growth(open_, close, target, commission, tax)
+    equity = initial_capital * np.cumprod(growth, axis=1)
+    returns = growth - 1
+    drawdown = equity / np.maximum.accumulate(equity, axis=1) - 1
+
+    trades, trade_rows = _trade_table(held, entered, exited, open_, close, equity, index, symbols)
+    stats = _stats(symbols, held, returns, equity, drawdown, trades, trade_rows, initial_capital, bars_per_year)
+    return BacktestResult(index, symbols, held, returns, equity, drawdown, trades, stats)
+
+
+def backtest_arrays(open_, close, yellow, blue, **kwargs):
+    """
+    以開盤價、收盤價與黃藍線陣列回測交叉策略，可傳入 (K線數,) 或 (股票數, K線數)。
+    第 t 根收盤出現交叉 → 第 t+1 根開盤成交。
+    """
+    return backtest_positions(open_, close, crossover_positions(yellow, blue), **kwargs)
+
+
+def backtest_prices(open_, close, fast=FAST_SPAN, slow=SLOW_SPAN, **kwargs):
+    """由收盤價計算黃線（快 EMA）與藍線（慢 EMA）後回測"""
+    return backtest_arrays(open_, close, ema(close, fast), ema(close, slow), **kwargs)
+
+
+def backtest_panel(panel, fast=FAST_SPAN, slow=SLOW_SPAN, **kwargs):
+    """回測具有 open / close / index / symbols 屬性的面板（例如 synthetic_market.SyntheticPanel）"""
+    return backtest_prices(panel.open, panel.close, fast, slow, index=panel.index, symbols=panel.symbols, **kwargs)
+
+
+def backtest_frame(data, symbol="", fast=FAST_SPAN, slow=SLOW_SPAN, **kwargs):
+    """回測單檔 OHLC DataFrame；已有 Yellow_Line / Blue_Line 時直接使用"""
+    close = data['Close'].to_numpy(dtype='float64')
+    if 'Yellow_Line' in data.columns and 'Blue_Line' in data.columns:
+        yellow, blue = data['Yellow_Line'].to_numpy(), data['Blue_Line'].to_numpy()
+    else:
+        yellow, blue = ema(close, fast), ema(close, slow)
+    return backtest_arrays(data['Open'].to_numpy(dtype='float64'), close, yellow, blue,
+                           index=data.index, symbols=[symbol], **kwargs)
+
+
+def _aligned(frames, column):
+    """將各檔指定欄位對齊為 (股票數, 交易日) 陣列，日期去除時區以便跨市場對齊"""
+    series = {}
+    for symbol, data in frames.items():
+        index = data.index.tz_localize(None) if data.index.tz is not None else data.index
+        series[symbol] = pd.Series(data[column].to_numpy(dtype='float64'), index=index)
+    matrix = pd.concat(series, axis=1).sort_index()
+    return matrix[~matrix.index.duplicated(keep='last')]
+
+
+def backtest_frames(frames, fast=FAST_SPAN, slow=SLOW_SPAN, **kwargs):
+    """
+    回測多檔 {代碼: DataFrame}，對齊到共同交易日曆後一次計算。
+    休市或未上市的日期收盤價以前值補齊、開盤價以收盤價補齊，該期間不會產生交叉。
+    """
+    frames = {symbol: data for symbol, data in frames.items() if data is not None and not data.empty}
+    close = _aligned(frames, 'Close').ffill()
+    open_ = _aligned(frames, 'Open').reindex(close.index).fillna(close)
+    lines = all('Yellow_Line' in d.columns and 'Blue_Line' in d.columns for d in frames.values())
+    if lines:
+        yellow = _aligned(frames, 'Yellow_Line').reindex(close.index).ffill().to_numpy().T
+        blue = _aligned(frames, 'Blue_Line').reindex(close.index).ffill().to_numpy().T
+    else:
+        yellow, blue = ema(close.to_numpy().T, fast), ema(close.to_numpy().T, slow)
+    return backtest_arrays(open_.to_numpy().T, close.to_numpy().T, yellow, blue,
+                           index=close.index, symbols=list(close.columns), **kwargs)
+
+
+def print_backtest(result, top_n=20):
+    """打印回測績效（依總報酬排序）"""
+    stats = result.stats.sort_values('total_return', ascending=False)
+    print(f"\n=== 黃藍線交叉策略回測 ({len(result.symbols)} 檔, {len(result.index)} 根K線) ===")
+    print(f"成本: 手續費 {COMMISSION_RATE * 100:.4f}%/邊，證交稅 {TRANSACTION_TAX * 100:.1f}%（賣出）")
+    print(f"{'股票代碼':<12} {'總報酬%':>9} {'年化%':>8} {'最大回撤%':>10} {'夏普':>6} {'交易數':>6} {'勝率%':>7}")
+    print("-" * 66)
+    for symbol, row in stats.head(top_n).iterrows():
+        win_rate = f"{row['win_rate'] * 100:>7.1f}" if pd.notna(row['win_rate']) else f"{'N/A':>7}"
+        sharpe = f"{row['sharpe']:>6.2f}" if pd.notna(row['sharpe']) else f"{'N/A':>6}"
+        print(f"{symbol:<12} {row['total_return'] * 100:>9.2f} {row['cagr'] * 100:>8.2f} "
+              f"{row['max_drawdown'] * 100:>10.2f} {sharpe} {int(row['trades']):>6} {win_rate}")
+    if len(result.symbols) > 1:
+        portfolio = result.portfolio()
+        print(f"\n等權重組合: 總報酬 {(portfolio['Equity'].iloc[-1] - 1) * 100:.2f}%，"
+              f"最大回撤 {portfolio['Drawdown'].min() * 100:.2f}%")
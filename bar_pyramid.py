@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+K線金字塔
+由最細的K線逐層聚合出 1m → 5m → 15m → 60m → 1d → 1wk → 1mo，每一層只由較細的一層計算
+（週K與月K跨越的日期不對齊，兩者皆由日K計算）：
+- 分鐘K以交易所開盤時間為錨點切分，收盤後（含收盤集合競價）的K線歸入當日最後一根；
+  開盤、收盤時間取自 trading_calendar，提前收盤日以提前的收盤時間為準
+- 日K以交易所時區的交易日為單位；週K、月K以當週／當月實際有交易的第一天為標籤
+新K線到達時，每一層只重算最新（及新增）的區段，不重新聚合整段歷史。
+K線時間以區段開始為標籤（與 yfinance 相同）。
+"""
+
+import threading
+import numpy as np
+import pandas as pd
+from metrics import timed
+from trading_calendar import exchange_for, get_calendar
+
+# 各週期的長度（分鐘），用於排序與判斷能否由較細的一層整除聚合
+LEVEL_MINUTES = {
+    '1m': 1, '2m': 2, '5m': 5, '15m': 15, '30m': 30, '60m': 60, '90m': 90,
+    '1d': 1440, '1wk': 7 * 1440, '1mo': 31 * 1440,
+}
+LEVEL_ALIASES = {'1h': '60m'}
+LEVELS = ('1m', '5m', '15m', '60m', '1d', '1wk', '1mo')
+DAILY_MINUTES = LEVEL_MINUTES['1d']
+
+OHLCV_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+
+_MINUTE = np.int64(60 * 10**9)
+_DAY = np.int64(86400 * 10**9)
+
+
+def normalize_level(level):
+    level = LEVEL_ALIASES.get(level, level)
+    if level not in LEVEL_MINUTES:
+        raise ValueError(f"不支援的K線週期: {level}")
+    return level
+
+
+def can_aggregate(parent, child):
+    """child 週期的每個區段是否恰由整數個 parent 區段組成"""
+    parent_minutes, child_minutes = LEVEL_MINUTES[parent], LEVEL_MINUTES[child]
+    if child_minutes <= parent_minutes:
+        return False
+    if child_minutes < DAILY_MINUTES:
+        return child_minutes % parent_minutes == 0
+    # 分鐘K以開盤為錨點不跨日；週K與月K只能由日K以下的週期組成
+    return child == '1d' or parent_minutes <= DAILY_MINUTES
+
+
+def _local_ns(index, tz):
+    """K線時間轉為交易所當地時間（不含時區）的 int64 奈秒；無時區的索引視為已是當地時間"""
+    if index.tz is not None:
+        index = index.tz_convert(tz).tz_localize(None)
+    return index.as_unit('ns').asi8
+
+
+def _to_index(local_ns, like, tz):
+    """將當地時間的奈秒轉回與 like 相同時區的 DatetimeIndex"""
+    index = pd.DatetimeIndex(local_ns.astype('datetime64[ns]'), name=like.name)
+    if like.tz is not None:
+        index = index.tz_localize(tz).tz_convert(like.tz)
+    return index
+
+
+def bucket_keys(index, level, session='TWSE'):
+    """
+    每根K線所屬區段的 (鍵, 區段標籤的當地時間奈秒)；索引已排序時鍵為非遞減。
+    日K以下的標籤為區段開始時間，週K、月K的標籤在 aggregate 中改為區段內第一個交易日。
+    """
+    calendar = get_calendar(session)
+    local = _local_ns(index, calendar.tz)
+    day = local - local % _DAY
+    minutes = LEVEL_MINUTES[level]
+    if minutes < DAILY_MINUTES:
+        open_offset = np.int64(calendar.open_time[0] * 60 + calendar.open_time[1])
+        session_minutes = calendar.close_minutes((day // _DAY).astype('datetime64[D]')) - open_offset
+        offset = np.clip((local - day) // _MINUTE - open_offset, 0, session_minutes - 1)
+        labels = day + (open_offset + offset // minutes * minutes) * _MINUTE
+        return labels, labels
+    if level == '1d':
+        return day, day
+    days = day // _DAY
+    if level == '1wk':
+        # 1970-01-01 為週四，+3 後以週一為一週的開始
+        return (days + 3) // 7, day
+    dates = day.astype('datetime64[ns]').astype('datetime64[M]').astype('int64')
+    return dates, day
+
+
+@timed('bar_pyramid_seconds', stage='aggregate')
+def aggregate(data, level, session='TWSE'):
+    """將已排序的 OHLCV 聚合為指定週期（依交易時段切分），只保留 OHLCV 欄位"""
+    level = normalize_level(level)
+    if data is None or data.empty:
+        return data
+    keys, labels = bucket_keys(data.index, level, session)
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    ends = np.append(starts[1:], len(keys))
+    columns = [column for column in OHLCV_COLUMNS if column in data.columns]
+    out = {}
+    if 'Open' in columns:
+        out['Open'] = data['Open'].to_numpy()[starts]
+    if 'High' in columns:
+        out['High'] = np.fmax.reduceat(data['High'].to_numpy(), starts)
+    if 'Low' in columns:
+        out['Low'] = np.fmin.reduceat(data['Low'].to_numpy(), starts)
+    if 'Close' in columns:
+        out['Close'] = data['Close'].to_numpy()[ends - 1]
+    if 'Volume' in columns:
+        out['Volume'] = np.add.reduceat(data['Volume'].to_numpy(), starts)
+    index = _to_index(labels[starts], data.index, get_calendar(session).tz)
+    return pd.DataFrame(out, index=index)[columns]
+
+
+class BarPyramid:
+    """
+    由基礎週期逐層聚合的K線金字塔。
+    只包含能由較細一層整除聚合的週期（例如基礎為 30m 時為 30m → 60m → 1d → 1wk / 1mo），
+    每一層由可整除它的最粗一層計算（parents）。
+    frame() 回傳的 DataFrame 為共用的內部數據，請勿直接修改。
+    """
+
+    def __init__(self, data, base='1d', session='TWSE', levels=LEVELS):
+        self.base = normalize_level(base)
+        self.session = session
+        self.levels = [self.base]
+        self.parents = {}
+        for level in sorted({normalize_level(level) for level in levels}, key=LEVEL_MINUTES.get):
+            parents = [parent for parent in self.levels if can_aggregate(parent, level)]
+            if parents:
+                self.parents[level] = parents[-1]
+                self.levels.append(level)
+        self._frames = {}
+        self._lock = threading.Lock()
+        self.fetch_result = None
+        self._build(data)
+
+    @classmethod
+    def from_result(cls, result, levels=LEVELS):
+        """由 FetchResult 建立，基礎週期與交易時段取自請求"""
+        pyramid = cls(result.data, base=result.interval, session=exchange_for(result.symbol), levels=levels)
+        pyramid.fetch_result = result
+        return pyramid
+
+    def _build(self, data):
+        data = data[[column for column in OHLCV_COLUMNS if column in data.columns]]
+        self._frames[self.base] = data
+        for child in self.levels[1:]:
+            self._frames[child] = aggregate(self._frames[self.parents[child]], child, self.session)
+
+    def __contains__(self, level):
+        return LEVEL_ALIASES.get(level, level) in self._frames
+
+    def frame(self, level):
+        """取得指定週期的K線"""
+        level = LEVEL_ALIASES.get(level, level)
+        if level not in self._frames:
+            raise KeyError(f"K線金字塔（基礎週期 {self.base}）不含 {level}")
+        return self._frames[level]
+
+    def result(self, level):
+        """以指定週期的K線取代 fetch_result 的數據，供 StockAnalyzer.load() 使用"""
+        level = LEVEL_ALIASES.get(level, level)
+        return self.fetch_result._replace(data=self.frame(level), interval=level)
+
+    @timed('bar_pyramid_seconds', stage='update')
+    def update(self, bars):
+        """
+        加入新的基礎週期K線（既有K線中不早於新K線第一根的部分以新數據取代），
+        每一層只重算受影響的最後幾個區段。回傳各週期被重算的K線數。
+        """
+        if bars is None or bars.empty:
+            return {}
+        bars = bars[[column for column in OHLCV_COLUMNS if column in bars.columns]].sort_index()
+        with self._lock:
+            return self._update(bars)
+
+    def _update(self, bars):
+        base = self._frames[self.base]
+        changed_from = {self.base: bars.index[0]}
+        self._frames[self.base] = pd.concat([base.iloc[:base.index.searchsorted(bars.index[0])], bars])
+        touched = {self.base: len(bars)}
+        for child in self.levels[1:]:
+            parent = self.parents[child]
+            current = self._frames[child]
+            # 可能包含變動K線的第一個區段：標籤不晚於變動時間的最後一個區段
+            position = current.index.searchsorted(changed_from[parent], side='right') - 1
+            source = self._frames[parent]
+            if position >= 0:
+                source = source.iloc[source.index.searchsorted(current.index[position]):]
+            else:
+                position = 0
+            tail = aggregate(source, child, self.session)
+            self._frames[child] = pd.concat([current.iloc[:position], tail])
+            touched[child] = len(tail)
+            changed_from[child] = tail.index[0]
+        return touched
+
+    def nbytes(self):
+        return int(sum(frame.memory_usage(deep=True).sum() for frame in self._frames.values()))
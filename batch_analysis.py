@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量分析模組
+並行獲取並分析多檔股票，並將各股價格對齊到共同交易日曆上做標準化比較。
+"""
+
+import concurrent.futures
+import json
+import numpy as np
+import pandas as pd
+from analysis_cache import get_analysis
+
+
+def analyze_batch(symbols, period="6mo", interval="1d", max_workers=8, on_progress=None, store=None):
+    """
+    並行分析多檔股票，回傳 {股票代碼: 分析結果}（依輸入順序，失敗者略過）。
+    on_progress(完成數, 總數, 股票代碼, 結果) 會在呼叫端執行緒中於每檔完成時呼叫，
+    因此可安全地更新 Streamlit 進度條。
+    store 為 MarketStore 時，日K且已在儲存區的股票直接讀取本地數據，不經網路下載。
+    """
+    symbols = list(dict.fromkeys(symbols))
+    results = {}
+
+    def analyze(symbol):
+        if store is not None and interval == "1d" and symbol in store:
+            from market_store import analyze_from_store
+            return analyze_from_store(store, symbol, period)
+        return get_analysis(symbol, period, interval)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_symbol = {
+            executor.submit(analyze, symbol): symbol
+            for symbol in symbols
+        }
+        for done, future in enumerate(concurrent.futures.as_completed(future_to_symbol), 1):
+            symbol = future_to_symbol[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"分析 {symbol} 時發生錯誤: {e}")
+                result = None
+            if result:
+                results[symbol] = result
+            if on_progress:
+                on_progress(done, len(symbols), symbol, result)
+
+    return {symbol: results[symbol] for symbol in symbols if symbol in results}
+
+
+def close_matrix(results):
+    """將各股收盤價對齊為 (交易日 × 股票) 矩陣，日期去除時區以便跨市場對齊"""
+    series = {}
+    for symbol, result in results.items():
+        close = result['analyzer'].data['Close']
+        index = close.index
+        if index.tz is not None:
+            index = index.tz_localize(None)
+        series[symbol] = pd.Series(close.to_numpy(), index=index.normalize())
+    if not series:
+        return pd.DataFrame()
+    matrix = pd.concat(series, axis=1).sort_index()
+    return matrix[~matrix.index.duplicated(keep='last')]
+
+
+def normalized_prices(results):
+    """以各股第一筆有效收盤價為 100 標準化，缺值（休市日）以前值補齊"""
+    matrix = close_matrix(results).ffill()
+    if matrix.empty:
+        return matrix
+    return matrix / matrix.bfill().iloc[0] * 100
+
+
+def comparison_table(results):
+    """建立批量比較表（期間漲跌以對齊後的矩陣一次計算）"""
+    matrix = close_matrix(results).ffill()
+    first = matrix.bfill().iloc[0]
+    last = matrix.iloc[-1]
+
+    rows = []
+    for symbol, result in results.items():
+        signals = result['signals']
+        profits = [p['profit_potential'] for p in signals['profit_analysis']]
+        rows.append({
+            '股票代碼': symbol,
+            '當前價格': last[symbol],
+            '期間漲跌(%)': (last[symbol] / first[symbol] - 1) * 100,
+            '交叉點數': len(signals['crossovers'] or []),
+            '上升趨勢數': len(signals['uptrends']),
+            '平均利潤空間(%)': np.mean(profits) if profits else 0
+        })
+    return pd.DataFrame(rows)
+
+
+# 輸出時摘要的指標欄位
+SUMMARY_INDICATORS = ['MA5', 'MA20', 'MA60', 'Support', 'Resistance', 'Trend_Slope']
+
+
+def _json_value(value):
+    """將 numpy / pandas 型別轉為可序列化的 Python 值"""
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if isinstance(value, (np.floating, float)):
+        return None if np.isnan(value) else float(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+
+def summarize_result(symbol, result, scorer):
+    """將單檔分析結果整理為一筆機器可讀的紀錄"""
+    analyzer = result['analyzer']
+    signals = result['signals']
+    data = analyzer.data
+    last = data.iloc[-1]
+    crossovers = signals['crossovers'] or []
+    profits = [p['profit_potential'] for p in signals['profit_analysis']]
+    latest_cross = crossovers[-1] if crossovers else None
+
+    record = {
+        'symbol': symbol,
+        'date': data.index[-1],
+        'close': last['Close'],
+        'score': scorer.calculate_stock_score(analyzer, signals),
+        'crossovers': len(crossovers),
+        'latest_signal': latest_cross['signal'] if latest_cross else None,
+        'latest_signal_date': latest_cross['date'] if latest_cross else None,
+        'uptrends': len(signals['uptrends']),
+        'avg_profit_potential': np.mean(profits) if profits else None,
+        'max_profit_potential': np.max(profits) if profits else None,
+    }
+    for column in SUMMARY_INDICATORS:
+        record[column.lower()] = last[column] if column in data.columns else None
+    return {key: _json_value(value) for key, value in record.items()}
+
+
+def run_batch(symbols, output, fmt="jsonl", period="6mo", interval="1d", max_workers=8, store=None):
+    """
+    非互動批量分析：並行分析所有股票並將摘要寫出為 JSON Lines 或 Parquet。
+    JSON Lines 會在每檔完成時立即寫入，中途中斷仍保留已完成的結果。
+    回傳成功筆數。
+    """
+    from stock_screener import StockScreener
+
+    scorer = StockScreener()
+    records = []
+    jsonl_file = open(output, 'w', encoding='utf-8') if fmt == "jsonl" else None
+
+    def on_progress(done, total, symbol, result):
+        if result:
+            try:
+                record = summarize_result(symbol, result, scorer)
+            except Exception as e:
+                print(f"✗ {symbol}: 摘要失敗 - {e}")
+                return
+            records.append(record)
+            if jsonl_file:
+                jsonl_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                jsonl_file.flush()
+        print(f"[{done}/{total}] {'✓' if result else '✗'} {symbol}")
+
+    try:
+        analyze_batch(symbols, period=period, interval=interval, max_workers=max_workers,
+                      on_progress=on_progress, store=store)
+    finally:
+        if jsonl_file:
+            jsonl_file.close()
+
+    if fmt == "parquet":
+        # 需要 pyarrow 或 fastparquet
+        pd.DataFrame(records).to_parquet(output, index=False)
+
+    print(f"✅ 批量分析完成: {len(records)}/{len(symbols)} 檔，結果已寫入 {output}")
+    return len(records)
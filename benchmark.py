@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分析流程效能基準測試
+以固定種子的合成數據，對數據整理、均線、趨勢斜率、交叉點、利潤空間、評分與圖表建立
+各階段在不同規模下量測吞吐量、延遲百分位與記憶體峰值，並輸出 JSON 供版本間比較。
+另以全新直譯器量測主要模組的匯入時間，並檢查重量級依賴是否在匯入時就被載入。
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from synthetic_market import generate_ohlcv, generate_panel
+
+# 預設規模：單檔K線數與多檔股票數
+DEFAULT_BAR_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+DEFAULT_SYMBOL_COUNTS = [10, 100, 2_000]
+# 多檔評分時每檔的K線數
+BARS_PER_SYMBOL = 250
+# 量測匯入時間的模組，以及這些模組匯入時不應載入的重量級依賴
+STARTUP_MODULES = ['stock_analyzer', 'stock_screener', 'batch_analysis', 'main']
+HEAVY_MODULES = ['matplotlib', 'plotly', 'ta', 'yfinance', 'shioaji']
+STARTUP_REPEATS = 5
+
+_STARTUP_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def make_analyzer(data, symbol="BENCH"):
+    """建立不連線任何數據源的分析器"""
+    from stock_analyzer import StockAnalyzer
+
+    analyzer = StockAnalyzer()
+    analyzer.data = data.copy()
+    analyzer.symbol = symbol
+    analyzer.data_fetcher = None
+    return analyzer
+
+
+def measure(func, repeats):
+    """執行 repeats 次量測延遲，並額外執行一次以 tracemalloc 量測記憶體峰值"""
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return latencies, peak
+
+
+def summarize(stage, size, unit, latencies, peak):
+    """整理單一量測結果"""
+    latencies = np.asarray(latencies)
+    p50 = float(np.percentile(latencies, 50))
+    return {
+        'stage': stage,
+        'size': size,
+        'unit': unit,
+        'repeats': len(latencies),
+        'throughput_per_sec': size / p50 if p50 > 0 else None,
+        'latency_p50_ms': p50 * 1000,
+        'latency_p95_ms': float(np.percentile(latencies, 95)) * 1000,
+        'latency_p99_ms': float(np.percentile(latencies, 99)) * 1000,
+        'peak_memory_mb': peak / 1024 / 1024,
+    }
+
+
+def repeats_for(size):
+    """規模越大重複次數越少，控制整體執行時間"""
+    if size <= 10_000:
+        return 10
+    if size <= 100_000:
+        return 3
+    return 1
+
+
+def bench_bar_stages(n):
+    """單檔各分析階段"""
+    from stock_data_fetcher import stitch_frames, split_date_windows
+
+    data = generate_ohlcv(n)
+    repeats = repeats_for(n)
+    results = []
+
+    # 數據整理：模擬分段下載後的合併去重（不含網路延遲）
+    windows = split_date_windows(data.index[0], data.index[-1] + pd.Timedelta(days=1), 30)
+    chunks = [data[(data.index >= start) & (data.index < end)] for start, end in windows]
+    results.append(summarize('fetch_stitch', n, 'bars', *measure(lambda: stitch_frames(chunks), repeats)))
+
+    analyzer = make_analyzer(data)
+    results.append(summarize('calculate_moving_averages', n, 'bars',
+                             *measure(analyzer.calculate_moving_averages, repeats)))
+    analyzer.calculate_support_resistance()
+    results.append(summarize('detect_trend_slope', n, 'bars',
+                             *measure(analyzer.detect_trend_slope, repeats)))
+    results.append(summarize('find_crossover_points', n, 'bars',
+                             *measure(analyzer.find_crossover_points, repeats)))
+
+    crossovers = analyzer.find_crossover_points()
+    results.append(summarize('calculate_profit_potential', n, 'bars',
+                             *measure(lambda: analyzer.calculate_profit_potential(crossovers), repeats)))
+    results.append(summarize('create_interactive_chart', n, 'bars',
+                             *measure(analyzer.create_interactive_chart, repeats)))
+    return results
+
+
+def bench_scoring(symbol_count):
+    """多檔評分：事先完成分析，只量測交易信號與評分"""
+    from stock_screener import StockScreener
+
+    screener = StockScreener()
+    analyzers = []
+    for symbol, data in generate_panel(symbol_count, BARS_PER_SYMBOL).frames():
+        analyzer = make_analyzer(data, symbol=symbol)
+        analyzer.calculate_moving_averages()
+        analyzer.calculate_support_resistance()
+        analyzer.detect_trend_slope()
+        analyzers.append(analyzer)
+
+    def score_all():
+        for analyzer in analyzers:
+            screener.calculate_stock_score(analyzer, analyzer.generate_trading_signals())
+
+    return summarize('signals_and_scoring', symbol_count, 'symbols',
+                     *measure(score_all, repeats_for(symbol_count * 10)))
+
+
+def bench_startup(module, repeats=STARTUP_REPEATS):
+    """以全新的直譯器量測匯入模組的時間，並記錄連帶載入的重量級依賴"""
+    probe = _STARTUP_PROBE.format(module=module, heavy=HEAVY_MODULES)
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    latencies = []
+    heavy = set()
+    for _ in range(repeats):
+        completed = subprocess.run([sys.executable, '-c', probe], capture_output=True,
+                                   text=True, check=True, cwd=cwd)
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        latencies.append(result['seconds'])
+        heavy.update(result['heavy'])
+
+    summary = summarize(f'import_{module}', 1, 'imports', latencies, 0)
+    summary['heavy_modules'] = sorted(heavy)
+    return summary
+
+
+def check_startup(modules=None):
+    """量測所有模組的匯入時間；回傳匯入時即載入重量級依賴的模組清單"""
+    results = [bench_startup(module) for module in modules or STARTUP_MODULES]
+    leaks = []
+    for r in results:
+        print(f"{r['stage']:<28} p50 {r['latency_p50_ms']:>8.1f} ms")
+        if r['heavy_modules']:
+            leaks.append(r['stage'])
+            print(f"   ⚠️ 匯入時載入了 {', '.join(r['heavy_modules'])}")
+    return results, leaks
+
+
+def bench_backtest(symbol_count, years=10):
+    """多檔 × 多年的向量化回測"""
+    from backtest import backtest_panel
+
+    panel = generate_panel(symbol_count, years * 252)
+    return summarize('backtest_panel', symbol_count, 'symbols',
+                     *measure(lambda: backtest_panel(panel), repeats_for(symbol_count * 10)))
+
+
+def code_version():
+    """取得目前程式版本（git commit），無法取得時回傳 None"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run_benchmarks(bar_sizes=None, symbol_counts=None, output="benchmark_results.json"):
+    """執行完整基準測試並寫出 JSON"""
+    bar_sizes = bar_sizes or DEFAULT_BAR_SIZES
+    symbol_counts = symbol_counts or DEFAULT_SYMBOL_COUNTS
+    results = []
+
+    print("⏱️ 模組匯入時間...")
+    startup, _ = check_startup()
+    results.extend(startup)
+    for n in bar_sizes:
+        print(f"⏱️ 單檔 {n:,} 根K線...")
+        results.extend(bench_bar_stages(n))
+    for count in symbol_counts:
+        print(f"⏱️ {count:,} 檔股票評分...")
+        results.append(bench_scoring(count))
+        print(f"⏱️ {count:,} 檔股票 10 年回測...")
+        results.append(bench_backtest(count))
+
+    report = {
+        'version': code_version(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'results': results,
+    }
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print_report(report)
+    print(f"\n✅ 基準測試結果已寫入 {output}")
+    return report
+
+
+def print_report(report, baseline=None):
+    """打印結果表；提供 baseline 時顯示與基準版本的 p50 延遲比值"""
+    base = {}
+    if baseline:
+        base = {(r['stage'], r['size']): r for r in baseline['results']}
+
+    print(f"\n=== 基準測試結果 (版本 {report.get('version') or 'N/A'}) ===")
+    header = f"{'階段':<28} {'規模':>10} {'吞吐量/秒':>14} {'p50(ms)':>10} {'p95(ms)':>10} {'記憶體(MB)':>11}"
+    if base:
+        header += f" {'相對基準':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in report['results']:
+        line = (f"{r['stage']:<28} {r['size']:>10,} {r['throughput_per_sec'] or 0:>14,.0f} "
+                f"{r['latency_p50_ms']:>10.2f} {r['latency_p95_ms']:>10.2f} {r['peak_memory_mb']:>11.1f}")
+        previous = base.get((r['stage'], r['size']))
+        if previous:
+            line += f" {r['latency_p50_ms'] / previous['latency_p50_ms']:>8.2f}x"
+        print(line)
+
+
+def compare(current_path, baseline_path):
+    """比較兩份基準測試結果"""
+    with open(current_path, encoding='utf-8') as f:
+        current = json.load(f)
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"基準版本: {baseline.get('version') or 'N/A'} ({baseline.get('timestamp')})")
+    print_report(current, baseline)
+
+
+if __name__ == "__main__":
+    run_benchmarks()
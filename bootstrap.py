@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+區塊自助法（block bootstrap）信賴區間
+以循環移動區塊重抽報酬序列，保留短期的自相關與波動聚集：
+- 利潤空間：以重抽的日報酬（連同當日最高價相對收盤的比例）重建價格路徑，
+  在每條路徑上重新判斷黃金交叉並計算平均利潤空間
+- 回測報酬：直接重抽策略的逐K線淨報酬，以區塊累積和計算總報酬與夏普
+所有重抽一次以陣列計算；重抽數較多時可分批交給多個程序，分批的亂數種子固定，
+因此結果與是否平行無關。
+"""
+
+import concurrent.futures
+import numpy as np
+import pandas as pd
+from backtest import BARS_PER_YEAR, FAST_SPAN, SLOW_SPAN, ema
+from stock_analyzer import crossover_masks
+
+N_RESAMPLES = 2000
+# 區塊長度（K線數），約兩週
+BLOCK_SIZE = 10
+CONFIDENCE = 0.90
+# 單批陣列的元素數上限（約 32MB 的 float64），決定每批的重抽數
+CHUNK_ELEMENTS = 4_000_000
+
+
+def block_indices(n, n_resamples, block_size=BLOCK_SIZE, rng=None):
+    """循環移動區塊的重抽位置，形狀 (重抽數, n)"""
+    rng = rng if rng is not None else np.random.default_rng()
+    block_size = max(1, min(block_size, n))
+    n_blocks = -(-n // block_size)
+    starts = rng.integers(0, n, size=(n_resamples, n_blocks))
+    index = (starts[:, :, None] + np.arange(block_size)) % n
+    return index.reshape(n_resamples, -1)[:, :n]
+
+
+def mean_profit_potential(close, high, golden):
+    """
+    沿最後一軸計算各黃金交叉之後最高價相對交叉收盤價的平均漲幅（%），
+    與 StockAnalyzer.calculate_profit_potential 的平均值相同；沒有可計算的交叉時為 NaN。
+    """
+    future_max = np.full(np.shape(high), np.nan)
+    future_max[..., :-1] = np.maximum.accumulate(high[..., ::-1], axis=-1)[..., ::-1][..., 1:]
+    valid = golden & np.isfinite(future_max)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        total = np.where(valid, (future_max / close - 1) * 100, 0).sum(axis=-1)
+        count = valid.sum(axis=-1)
+        return np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+
+def _profit_chunk(log_returns, log_high, first_close, first_high, block_size, fast, slow, n_resamples, seed):
+    """單批重抽的平均利潤空間"""
+    rng = np.random.default_rng(seed)
+    index = block_indices(len(log_returns), n_resamples, block_size, rng)
+    close = first_close * np.exp(np.concatenate(
+        [np.zeros((n_resamples, 1)), np.cumsum(log_returns[index], axis=1)], axis=1))
+    high = close * np.exp(np.concatenate([np.full((n_resamples, 1), np.log(first_high / first_close)),
+                                          log_high[index]], axis=1))
+    golden, _ = crossover_masks(ema(close, fast), ema(close, slow))
+    return mean_profit_potential(close, high, golden)
+
+
+def _backtest_chunk(log_growth, block_size, n_resamples, seed):
+    """單批重抽的總對數成長、報酬和與報酬平方和，各為 (股票數, 重抽數)"""
+    n = log_growth.shape[1]
+    rng = np.random.default_rng(seed)
+    block_size = max(1, min(block_size, n))
+    n_blocks = -(-n // block_size)
+    starts = rng.integers(0, n, size=(n_resamples, n_blocks))
+    # 每個區塊的和 = 循環延伸後累積和的差；最後一個區塊截短為剩餘長度
+    lengths = np.full(n_blocks, block_size)
+    lengths[-1] = n - block_size * (n_blocks - 1)
+    returns = np.expm1(log_growth)
+    totals = []
+    for values in (log_growth, returns, returns ** 2):
+        extended = np.concatenate([values, values[:, :block_size]], axis=1)
+        cumulative = np.concatenate([np.zeros((len(values), 1)), np.cumsum(extended, axis=1)], axis=1)
+        totals.append((cumulative[:, starts + lengths] - cumulative[:, starts]).sum(axis=-1))
+    return totals
+
+
+def _run_chunks(func, args, n_resamples, seed, n_jobs, elements_per_resample):
+    """將重抽切成固定種子的批次，依 n_jobs 決定在本程序或程序池中執行"""
+    chunk = max(1, CHUNK_ELEMENTS // max(1, elements_per_resample))
+    sizes = [min(chunk, n_resamples - start) for start in range(0, n_resamples, chunk)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if n_jobs is None or n_jobs <= 1 or len(sizes) == 1:
+        return [func(*args, size, chunk_seed) for size, chunk_seed in zip(sizes, seeds)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(n_jobs, len(sizes))) as executor:
+        futures = [executor.submit(func, *args, size, chunk_seed) for size, chunk_seed in zip(sizes, seeds)]
+        return [future.result() for future in futures]
+
+
+def _interval(estimate, samples, confidence):
+    samples = samples[np.isfinite(samples)]
+    alpha = (1 - confidence) / 2
+    if samples.size == 0:
+        return {'estimate': estimate, 'mean': np.nan, 'std': np.nan, 'lower': np.nan, 'upper': np.nan,
+                'confidence': confidence, 'resamples': 0}
+    lower, upper = np.quantile(samples, [alpha, 1 - alpha])
+    return {
+        'estimate': estimate,
+        'mean': float(samples.mean()),
+        'std': float(samples.std(ddof=1)) if samples.size > 1 else 0.0,
+        'lower': float(lower),
+        'upper': float(upper),
+        'confidence': confidence,
+        'resamples': int(samples.size),
+    }
+
+
+def profit_potential_ci(data, n_resamples=N_RESAMPLES, block_size=BLOCK_SIZE, confidence=CONFIDENCE,
+                        seed=0, n_jobs=1, fast=FAST_SPAN, slow=SLOW_SPAN):
+    """
+    單檔股票平均利潤空間（%）的區塊自助法信賴區間。
+    data 需含 Close 與 High；沒有黃金交叉的重抽路徑不計入分布（resamples 為有效路徑數）。
+    """
+    prices = data[['Close', 'High']].dropna()
+    close = prices['Close'].to_numpy(dtype='float64')
+    high = prices['High'].to_numpy(dtype='float64')
+    if len(close) < slow + 2:
+        return _interval(np.nan, np.array([]), confidence)
+
+    golden, _ = crossover_masks(ema(close, fast), ema(close, slow))
+    estimate = float(mean_profit_potential(close, high, golden))
+    log_returns = np.diff(np.log(close))
+    log_high = np.log(high[1:] / close[1:])
+    chunks = _run_chunks(_profit_chunk, (log_returns, log_high, close[0], high[0], block_size, fast, slow),
+                         n_resamples, seed, n_jobs, len(close))
+    return _interval(estimate, np.concatenate(chunks), confidence)
+
+
+def backtest_return_ci(result, n_resamples=N_RESAMPLES, block_size=BLOCK_SIZE, confidence=CONFIDENCE,
+                       seed=0, n_jobs=1, bars_per_year=BARS_PER_YEAR):
+    """
+    BacktestResult 各檔總報酬與夏普的區塊自助法信賴區間。
+    所有股票共用同一組重抽位置，保留股票之間的同期相關；回傳以代碼為索引的 DataFrame。
+    """
+    returns = np.nan_to_num(np.asarray(result.returns, dtype='float64'))
+    n = returns.shape[1]
+    log_growth = np.log1p(returns)
+    chunks = _run_chunks(_backtest_chunk, (log_growth, block_size), n_resamples, seed, n_jobs,
+                         len(returns) * -(-n // max(1, min(block_size, n))))
+    total_log, total, total_sq = (np.concatenate(parts, axis=1) for parts in zip(*chunks))
+
+    total_return = np.expm1(total_log)
+    mean = total / n
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.sqrt(np.maximum(total_sq / n - mean ** 2, 0) * n / max(n - 1, 1))
+        sharpe = np.where(std > 0, mean / std * np.sqrt(bars_per_year), np.nan)
+    alpha = (1 - confidence) / 2
+    with np.errstate(invalid='ignore'):
+        return_bounds = np.quantile(total_return, [alpha, 1 - alpha], axis=1)
+        sharpe_bounds = np.nanquantile(sharpe, [alpha, 1 - alpha], axis=1)
+    return pd.DataFrame({
+        'total_return': result.stats['total_return'].to_numpy(),
+        'return_lower': return_bounds[0],
+        'return_upper': return_bounds[1],
+        'prob_loss': (total_return < 0).mean(axis=1),
+        'sharpe': result.stats['sharpe'].to_numpy(),
+        'sharpe_lower': sharpe_bounds[0],
+        'sharpe_upper': sharpe_bounds[1],
+    }, index=pd.Index(result.symbols, name='symbol'))
+
+
+def print_backtest_ci(intervals, confidence=CONFIDENCE, top_n=20):
+    """打印回測報酬的信賴區間（依報酬下界排序）"""
+    table = intervals.sort_values('return_lower', ascending=False)
+    print(f"\n=== 回測報酬 {confidence * 100:.0f}% 信賴區間（區塊自助法）===")
+    print(f"{'股票代碼':<12} {'總報酬%':>9} {'下界%':>9} {'上界%':>9} {'虧損機率%':>10} {'夏普下界':>8}")
+    print("-" * 64)
+    for symbol, row in table.head(top_n).iterrows():
+        sharpe_lower = f"{row['sharpe_lower']:>8.2f}" if pd.notna(row['sharpe_lower']) else f"{'N/A':>8}"
+        print(f"{symbol:<12} {row['total_return'] * 100:>9.2f} {row['return_lower'] * 100:>9.2f} "
+              f"{row['return_upper'] * 100:>9.2f} {row['prob_loss'] * 100:>10.1f} {sharpe_lower}")
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+圖表降採樣工具
+長期間或日內K線在送到瀏覽器前依畫面解析度降採樣：
+K線以區間 min-max 聚合（保留每段的最高/最低點），折線以 LTTB 演算法保留形狀。
+"""
+
+import numpy as np
+import pandas as pd
+
+# 預設最多送出的K線/折線點數（約等於圖表寬度的像素數）
+DEFAULT_MAX_POINTS = 1500
+
+# 超過此點數時改用 WebGL 折線
+WEBGL_THRESHOLD = 1000
+
+
+def bucket_starts(length, max_points):
+    """將 length 筆資料平均分成不超過 max_points 個連續區段，回傳各區段起點"""
+    if length <= max_points:
+        return np.arange(length)
+    return np.unique(np.linspace(0, length, max_points, endpoint=False).astype(np.int64))
+
+
+def aggregate_ohlc(data, max_points=DEFAULT_MAX_POINTS):
+    """
+    以 min-max 方式將 OHLCV 聚合成最多 max_points 根K線：
+    開盤取區段第一筆、收盤與指標取最後一筆、最高/最低取極值、成交量加總。
+    回傳 (聚合後 DataFrame, 區段起點)。
+    """
+    starts = bucket_starts(len(data), max_points)
+    if len(starts) == len(data):
+        return data, starts
+
+    ends = np.append(starts[1:], len(data)) - 1
+    result = data.iloc[ends].copy()
+    result.index = data.index[starts]
+    result['Open'] = data['Open'].to_numpy()[starts]
+    result['High'] = np.maximum.reduceat(data['High'].to_numpy(), starts)
+    result['Low'] = np.minimum.reduceat(data['Low'].to_numpy(), starts)
+    if 'Volume' in data.columns:
+        result['Volume'] = np.add.reduceat(data['Volume'].to_numpy(), starts)
+    return result, starts
+
+
+def lttb_indices(y, max_points=DEFAULT_MAX_POINTS):
+    """
+    Largest-Triangle-Three-Buckets 降採樣，回傳保留點的索引（x 以等距位置計算）。
+    每個區段挑選與前一保留點、下一區段平均點構成最大三角形面積的點。
+    """
+    y = np.asarray(y, dtype='float64')
+    n = len(y)
+    if n <= max_points or max_points < 3:
+        return np.arange(n)
+
+    # 缺值以前後值補齊，避免 NaN 影響面積計算
+    filled = pd.Series(y).ffill().bfill().to_numpy()
+    edges = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    # 預先計算各區段平均點
+    next_avg_x = np.empty(max_points - 2)
+    next_avg_y = np.empty(max_points - 2)
+    for i in range(max_points - 2):
+        lo = edges[i + 1]
+        hi = edges[i + 2] if i + 2 < len(edges) else n
+        next_avg_x[i] = (lo + hi - 1) / 2
+        next_avg_y[i] = filled[lo:hi].mean()
+
+    a = 0
+    for i in range(max_points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        xs = np.arange(lo, hi)
+        areas = np.abs(
+            (a - next_avg_x[i]) * (filled[lo:hi] - filled[a])
+            - (a - xs) * (next_avg_y[i] - filled[a])
+        )
+        a = lo + int(np.argmax(areas))
+        selected[i + 1] = a
+    return selected
+
+
+def axis_labels(index):
+    """以向量化方式產生類別軸標籤，日內資料保留時間"""
+    if len(index) > 1 and (index[1:] - index[:-1]).min() < pd.Timedelta(days=1):
+        return index.strftime('%Y-%m-%d %H:%M')
+    return index.strftime('%Y-%m-%d')
+
+
+def line_trace_class(points):
+    """依點數選擇 Scatter 或 WebGL 的 Scattergl"""
+    import plotly.graph_objects as go
+    return go.Scattergl if points > WEBGL_THRESHOLD else go.Scatter
@@ -57,7 +57,6 @@ def verify_installation():
         'yfinance',
         'pandas',
         'numpy',
-        'matplotlib',
         'plotly',
         'streamlit',
         'ta',
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+即時逐筆資料緩衝與增量聚合
+Shioaji 回呼寫入緩衝區，畫面端以游標只讀取上次之後的新資料，
+每次更新的成本只與新增筆數有關，不隨當日累積筆數成長。
+"""
+
+import itertools
+import threading
+from collections import deque
+import numpy as np
+import pandas as pd
+from metrics import inc, timed
+
+TICK_TYPE_LABELS = {1: '買盤', -1: '賣盤'}
+
+
+class LiveTickBuffer:
+    """執行緒安全的逐筆資料緩衝區，並以增量方式維護當日統計"""
+
+    def __init__(self, maxlen=20000):
+        self._ticks = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.latest = None
+        self.high = None
+        self.low = None
+        self.total_volume = 0
+
+    @timed('tick_handler_seconds', handler='live')
+    def on_tick(self, exchange, tick):
+        """Shioaji set_on_tick_stk_v1_callback 回呼"""
+        ts = getattr(tick, 'datetime', None) or pd.to_datetime(tick.ts, unit='ns')
+        self.append(pd.Timestamp(ts), float(tick.close), int(tick.volume), int(tick.tick_type))
+
+    def append(self, ts, price, volume, tick_type=0):
+        with self._lock:
+            self._ticks.append((ts, price, volume, tick_type))
+            self.count += 1
+            self.latest = price
+            self.high = price if self.high is None else max(self.high, price)
+            self.low = price if self.low is None else min(self.low, price)
+            self.total_volume += volume
+        inc('ticks_total', source='live')
+
+    def extend(self, frame):
+        """寫入 GatewayTickStream.poll() 回傳的逐筆資料（ts, close, volume, tick_type 欄位）"""
+        for row in frame.itertuples(index=False):
+            self.append(pd.Timestamp(row.ts), float(row.close), int(row.volume), int(row.tick_type))
+
+    def since(self, cursor):
+        """取得游標之後的新逐筆資料，回傳 (DataFrame, 新游標)"""
+        with self._lock:
+            count = self.count
+            new_count = min(count - cursor, len(self._ticks))
+            rows = list(itertools.islice(reversed(self._ticks), new_count))[::-1]
+
+        if not rows:
+            return pd.DataFrame(columns=['價格', '成交量', '買賣別'], index=pd.DatetimeIndex([], name='時間')), count
+
+        ts, price, volume, tick_type = zip(*rows)
+        df = pd.DataFrame({
+            '價格': np.asarray(price, dtype='float64'),
+            '成交量': np.asarray(volume, dtype='int64'),
+            '買賣別': pd.Series(tick_type).map(TICK_TYPE_LABELS).fillna('中性').to_numpy(),
+        }, index=pd.DatetimeIndex(ts, name='時間'))
+        return df, count
+
+    def clear(self):
+        with self._lock:
+            self._ticks.clear()
+            self.count = 0
+            self.latest = self.high = self.low = None
+            self.total_volume = 0
+
+
+class MinuteBarAggregator:
+    """將逐筆資料增量聚合為 1 分鐘 K 線，只回傳新完成的 K 線"""
+
+    def __init__(self, rule='1min'):
+        self.rule = rule
+        self.current = None   # 尚未完成的 K 線 (時間, 開, 高, 低, 收, 量)
+
+    def update(self, ticks):
+        """加入新逐筆資料，回傳本次新完成的 K 線 DataFrame"""
+        if ticks.empty:
+            return pd.DataFrame(columns=['Open', 'High', 'Low', 'Close', '成交量'])
+
+        bars = ticks.resample(self.rule).agg({'價格': ['first', 'max', 'min', 'last'], '成交量': 'sum'}).dropna()
+        bars.columns = ['Open', 'High', 'Low', 'Close', '成交量']
+
+        # 與上一批尚未完成的 K 線合併
+        if self.current is not None and len(bars) and bars.index[0] == self.current.name:
+            first = bars.iloc[0]
+            bars.iloc[0] = [
+                self.current['Open'], max(self.current['High'], first['High']),
+                min(self.current['Low'], first['Low']), first['Close'],
+                self.current['成交量'] + first['成交量'],
+            ]
+        elif self.current is not None:
+            bars = pd.concat([self.current.to_frame().T, bars])
+
+        self.current = bars.iloc[-1]
+        return bars.iloc[:-1]
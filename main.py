@@ -12,7 +12,9 @@
 from stock_analyzer import StockAnalyzer
 from stock_screener import StockScreener
 import argparse
+import os
 import sys
+import metrics
 
 def analyze_single_stock(symbol, period="6mo"):
     """分析單一股票"""
@@ -40,14 +42,17 @@ def analyze_single_stock(symbol, period="6mo"):
     
     return analyzer
 
-def screen_stocks(min_score=60, custom_stocks=None):
-    """篩選股票"""
+def screen_stocks(min_score=60, custom_stocks=None, confidence=None, rank_by='score', store=None):
+    """篩選股票（設定 confidence 時利潤空間以自助法信賴區間下界計分）"""
     print("\n=== 開始股票篩選 ===")
     
-    screener = StockScreener()
+    if rank_by == 'profit_lower' and not confidence:
+        from bootstrap import CONFIDENCE
+        confidence = CONFIDENCE
+    screener = StockScreener(confidence=confidence, store=store)
     screener.load_stock_list(custom_stocks)
     
-    results = screener.screen_stocks(min_score=min_score)
+    results = screener.screen_stocks(min_score=min_score, rank_by=rank_by)
     screener.print_screening_results()
     
     if results:
@@ -58,6 +63,87 @@ def screen_stocks(min_score=60, custom_stocks=None):
     
     return results
 
+def backtest_stocks(symbols, period="2y", confidence=None):
+    """以黃藍線交叉策略回測一或多檔股票（設定 confidence 時另列報酬的自助法信賴區間）"""
+    from backtest import backtest_frames, print_backtest
+    from batch_analysis import analyze_batch
+    
+    results = analyze_batch(symbols, period=period)
+    if not results:
+        print("錯誤：無法獲取任何股票的數據")
+        return None
+    result = backtest_frames({symbol: r['analyzer'].data for symbol, r in results.items()})
+    print_backtest(result)
+    if confidence:
+        from bootstrap import backtest_return_ci, print_backtest_ci
+        print_backtest_ci(backtest_return_ci(result, confidence=confidence), confidence)
+    return result
+
+def walk_forward_stocks(symbols, period="5y", strategy="uptrend", workers=None, checkpoint=None):
+    """以滾動前進方式最佳化策略參數並報告樣本外績效"""
+    from batch_analysis import analyze_batch
+    from walk_forward import WalkForwardOptimizer, panel_arrays, print_walk_forward
+    
+    results = analyze_batch(symbols, period=period)
+    if not results:
+        print("錯誤：無法獲取任何股票的數據")
+        return None
+    arrays, index, _ = panel_arrays({symbol: r['analyzer'].data for symbol, r in results.items()})
+    optimizer = WalkForwardOptimizer(arrays, strategy, max_workers=workers,
+                                     checkpoint=checkpoint or f"walk_forward_{strategy}.json", index=index)
+    try:
+        report = optimizer.run()
+    except ValueError as e:
+        print(f"錯誤：{e}，請以 --period 指定更長的期間")
+        return None
+    print_walk_forward(report)
+    return report
+
+def load_symbols_file(path):
+    """讀取股票清單檔（每行一個代碼，# 開頭為註解）"""
+    with open(path, encoding='utf-8') as f:
+        return [line.split('#')[0].strip() for line in f if line.split('#')[0].strip()]
+
+def resolve_symbols(args):
+    """依 --universe / --symbols-file / --stocks 取得股票清單，失敗時回傳 None"""
+    if args.universe:
+        # 使用程序內共用的 Shioaji 連線（優先經由本機閘道），後續數據獲取不需再次登入
+        from stock_data_fetcher import shared_fetcher
+        client = shared_fetcher().shioaji_client
+        if client is None:
+            print("錯誤：無法連接 Shioaji，無法取得完整股票清單")
+            return None
+        return client.get_stock_universe()
+    elif args.symbols_file:
+        return load_symbols_file(args.symbols_file)
+    elif args.stocks:
+        return args.stocks
+    print("錯誤：請以 --symbols-file、--stocks 或 --universe 指定股票")
+    return None
+
+def open_market_store(args):
+    """--from-store 時以唯讀模式開啟市場儲存區"""
+    if not args.from_store:
+        return None
+    from market_store import open_store
+    store = open_store(args.store_dir)
+    if store is None:
+        print(f"⚠️ 找不到市場儲存區 {args.store_dir}，改為線上獲取數據（可先執行 --update-store）")
+    return store
+
+def batch_analyze(args):
+    """非互動批量分析，輸出 JSON Lines 或 Parquet"""
+    from batch_analysis import run_batch
+    
+    symbols = resolve_symbols(args)
+    if not symbols:
+        return 1
+    
+    output = args.output or f"batch_results.{args.format}"
+    run_batch(symbols, output, fmt=args.format, period=args.period,
+              interval=args.interval, max_workers=args.workers, store=open_market_store(args))
+    return 0
+
 def interactive_mode():
     """互動模式"""
     print("=== 股票技術分析系統 ===")
@@ -133,15 +219,114 @@ def main():
                        help='啟動網頁界面')
     parser.add_argument('--interactive', '-i', action='store_true', 
                        help='互動模式')
+    parser.add_argument('--gateway', action='store_true', 
+                       help='啟動 Shioaji 本機閘道（多個程序共用同一個登入）')
+    parser.add_argument('--batch', action='store_true', 
+                       help='非互動批量分析並輸出機器可讀結果')
+    parser.add_argument('--symbols-file', 
+                       help='批量分析的股票清單檔（每行一個代碼）')
+    parser.add_argument('--universe', action='store_true', 
+                       help='批量分析 Shioaji 合約表中的所有上市櫃股票')
+    parser.add_argument('--interval', default='1d', 
+                       help='批量分析的K線週期')
+    parser.add_argument('--workers', type=int, default=8, 
+                       help='批量分析的並行數')
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], default='jsonl', 
+                       help='批量分析輸出格式')
+    parser.add_argument('--output', '-o', 
+                       help='批量分析輸出檔案路徑')
+    parser.add_argument('--backtest', action='store_true', 
+                       help='以黃藍線交叉策略回測 --symbol / --stocks / --symbols-file 指定的股票')
+    parser.add_argument('--update-store', action='store_true', 
+                       help='下載並就地附加 --stocks / --symbols-file / --universe 的日K到市場儲存區（每日收盤後執行）')
+    parser.add_argument('--from-store', action='store_true', 
+                       help='篩選與批量分析直接讀取市場儲存區的日K')
+    parser.add_argument('--store-dir', default=os.getenv('MARKET_STORE', 'data/market'), 
+                       help='市場儲存區目錄')
+    parser.add_argument('--confidence', type=float, 
+                       help='以區塊自助法計算信賴區間（例: 0.9）：篩選時利潤空間以下界計分，回測時列出報酬區間')
+    parser.add_argument('--rank-by', choices=['score', 'profit_lower'], default='score', 
+                       help='篩選結果排序依據（profit_lower: 利潤空間信賴區間下界，未指定 --confidence 時使用 90%%）')
+    parser.add_argument('--walk-forward', nargs='?', const='uptrend', choices=['uptrend', 'score'], 
+                       help='滾動前進最佳化策略參數（uptrend: 緩坡爬升門檻, score: 評分權重），建議搭配 -p 5y')
+    parser.add_argument('--checkpoint', 
+                       help='滾動前進最佳化的檢查點檔（預設 walk_forward_<策略>.json，中斷後可續跑）')
+    parser.add_argument('--bench', action='store_true', 
+                       help='執行分析流程效能基準測試')
+    parser.add_argument('--bench-bars', type=int, nargs='+', 
+                       help='基準測試的單檔K線數 (預設 1000 10000 100000 1000000)')
+    parser.add_argument('--bench-symbols', type=int, nargs='+', 
+                       help='基準測試的股票數 (預設 10 100 2000)')
+    parser.add_argument('--bench-startup', action='store_true', 
+                       help='只量測模組匯入時間，重量級依賴在匯入時被載入則回傳錯誤碼')
+    parser.add_argument('--bench-compare', 
+                       help='與指定的基準測試結果 JSON 比較')
+    parser.add_argument('--quiet', '-q', action='store_true', 
+                       help='靜音模式：不輸出數據獲取與分析的診斷訊息')
+    parser.add_argument('--metrics-port', type=int, 
+                       help='在指定埠提供 Prometheus 指標端點 (/metrics)')
+    parser.add_argument('--metrics-dump', 
+                       help='定期將指標快照寫入指定的 JSON 檔')
+    parser.add_argument('--metrics-interval', type=int, default=60, 
+                       help='指標 JSON 寫出間隔秒數')
     
     args = parser.parse_args()
     
+    if args.quiet:
+        metrics.set_silent(True)
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
+    dump_stop = None
+    if args.metrics_dump:
+        dump_stop = metrics.start_json_dump(args.metrics_dump, args.metrics_interval)
+    
     try:
         if args.web:
             print("正在啟動網頁界面...")
             import subprocess
             subprocess.run(["streamlit", "run", "streamlit_app.py"])
             
+        elif args.gateway:
+            from shioaji_gateway import ShioajiGateway
+            ShioajiGateway().start()
+            
+        elif args.batch:
+            return batch_analyze(args)
+            
+        elif args.update_store:
+            from market_store import update_store
+            symbols = resolve_symbols(args)
+            if not symbols:
+                return 1
+            update_store(symbols, args.store_dir, max_workers=args.workers)
+            
+        elif args.backtest:
+            symbols = ([args.symbol] if args.symbol else args.stocks
+                       or (load_symbols_file(args.symbols_file) if args.symbols_file else None))
+            if not symbols:
+                print("錯誤：請以 --symbol、--stocks 或 --symbols-file 指定股票")
+                return 1
+            backtest_stocks(symbols, args.period, args.confidence)
+            
+        elif args.walk_forward:
+            symbols = args.stocks or (load_symbols_file(args.symbols_file) if args.symbols_file else None)
+            if not symbols:
+                print("錯誤：請以 --stocks 或 --symbols-file 指定股票")
+                return 1
+            walk_forward_stocks(symbols, args.period, args.walk_forward, args.workers, args.checkpoint)
+            
+        elif args.bench_startup:
+            from benchmark import check_startup
+            _, leaks = check_startup()
+            return 1 if leaks else 0
+            
+        elif args.bench:
+            from benchmark import run_benchmarks, compare
+            output = args.output or "benchmark_results.json"
+            run_benchmarks(args.bench_bars, args.bench_symbols, output)
+            if args.bench_compare:
+                compare(output, args.bench_compare)
+            
         elif args.interactive:
             interactive_mode()
             
@@ -149,7 +334,7 @@ def main():
             analyze_single_stock(args.symbol, args.period)
             
         elif args.screen:
-            screen_stocks(args.min_score, args.stocks)
+            screen_stocks(args.min_score, args.stocks, args.confidence, args.rank_by, open_market_store(args))
             
         else:
             # 預設進入互動模式
@@ -160,6 +345,17 @@ def main():
     except Exception as e:
         print(f"程式執行錯誤: {e}")
         return 1
+    finally:
+        # 只有實際用過數據獲取器時才需要登出共用的 Shioaji 連線
+        if 'stock_data_fetcher' in sys.modules:
+            sys.modules['stock_data_fetcher'].close_shared_shioaji()
+        # 結束前寫出最後一次指標快照（執行時間短於寫出間隔時也會有檔案）
+        if dump_stop is not None:
+            dump_stop.set()
+            try:
+                metrics.write_json(args.metrics_dump)
+            except OSError as e:
+                metrics.log(f"⚠️ 指標寫出失敗: {e}", level="warning")
     
     return 0
 
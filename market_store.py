@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+全市場日K矩陣儲存
+每個欄位一個 (股票數 × 交易日) 的 .npy 檔，搭配日期陣列與 meta.json（股票代碼與有效天數），
+讀取端以記憶體映射開啟，任何程序都能直接切片而不需解析或複製；
+寫入端（每日收盤後的更新工作）預留容量並就地附加新的交易日，容量不足時才整批擴充。
+
+一致性：寫入端先寫入數據並 flush，最後才以原子取代更新 meta.json 的有效天數，
+讀取端只看得到完整寫入的交易日。同一時間只允許一個寫入端。
+"""
+
+import concurrent.futures
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+from metrics import inc, log, timed
+from trading_calendar import calendar_for
+
+STORE_DIR = os.getenv('MARKET_STORE', 'data/market')
+
+# 欄位與儲存型別（與 normalize_ohlcv 相同）；價格缺值（尚未上市、停牌）為 NaN，成交量缺值為 0。
+# 既有儲存區沿用建立時的型別（由 .npy 檔頭讀取）
+FIELDS = {
+    'open': 'float32',
+    'high': 'float32',
+    'low': 'float32',
+    'close': 'float32',
+    'volume': 'int64',
+}
+FRAME_COLUMNS = {'open': 'Open', 'high': 'High', 'low': 'Low', 'close': 'Close', 'volume': 'Volume'}
+
+# 預留容量：交易日約 4 年、股票數依初始清單加 25%，不足時加倍
+INITIAL_DAY_CAPACITY = 1024
+SYMBOL_HEADROOM = 1.25
+# 新加入股票第一次下載的歷史長度
+HISTORY_PERIOD = "5y"
+# 日K分析使用的暖機交易日數，與 stock_data_fetcher.DAILY_WARMUP_SESSIONS 相同
+WARMUP_SESSIONS = 60
+
+
+def _to_days(index):
+    """DatetimeIndex → 以日為單位的 datetime64（去除時區）"""
+    index = pd.DatetimeIndex(index)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    return index.normalize().to_numpy().astype('datetime64[D]')
+
+
+class MarketStore:
+    """記憶體映射的全市場日K儲存"""
+
+    def __init__(self, root=STORE_DIR, writable=False):
+        self.root = root
+        self.writable = writable
+        self._generation = None
+        self._load()
+
+    @staticmethod
+    def exists(root=STORE_DIR):
+        return os.path.exists(os.path.join(root, 'meta.json'))
+
+    @classmethod
+    def create(cls, root=STORE_DIR, symbols=(), day_capacity=INITIAL_DAY_CAPACITY):
+        """建立空的儲存區並回傳可寫入的實例"""
+        os.makedirs(root, exist_ok=True)
+        symbols = list(dict.fromkeys(symbols))
+        symbol_capacity = max(16, int(len(symbols) * SYMBOL_HEADROOM))
+        cls._allocate(root, 0, symbol_capacity, day_capacity)
+        cls._write_meta(root, {
+            'symbols': symbols,
+            'n_days': 0,
+            'symbol_capacity': symbol_capacity,
+            'day_capacity': day_capacity,
+            'generation': 0,
+        })
+        return cls(root, writable=True)
+
+    @staticmethod
+    def _path(root, name, generation):
+        return os.path.join(root, f"{name}.{generation}.npy")
+
+    @classmethod
+    def _allocate(cls, root, generation, symbol_capacity, day_capacity):
+        """建立指定容量的欄位檔，價格預填 NaN"""
+        np.lib.format.open_memmap(cls._path(root, 'dates', generation), mode='w+',
+                                  dtype='datetime64[D]', shape=(day_capacity,))
+        for field, dtype in FIELDS.items():
+            array = np.lib.format.open_memmap(cls._path(root, field, generation), mode='w+',
+                                              dtype=dtype, shape=(symbol_capacity, day_capacity))
+            if np.issubdtype(array.dtype, np.floating):
+                array[:] = np.nan
+            array.flush()
+
+    @staticmethod
+    def _write_meta(root, meta):
+        path = os.path.join(root, 'meta.json')
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _load(self):
+        with open(os.path.join(self.root, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        self.meta = meta
+        if meta['generation'] != self._generation:
+            mode = 'r+' if self.writable else 'r'
+            self._dates = np.load(self._path(self.root, 'dates', meta['generation']), mmap_mode=mode)
+            self._arrays = {
+                field: np.load(self._path(self.root, field, meta['generation']), mmap_mode=mode)
+                for field in FIELDS
+            }
+            self._generation = meta['generation']
+        self.symbols = list(meta['symbols'])
+        self.n_days = meta['n_days']
+        self._rows = {symbol: i for i, symbol in enumerate(self.symbols)}
+
+    def refresh(self):
+        """重新讀取 meta.json，取得寫入端新增的交易日與股票"""
+        self._load()
+        return self
+
+    def __contains__(self, symbol):
+        return symbol in self._rows
+
+    def __len__(self):
+        return len(self.symbols)
+
+    @property
+    def dates(self):
+        return self._dates[:self.n_days]
+
+    @property
+    def index(self):
+        return pd.DatetimeIndex(self.dates.astype('datetime64[ns]'), name='Date')
+
+    @property
+    def last_date(self):
+        return pd.Timestamp(self._dates[self.n_days - 1]) if self.n_days else None
+
+    def symbol_last_date(self, symbol):
+        """單檔股票最後一個有收盤價的交易日（下載失敗或停牌的股票可能早於 last_date），沒有數據時回傳 None"""
+        row = self._rows.get(symbol)
+        if row is None:
+            return None
+        valid = np.flatnonzero(~np.isnan(self._arrays['close'][row, :self.n_days]))
+        return pd.Timestamp(self._dates[valid[-1]]) if valid.size else None
+
+    def last_dates(self):
+        """{股票代碼: 最後一個有收盤價的交易日或 None}（向量化）"""
+        if self.n_days == 0:
+            return dict.fromkeys(self.symbols)
+        valid = ~np.isnan(self._arrays['close'][:len(self.symbols), :self.n_days])
+        has_data = valid.any(axis=1)
+        last = self.n_days - 1 - np.argmax(valid[:, ::-1], axis=1)
+        return {symbol: pd.Timestamp(self._dates[last[i]]) if has_data[i] else None
+                for i, symbol in enumerate(self.symbols)}
+
+    def _day_slice(self, start=None, end=None):
+        dates = self.dates
+        lo = 0 if start is None else int(np.searchsorted(dates, np.datetime64(pd.Timestamp(start).date(), 'D')))
+        hi = self.n_days if end is None else int(
+            np.searchsorted(dates, np.datetime64(pd.Timestamp(end).date(), 'D'), side='right'))
+        return slice(lo, hi)
+
+    def matrix(self, field, symbols=None, start=None, end=None):
+        """
+        取得欄位的 (股票 × 交易日) 陣列與對應日期。
+        symbols 為 None 時回傳記憶體映射的切片（不複製）；指定股票時依序取出（會複製）。
+        """
+        days = self._day_slice(start, end)
+        array = self._arrays[field]
+        if symbols is None:
+            return array[:len(self.symbols), days], self.index[days]
+        rows = [self._rows[symbol] for symbol in symbols]
+        return array[rows, days], self.index[days]
+
+    def panel(self, symbols=None, start=None, end=None):
+        """所有欄位的陣列 {欄位: (股票 × 交易日)}、日期與股票清單"""
+        arrays = {field: self.matrix(field, symbols, start, end)[0] for field in FIELDS}
+        return arrays, self.index[self._day_slice(start, end)], list(symbols or self.symbols)
+
+    def frame(self, symbol, start=None, end=None):
+        """單檔股票的 OHLCV DataFrame（去除未上市或停牌的空白日），不存在時回傳 None"""
+        row = self._rows.get(symbol)
+        if row is None:
+            return None
+        days = self._day_slice(start, end)
+        data = pd.DataFrame({
+            column: self._arrays[field][row, days] for field, column in FRAME_COLUMNS.items()
+        }, index=self.index[days])
+        return data[data['Close'].notna()]
+
+    # --- 寫入端 ---
+    def _require_writable(self):
+        if not self.writable:
+            raise PermissionError("市場儲存區以唯讀模式開啟")
+
+    def _grow(self, symbol_capacity, day_capacity):
+        """以新世代的檔案擴充容量；已開啟舊檔的讀取端不受影響，refresh() 後改用新檔"""
+        old_generation = self._generation
+        generation = old_generation + 1
+        self._allocate(self.root, generation, symbol_capacity, day_capacity)
+        dates = np.load(self._path(self.root, 'dates', generation), mmap_mode='r+')
+        dates[:self.n_days] = self.dates
+        dates.flush()
+        for field in FIELDS:
+            array = np.load(self._path(self.root, field, generation), mmap_mode='r+')
+            array[:len(self.symbols), :self.n_days] = self._arrays[field][:len(self.symbols), :self.n_days]
+            array.flush()
+        self._write_meta(self.root, {**self.meta, 'symbol_capacity': symbol_capacity,
+                                     'day_capacity': day_capacity, 'generation': generation})
+        self._load()
+        for name in ('dates',) + tuple(FIELDS):
+            try:
+                os.remove(self._path(self.root, name, old_generation))
+            except OSError:
+                pass
+        log(f"📦 市場儲存區擴充為 {symbol_capacity} 檔 × {day_capacity} 日")
+
+    @timed('market_store_write_seconds')
+    def write_frames(self, frames):
+        """
+        寫入 {股票代碼: OHLCV DataFrame}：新股票加入清單，晚於最後交易日的日期就地附加，
+        已存在的日期以新值覆寫（例如修正當日數據）。早於最後交易日但不在日曆中的日期無法插入，會被略過。
+        回傳新增的交易日數。
+        """
+        self._require_writable()
+        frames = {symbol: data for symbol, data in frames.items() if data is not None and not data.empty}
+        if not frames:
+            return 0
+
+        new_symbols = [symbol for symbol in frames if symbol not in self._rows]
+        last = self._dates[self.n_days - 1] if self.n_days else None
+        new_dates = np.unique(np.concatenate([_to_days(data.index) for data in frames.values()]))
+        if last is not None:
+            new_dates = new_dates[new_dates > last]
+
+        n_symbols = len(self.symbols) + len(new_symbols)
+        n_days = self.n_days + len(new_dates)
+        symbol_capacity, day_capacity = self.meta['symbol_capacity'], self.meta['day_capacity']
+        if n_symbols > symbol_capacity or n_days > day_capacity:
+            while symbol_capacity < n_symbols:
+                symbol_capacity *= 2
+            while day_capacity < n_days:
+                day_capacity *= 2
+            self._grow(symbol_capacity, day_capacity)
+
+        symbols = self.symbols + new_symbols
+        rows = {symbol: i for i, symbol in enumerate(symbols)}
+        self._dates[self.n_days:n_days] = new_dates
+        dates = self._dates[:n_days]
+
+        skipped = 0
+        for symbol, data in frames.items():
+            days = _to_days(data.index)
+            position = np.searchsorted(dates, days)
+            found = (position < n_days) & (dates[np.minimum(position, n_days - 1)] == days)
+            skipped += int((~found).sum())
+            row, columns = rows[symbol], position[found]
+            for field, column in FRAME_COLUMNS.items():
+                if column in data.columns:
+                    values = data[column].to_numpy()[found]
+                    if field == 'volume':
+                        values = np.nan_to_num(values).astype(FIELDS[field])
+                    self._arrays[field][row, columns] = values
+
+        self._dates.flush()
+        for array in self._arrays.values():
+            array.flush()
+        self.meta = {**self.meta, 'symbols': symbols, 'n_days': n_days}
+        self._write_meta(self.root, self.meta)
+        self._load()
+
+        if skipped:
+            log(f"⚠️ {skipped} 筆早於儲存區日曆且不在日曆中的K線未寫入", level="warning")
+        inc('market_store_days_total', len(new_dates))
+        return len(new_dates)
+
+
+def open_store(root=STORE_DIR):
+    """以唯讀模式開啟儲存區，不存在時回傳 None"""
+    return MarketStore(root) if MarketStore.exists(root) else None
+
+
+def _fetch_period(last_date, calendar, now=None):
+    """
+    涵蓋該股票最後交易日以來缺口的最短 yfinance 期間（last_date 為該股票自己的最後交易日）；
+    之後沒有已收盤的交易日（週末、假日、盤中）時回傳 None，不需下載。
+    """
+    if last_date is None:
+        return HISTORY_PERIOD
+    now = calendar.localize(now) if now is not None else calendar.now()
+    if calendar.session_count(last_date, calendar.last_close(now)) == 0:
+        return None
+    return calendar.covering_period(calendar.next_session(last_date, inclusive=False), now)
+
+
+def _completed_sessions(data, calendar, now=None):
+    """去除尚未收盤的交易日（例如美股盤中執行時的當日K線），避免寫入後被視為已完成"""
+    if data is None or data.empty:
+        return data
+    last_close = calendar.last_close(now)
+    return data[_to_days(data.index) <= np.datetime64(last_close.date(), 'D')]
+
+
+def update_store(symbols, root=STORE_DIR, max_workers=8, history_period=HISTORY_PERIOD):
+    """
+    每日更新工作：已在儲存區的股票只下載缺口期間，新股票下載 history_period 的歷史，
+    下載完成後一次寫入。只使用真實數據源，不會寫入示範數據。回傳執行摘要。
+    """
+    from stock_data_fetcher import normalize_ohlcv, shared_fetcher
+
+    store = MarketStore(root, writable=True) if MarketStore.exists(root) else MarketStore.create(root, symbols)
+    symbols = list(dict.fromkeys(symbols))
+    fetcher = shared_fetcher()
+    log(f"🗄️ 更新市場儲存區 {root}: {len(symbols)} 檔，最後交易日 "
+        f"{store.last_date.strftime('%Y-%m-%d') if store.last_date is not None else '無'}")
+
+    # 依各股票自己的最後交易日與交易所日曆決定缺口期間（前一次下載失敗的股票會補抓），沒有缺漏的股票不送出請求
+    last_dates = store.last_dates()
+    periods = {symbol: history_period if last_dates.get(symbol) is None
+               else _fetch_period(last_dates[symbol], calendar_for(symbol))
+               for symbol in symbols}
+    pending = [symbol for symbol in symbols if periods[symbol] is not None]
+
+    def fetch(symbol):
+        data = fetcher.fetch_data_yfinance(symbol, periods[symbol], "1d", warmup=False)
+        return normalize_ohlcv(_completed_sessions(data, calendar_for(symbol)))
+
+    frames, failed = {}, []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_symbol = {executor.submit(fetch, symbol): symbol for symbol in pending}
+        for future in concurrent.futures.as_completed(future_to_symbol):
+            symbol = future_to_symbol[future]
+            try:
+                data = future.result()
+            except Exception as e:
+                log(f"⚠️ {symbol} 下載失敗: {e}", level="warning")
+                data = None
+            if data is None or data.empty:
+                failed.append(symbol)
+            else:
+                frames[symbol] = data
+
+    added = store.write_frames(frames)
+    summary = {'symbols': len(symbols), 'updated': len(frames), 'failed': len(failed),
+               'skipped': len(symbols) - len(pending),
+               'new_days': added, 'n_days': store.n_days,
+               'last_date': store.last_date.strftime('%Y-%m-%d') if store.last_date is not None else None}
+    log(f"✅ 儲存區更新完成: {summary['updated']}/{summary['symbols']} 檔（{summary['skipped']} 檔已是最新），"
+        f"新增 {added} 個交易日，"
+        f"共 {store.n_days} 日")
+    return summary
+
+
+def analyze_from_store(store, symbol, period="6mo", warmup_sessions=WARMUP_SESSIONS):
+    """
+    以儲存區的日K執行完整分析，回傳與 get_analysis 相同格式的 {'analyzer', 'signals'}；
+    指標以暖機期間計算後再裁剪回請求期間。股票不在儲存區時回傳 None。
+    """
+    from stock_analyzer import StockAnalyzer
+    from stock_data_fetcher import FetchResult
+
+    last_date = store.symbol_last_date(symbol)
+    if last_date is None:
+        return None
+    start = time.perf_counter()
+    calendar = calendar_for(symbol)
+    requested_start = calendar.period_start(period, last_date)
+    warmup_start = calendar.warmup_start(requested_start, warmup_sessions)
+    data = store.frame(symbol, start=warmup_start)
+    if data is None or data.empty:
+        return None
+    result = FetchResult(symbol, period, "1d", data, requested_start, warmup_start, last_date,
+                         'store', time.perf_counter() - start)
+
+    analyzer = StockAnalyzer()
+    analyzer.data_fetcher = None
+    if not analyzer.load(result):
+        return None
+    analyzer.analyze()
+    if analyzer.data.empty:
+        return None
+    return {'analyzer': analyzer, 'signals': analyzer.generate_trading_signals()}
+
+
+if __name__ == "__main__":
+    import sys
+    update_store(sys.argv[1:] or ['2330.TW', '2454.TW', '2317.TW'])
+    store = open_store()
+    print(f"{len(store)} 檔 × {store.n_days} 日，最後交易日 {store.last_date.strftime('%Y-%m-%d')}")
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+輕量效能量測與指標輸出
+提供計數器、量測值與延遲直方圖，包住數據獲取、技術分析、評分與逐筆處理各階段；
+診斷訊息改經 log() 輸出，可切換為靜音模式（環境變數 METRICS_SILENT=1 或 set_silent(True)）。
+指標可由 Prometheus 文字格式的 HTTP 端點讀取，或定期寫出 JSON 檔。
+"""
+
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 延遲直方圖的預設分桶上限（秒）
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DEFAULT_PORT = 9108
+# 所有指標名稱的前綴
+NAMESPACE = "stock"
+
+_silent = os.getenv('METRICS_SILENT', '').lower() in ('1', 'true', 'yes')
+
+
+def set_silent(silent=True):
+    """切換靜音模式：靜音時 log() 不輸出，只累計訊息數"""
+    global _silent
+    _silent = silent
+
+
+def is_silent():
+    return _silent
+
+
+def log(message, level="info"):
+    """輸出診斷訊息；warning / error 另計入 log_events_total 供彙總"""
+    if level != "info":
+        registry.inc('log_events_total', level=level)
+    if not _silent:
+        print(message)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=None):
+    items = list(key) + (list(extra) if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class _Histogram:
+    """單一標籤組合的直方圖"""
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class MetricsRegistry:
+    """執行緒安全的指標登錄表"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}     # name -> {label_key: value}
+        self._gauges = {}       # name -> {label_key: value}
+        self._histograms = {}   # name -> {label_key: _Histogram}
+        self._collectors = {}   # 前綴 -> 回傳 {名稱: 數值} 的函式
+
+    def inc(self, name, value=1, **labels):
+        """計數器加值"""
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        """設定量測值"""
+        with self._lock:
+            self._gauges.setdefault(name, {})[_label_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        """記錄一筆觀測值到直方圖"""
+        key = _label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = _Histogram(self.buckets)
+            hist.counts[index] += 1
+            hist.sum += value
+            hist.count += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """量測區塊執行秒數"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name, **labels):
+        """量測函式執行秒數的裝飾器"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start, **labels)
+            return wrapper
+        return decorator
+
+    def register_collector(self, prefix, func):
+        """登錄在輸出時才呼叫的指標來源（例如快取或配額排程器的 stats()），僅匯出數值欄位"""
+        with self._lock:
+            self._collectors[prefix] = func
+
+    def unregister_collector(self, prefix):
+        with self._lock:
+            self._collectors.pop(prefix, None)
+
+    def _collect(self):
+        """呼叫所有指標來源，回傳 {前綴: {名稱: 數值}}"""
+        with self._lock:
+            collectors = list(self._collectors.items())
+        collected = {}
+        for prefix, func in collectors:
+            try:
+                values = func() or {}
+            except Exception as e:
+                log(f"⚠️ 指標來源 {prefix} 收集失敗: {e}", level="warning")
+                continue
+            collected[prefix] = {
+                name: float(value) for name, value in values.items()
+                if isinstance(value, (int, float)) and not isinstance(value, bool)
+            }
+        return collected
+
+    def snapshot(self):
+        """目前所有指標的 JSON 可序列化快照"""
+        collected = self._collect()
+        with self._lock:
+            histograms = {}
+            for name, series in self._histograms.items():
+                histograms[name] = [
+                    {
+                        'labels': dict(key),
+                        'count': hist.count,
+                        'sum': hist.sum,
+                        'mean': hist.sum / hist.count if hist.count else 0.0,
+                        'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], hist.counts)),
+                    }
+                    for key, hist in series.items()
+                ]
+            return {
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'counters': {name: [{'labels': dict(k), 'value': v} for k, v in series.items()]
+                             for name, series in self._counters.items()},
+                'gauges': {name: [{'labels': dict(k), 'value': v} for k, v in series.items()]
+                           for name, series in self._gauges.items()},
+                'histograms': histograms,
+                'collectors': collected,
+            }
+
+    def render_prometheus(self):
+        """以 Prometheus 文字格式輸出所有指標"""
+        collected = self._collect()
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# TYPE {NAMESPACE}_{name} counter")
+                lines.extend(f"{NAMESPACE}_{name}{_format_labels(k)} {v}" for k, v in series.items())
+            for name, series in sorted(self._gauges.items()):
+                lines.append(f"# TYPE {NAMESPACE}_{name} gauge")
+                lines.extend(f"{NAMESPACE}_{name}{_format_labels(k)} {v}" for k, v in series.items())
+            for name, series in sorted(self._histograms.items()):
+                metric = f"{NAMESPACE}_{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                for key, hist in series.items():
+                    cumulative = 0
+                    for bound, count in zip(list(self.buckets) + ['+Inf'], hist.counts):
+                        cumulative += count
+                        lines.append(f"{metric}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+                    lines.append(f"{metric}_sum{_format_labels(key)} {hist.sum}")
+                    lines.append(f"{metric}_count{_format_labels(key)} {hist.count}")
+        for prefix, values in sorted(collected.items()):
+            for name, value in sorted(values.items()):
+                lines.append(f"# TYPE {NAMESPACE}_{prefix}_{name} gauge")
+                lines.append(f"{NAMESPACE}_{prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+
+# 程序內共用的登錄表
+registry = MetricsRegistry()
+inc = registry.inc
+set_gauge = registry.set_gauge
+observe = registry.observe
+timer = registry.timer
+timed = registry.timed
+register_collector = registry.register_collector
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith('/metrics.json'):
+            body = json.dumps(registry.snapshot(), ensure_ascii=False).encode('utf-8')
+            content_type = 'application/json; charset=utf-8'
+        elif self.path.startswith('/metrics'):
+            body = registry.render_prometheus().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_http_server(port=DEFAULT_PORT, host="127.0.0.1"):
+    """在背景執行緒提供 /metrics（Prometheus 文字格式）與 /metrics.json；同一程序只啟動一次"""
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True).start()
+            log(f"📈 指標端點: http://{host}:{port}/metrics")
+        return _server
+
+
+def write_json(path):
+    """將目前指標快照寫入 JSON 檔（先寫暫存檔再取代，避免讀到寫到一半的檔案）"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(registry.snapshot(), f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def start_json_dump(path="metrics.json", interval=60):
+    """在背景執行緒每 interval 秒寫出一次指標快照，回傳可用來停止的 Event"""
+    stop = threading.Event()
+
+    def loop():
+        while not stop.wait(interval):
+            try:
+                write_json(path)
+            except OSError as e:
+                log(f"⚠️ 指標寫出失敗: {e}", level="warning")
+
+    threading.Thread(target=loop, name="metrics-dump", daemon=True).start()
+    return stop
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+盤前預熱排程
+依台股交易日曆（跳過休市日），在開盤前、盤中定期與收盤後重新獲取歷史數據並預先計算
+analyze() 與 generate_trading_signals() 的結果寫入共用分析快取，
+讓使用者開盤後第一次查詢即可命中快取。
+分析快取只存在於程序記憶體中，排程必須在提供查詢的程序內執行（Streamlit 以 PREWARM_ENABLED=1 啟動）。
+"""
+
+import os
+import threading
+import concurrent.futures
+import pandas as pd
+from analysis_cache import get_analysis, is_market_open, next_market_open, DAILY_TTL
+from metrics import inc, log
+from stock_screener import DEFAULT_STOCK_LIST
+from trading_calendar import get_calendar
+
+# 開盤前多久開始預熱（分鐘）
+PREOPEN_LEAD_MINUTES = 15
+# 收盤後多久做最後一次更新（分鐘），等待收盤價定案
+POSTCLOSE_DELAY_MINUTES = 15
+
+
+def load_watchlist(path="watchlist.txt"):
+    """讀取自選股清單檔（每行一個代碼，# 開頭為註解）"""
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        return [line.split('#')[0].strip() for line in f if line.split('#')[0].strip()]
+
+
+class PrewarmScheduler:
+    """依台股交易時段預熱分析快取的背景排程器"""
+
+    def __init__(self, symbols=None, targets=(("6mo", "1d"),), session_refresh_minutes=DAILY_TTL // 60, max_workers=4):
+        """
+        symbols: 要預熱的股票；預設為自選股清單加上篩選器股票池
+        targets: (期間, 週期) 組合，需與頁面實際查詢的參數一致才會命中快取
+        session_refresh_minutes: 盤中重新整理間隔，預設與盤中快取存活時間相同
+        """
+        if symbols is None:
+            symbols = load_watchlist() + list(DEFAULT_STOCK_LIST)
+        self.symbols = list(dict.fromkeys(symbols))
+        self.targets = list(targets)
+        self.session_refresh_minutes = session_refresh_minutes
+        self.max_workers = max_workers
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_run = None
+
+    def run_once(self, ttl=None):
+        """重新計算所有股票與目標組合，回傳成功數量"""
+        jobs = [(symbol, period, interval) for symbol in self.symbols for period, interval in self.targets]
+        log(f"🔥 開始預熱 {len(self.symbols)} 檔股票，共 {len(jobs)} 個分析組合...")
+
+        succeeded = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                executor.submit(get_analysis, symbol, period, interval, None, True, ttl)
+                for symbol, period, interval in jobs
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    if future.result():
+                        succeeded += 1
+                        continue
+                    inc('prewarm_failures_total', reason='empty')
+                except Exception as e:
+                    inc('prewarm_failures_total', reason='error')
+                    log(f"⚠️ 預熱失敗: {e}", level="warning")
+
+        self.last_run = get_calendar('TWSE').now()
+        inc('prewarm_jobs_total', len(jobs))
+        log(f"✅ 預熱完成: {succeeded}/{len(jobs)}")
+        return succeeded
+
+    def next_run(self, now=None):
+        """
+        計算下一次執行時間與該次寫入快取的存活秒數：
+        盤中每 session_refresh_minutes 分鐘一次；收盤後一次；下次開盤前 PREOPEN_LEAD_MINUTES 分鐘一次。
+        """
+        calendar = get_calendar('TWSE')
+        now = calendar.localize(now) if now is not None else calendar.now()
+        refresh = pd.Timedelta(minutes=self.session_refresh_minutes)
+        _, close_time = calendar.session_bounds(now)
+        postclose = close_time + pd.Timedelta(minutes=POSTCLOSE_DELAY_MINUTES)
+        market_open = next_market_open(now)
+        preopen = market_open - pd.Timedelta(minutes=PREOPEN_LEAD_MINUTES)
+
+        if is_market_open(now):
+            run_at = min(now + refresh, postclose)
+            # 盤中結果保留到下一次重新整理之後，避免排程空窗
+            return run_at, (refresh + pd.Timedelta(minutes=1)).total_seconds()
+        if calendar.is_session(now) and close_time <= now < postclose:
+            return postclose, None
+        if now < preopen:
+            # 盤前預熱的結果保留到開盤後第一次盤中重新整理
+            return preopen, (market_open + refresh - preopen).total_seconds() + 60
+        return market_open, None
+
+    def run_forever(self):
+        """依排程持續執行（阻塞），直到 stop() 被呼叫"""
+        log(f"🕘 預熱排程啟動，{len(self.symbols)} 檔股票")
+        while not self._stop.is_set():
+            run_at, ttl = self.next_run()
+            wait = (run_at - get_calendar('TWSE').now()).total_seconds()
+            log(f"⏳ 下一次預熱: {run_at.strftime('%Y-%m-%d %H:%M')}")
+            if self._stop.wait(max(wait, 0)):
+                break
+            self.run_once(ttl=ttl)
+
+    def start(self):
+        """在背景執行緒中啟動排程"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run_forever, name="prewarm", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def start_background_prewarm(symbols=None):
+    """在目前程序（例如 Streamlit 伺服器）中啟動唯一的預熱排程"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = PrewarmScheduler(symbols)
+            _scheduler.start()
+        return _scheduler
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shioaji 流量配額排程器
+依 api.usage() 回報的剩餘流量與連線數，對 kbars / ticks / snapshots 請求排序執行：
+互動請求優先於批次請求，流量吃緊時批次工作會延後或改走備援數據源（yfinance / 本地快取）。
+"""
+
+import heapq
+import itertools
+import threading
+import time
+import concurrent.futures
+from collections import deque
+from metrics import log, register_collector
+
+# 請求優先權（數字越小越優先）
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+# Shioaji 每個帳號的同時連線上限
+CONNECTION_LIMIT = 5
+# 批次請求因流量不足延後的最長等待秒數，超過時以 TimeoutError 結束
+MAX_DELAY_SECONDS = 600
+
+
+class _Task:
+    """排程中的單一請求"""
+
+    def __init__(self, kind, func, args, kwargs, priority, fallback):
+        self.kind = kind
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.fallback = fallback
+        self.future = concurrent.futures.Future()
+        self.submitted_at = time.monotonic()
+
+
+class QuotaScheduler:
+    """依剩餘流量決定請求執行、延後或改道的排程器"""
+
+    def __init__(self, client, max_workers=2, poll_interval=30,
+                 low_watermark=0.2, critical_watermark=0.05, batch_delay=60, max_delay=MAX_DELAY_SECONDS):
+        """
+        client: 已連線的 ShioajiExtended
+        low_watermark: 剩餘流量比例低於此值時，批次請求改走備援或延後
+        critical_watermark: 剩餘流量比例低於此值時，互動請求也改走備援（若有提供）
+        max_delay: 批次請求自提交起最多延後的秒數
+        """
+        self.client = client
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.low_watermark = low_watermark
+        self.critical_watermark = critical_watermark
+        self.batch_delay = batch_delay
+        self.max_delay = max_delay
+
+        self._queue = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._workers = []
+        self._running = False
+
+        self._usage = None
+        self._usage_at = 0.0
+        self._samples = deque(maxlen=60)  # (時間, 已用流量) 用於計算燃燒速率
+        self._counters = {'executed': 0, 'rerouted': 0, 'delayed': 0, 'failed': 0}
+        self._per_kind = {}
+        register_collector('quota', self.metrics)
+
+    # --- 配額狀態 ---
+    def refresh_usage(self, force=False):
+        """向 API 查詢最新使用量（依 poll_interval 節流）"""
+        now = time.monotonic()
+        if not force and self._usage is not None and now - self._usage_at < self.poll_interval:
+            return self._usage
+
+        try:
+            status = self.client.api.usage()
+            usage = {
+                'connections': getattr(status, 'connections', 0),
+                'bytes': getattr(status, 'bytes', 0),
+                'limit_bytes': getattr(status, 'limit_bytes', 0),
+                'remaining_bytes': getattr(status, 'remaining_bytes', 0),
+            }
+        except Exception as e:
+            log(f"⚠️ 無法取得 Shioaji 使用量: {e}", level="warning")
+            return self._usage
+
+        with self._cond:
+            self._usage = usage
+            self._usage_at = now
+            self._samples.append((now, usage['bytes']))
+        return usage
+
+    def remaining_ratio(self):
+        """剩餘流量比例（無資料時視為充足）"""
+        usage = self.refresh_usage()
+        if not usage or not usage['limit_bytes']:
+            return 1.0
+        return usage['remaining_bytes'] / usage['limit_bytes']
+
+    def burn_rate(self):
+        """近期流量消耗速率（bytes/秒）"""
+        with self._cond:
+            if len(self._samples) < 2:
+                return 0.0
+            (t0, b0), (t1, b1) = self._samples[0], self._samples[-1]
+        return max(b1 - b0, 0) / (t1 - t0) if t1 > t0 else 0.0
+
+    def metrics(self):
+        """配額與排程指標"""
+        usage = self.refresh_usage() or {}
+        ratio = self.remaining_ratio()
+        rate = self.burn_rate()
+        remaining = usage.get('remaining_bytes', 0)
+        with self._cond:
+            return {
+                'connections': usage.get('connections', 0),
+                'connection_limit': CONNECTION_LIMIT,
+                'used_bytes': usage.get('bytes', 0),
+                'limit_bytes': usage.get('limit_bytes', 0),
+                'remaining_bytes': remaining,
+                'remaining_ratio': ratio,
+                'burn_rate_bytes_per_sec': rate,
+                'seconds_to_exhaustion': remaining / rate if rate > 0 else None,
+                'queue_depth': len(self._queue),
+                **self._counters,
+                'per_kind': dict(self._per_kind),
+            }
+
+    def print_metrics(self):
+        """打印配額摘要"""
+        m = self.metrics()
+        eta = f"{m['seconds_to_exhaustion'] / 60:.1f} 分鐘" if m['seconds_to_exhaustion'] else "N/A"
+        log(f"🔍 流量剩餘 {m['remaining_ratio'] * 100:.1f}% "
+              f"({m['remaining_bytes']:,}/{m['limit_bytes']:,} bytes)，"
+              f"消耗速率 {m['burn_rate_bytes_per_sec']:.0f} B/s，預估耗盡 {eta}，"
+              f"連線 {m['connections']}/{m['connection_limit']}，排隊 {m['queue_depth']} 筆")
+
+    # --- 排程 ---
+    def submit(self, kind, func, *args, priority=PRIORITY_BATCH, fallback=None, **kwargs):
+        """
+        提交一個 Shioaji 請求，回傳 concurrent.futures.Future。
+        kind: 'kbars' / 'ticks' / 'snapshots'
+        fallback: 流量不足時改用的替代函數（例如 yfinance 或本地快取），會以相同參數呼叫
+        """
+        task = _Task(kind, func, args, kwargs, priority, fallback)
+        self._push(task, time.monotonic())
+        if not self._running:
+            self.start()
+        return task.future
+
+    def _push(self, task, not_before):
+        with self._cond:
+            heapq.heappush(self._queue, (task.priority, not_before, next(self._seq), task))
+            self._cond.notify()
+
+    def start(self):
+        """啟動背景工作執行緒"""
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        for i in range(self.max_workers):
+            worker = threading.Thread(target=self._worker_loop, name=f"quota-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        """停止工作執行緒；排隊中的請求不再執行，其 Future 會被取消（等待結果的呼叫端收到 CancelledError）"""
+        with self._cond:
+            self._running = False
+            pending, self._queue = self._queue, []
+            self._cond.notify_all()
+        for entry in pending:
+            entry[3].future.cancel()
+        for worker in self._workers:
+            worker.join(timeout=5)
+        self._workers = []
+
+    def _requeue(self, task, not_before):
+        """延後重新排隊；排程器已停止時改為取消"""
+        with self._cond:
+            if self._running:
+                heapq.heappush(self._queue, (task.priority, not_before, next(self._seq), task))
+                self._cond.notify()
+                return
+        task.future.cancel()
+
+    def _next_task(self):
+        """取出最優先且已到執行時間的請求"""
+        with self._cond:
+            while self._running:
+                now = time.monotonic()
+                ready = [entry for entry in self._queue if entry[1] <= now]
+                if ready:
+                    entry = min(ready)
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+                    return entry[3]
+                timeout = min((entry[1] for entry in self._queue), default=now + 1) - now
+                self._cond.wait(timeout=max(timeout, 0.05))
+        return None
+
+    def _worker_loop(self):
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+            self._dispatch(task)
+
+    def _dispatch(self, task):
+        """依剩餘流量決定執行、改道或延後"""
+        ratio = self.remaining_ratio()
+        is_batch = task.priority >= PRIORITY_BATCH
+        func = task.func
+
+        # 低於 low_watermark 時批次請求讓路；低於 critical_watermark 時互動請求也優先走備援
+        if ratio < self.critical_watermark or (is_batch and ratio < self.low_watermark):
+            if task.fallback is not None:
+                func = task.fallback
+                self._count('rerouted', task.kind)
+            elif is_batch:
+                not_before = time.monotonic() + self.batch_delay
+                if not_before - task.submitted_at > self.max_delay:
+                    task.future.set_exception(TimeoutError(
+                        f"Shioaji 流量不足，{task.kind} 請求已延後超過 {self.max_delay} 秒"))
+                    self._count('failed', task.kind)
+                    return
+                self._count('delayed', task.kind)
+                self._requeue(task, not_before)
+                return
+
+        try:
+            result = func(*task.args, **task.kwargs)
+            task.future.set_result(result)
+            self._count('executed', task.kind)
+        except Exception as e:
+            task.future.set_exception(e)
+            self._count('failed', task.kind)
+
+    def _count(self, name, kind):
+        with self._cond:
+            self._counters[name] += 1
+            per_kind = self._per_kind.setdefault(kind, {'executed': 0, 'rerouted': 0, 'delayed': 0, 'failed': 0})
+            per_kind[name] += 1
@@ -7,13 +7,72 @@
 
 import os
 from dotenv import load_dotenv
-import shioaji as sj
 import pandas as pd
+import threading
+import time
+import concurrent.futures
+from collections import deque
 from datetime import datetime, timedelta
+from metrics import inc, log, observe, timed
+from quota_scheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE, QuotaScheduler
 
 # 載入環境變數
 load_dotenv()
 
+# Shioaji 行情查詢限制：snapshots 每次最多 500 檔，查詢類 API 每 5 秒最多 50 次
+SNAPSHOT_BATCH_SIZE = 500
+QUERY_RATE_LIMIT = 50
+QUERY_RATE_WINDOW = 5.0
+# 流量配額排程器同時執行的查詢數（與日內 kbars 視窗的並行數相同）
+QUOTA_WORKERS = 4
+
+# 快照轉為 DataFrame 時保留的欄位
+SNAPSHOT_FIELDS = [
+    'ts', 'code', 'exchange', 'open', 'high', 'low', 'close',
+    'change_price', 'change_rate', 'average_price', 'volume', 'total_volume',
+    'amount', 'total_amount', 'yesterday_volume', 'buy_price', 'buy_volume',
+    'sell_price', 'sell_volume', 'volume_ratio'
+]
+
+# 單日逐筆資料（get_ticks）保留的欄位
+TICK_FIELDS = ('ts', 'close', 'volume', 'bid_price', 'bid_volume', 'ask_price', 'ask_volume', 'tick_type')
+
+
+def _no_data(*args, **kwargs):
+    """流量吃緊時的改道目標：回傳 None，由呼叫端改用 yfinance 或本地快取"""
+    return None
+
+
+def shioaji_code(symbol):
+    """去除 yfinance 代碼的交易所後綴（上市 .TW、上櫃 .TWO），回傳 Shioaji 使用的股票代碼"""
+    symbol = str(symbol).strip().upper()
+    return symbol.removesuffix('.TWO').removesuffix('.TW')
+
+
+class RateLimiter:
+    """滑動視窗限流器（執行緒安全），確保查詢次數不超過 API 限制"""
+
+    def __init__(self, max_calls=QUERY_RATE_LIMIT, period=QUERY_RATE_WINDOW):
+        self.max_calls = max_calls
+        self.period = period
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取得一次呼叫額度，額度用完時等待到最舊的呼叫移出視窗"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.period:
+                    self._calls.popleft()
+                if len(self._calls) < self.max_calls:
+                    self._calls.append(now)
+                    return
+                wait = self.period - (now - self._calls[0])
+            inc('rate_limiter_waits_total')
+            observe('rate_limiter_wait_seconds', max(wait, 0.01))
+            time.sleep(max(wait, 0.01))
+
 class ShioajiExtended:
     """Shioaji API 擴展功能客戶端"""
     
@@ -21,10 +80,15 @@ class ShioajiExtended:
         self.api = None
         self.is_connected = False
         self.contracts = {}
+        self.rate_limiter = RateLimiter()
+        self.scheduler = None
     
     def connect(self):
         """連接到 Shioaji API"""
         try:
+            # shioaji 載入成本高，只在實際連線時匯入
+            import shioaji as sj
+
             # 初始化 API（模擬模式）
             self.api = sj.Shioaji(simulation=True)
             
@@ -35,14 +99,14 @@ class ShioajiExtended:
                 fetch_contract=False
             )
 
-            print("🔍 使用量: ", self.api.usage())
+            log(f"🔍 使用量: {self.api.usage()}")
             
             # 處理憑證路徑
             cert_path = os.environ.get("CA_CERT_PATH")
             if cert_path:
                 cert_path = os.path.abspath(cert_path)
                 if not os.path.exists(cert_path):
-                    print(f"❌ 找不到憑證檔案: {cert_path}")
+                    log(f"❌ 找不到憑證檔案: {cert_path}", level="error")
                     return False
             
             # 啟用憑證
@@ -52,25 +116,41 @@ class ShioajiExtended:
             )
             
             self.is_connected = True
-            print("✅ Shioaji API 連接成功！")
+            self.scheduler = QuotaScheduler(self, max_workers=QUOTA_WORKERS)
+            log("✅ Shioaji API 連接成功！")
             
             # 載入合約資訊
             self.load_contracts()
             return True
             
         except Exception as e:
-            print(f"❌ Shioaji API 連接失敗: {e}")
+            log(f"❌ Shioaji API 連接失敗: {e}", level="error")
             return False
     
+    def _query(self, kind, func, *args, priority=PRIORITY_INTERACTIVE, reroute=False, **kwargs):
+        """
+        經由流量配額排程器執行一次 kbars / ticks / snapshots 查詢並等待結果（同時遵守查詢頻率限制）。
+        reroute=True 時，流量吃緊的請求不延後而是回傳 None，讓呼叫端改用其他數據源。
+        """
+        def call(*call_args, **call_kwargs):
+            self.rate_limiter.acquire()
+            return func(*call_args, **call_kwargs)
+
+        if self.scheduler is None:
+            return call(*args, **kwargs)
+        future = self.scheduler.submit(kind, call, *args, priority=priority,
+                                       fallback=_no_data if reroute else None, **kwargs)
+        return future.result()
+
     def load_contracts(self):
         """載入股票合約資訊"""
         try:
-            print("📋 正在載入合約資訊...")
+            log("📋 正在載入合約資訊...")
             # 取得台股合約
             self.api.fetch_contracts(contract_download=True)
-            print("✅ 合約資訊載入完成")
+            log("✅ 合約資訊載入完成")
         except Exception as e:
-            print(f"⚠️ 載入合約資訊失敗: {e}")
+            log(f"⚠️ 載入合約資訊失敗: {e}", level="warning")
     
     def get_quote(self, stock_code):
         """獲取即時報價"""
@@ -99,7 +179,7 @@ class ShioajiExtended:
             
             # 獲取即時報價 (使用 snapshots 方法)
             try:
-                snapshots = self.api.snapshots([contract])
+                snapshots = self._query('snapshots', self.api.snapshots, [contract])
                 if snapshots and len(snapshots) > 0:
                     quote_data = snapshots[0]
                     print(f"\n📈 即時報價:")
@@ -126,6 +206,58 @@ class ShioajiExtended:
             print(f"   錯誤詳情: {str(e)}")
             return None
     
+    @timed('shioaji_request_seconds', kind='snapshots')
+    def get_quotes(self, stock_codes, batch_size=SNAPSHOT_BATCH_SIZE, max_workers=4):
+        """
+        批次獲取多檔股票的快照報價，回傳以股票代碼為索引的 DataFrame。
+        代碼會依 API 上限切成多批，並在限流範圍內並行查詢。
+        """
+        if not self.is_connected:
+            log("❌ 請先連接 API", level="error")
+            return None
+
+        # 去除重複代碼並保留順序
+        codes = list(dict.fromkeys(shioaji_code(code) for code in stock_codes))
+        contracts = []
+        missing = []
+        for code in codes:
+            contract = self._find_contract(code)
+            if contract is None:
+                missing.append(code)
+            else:
+                contracts.append(contract)
+
+        if missing:
+            log(f"⚠️ 找不到 {len(missing)} 檔股票合約: {', '.join(missing[:10])}{' ...' if len(missing) > 10 else ''}", level="warning")
+        if not contracts:
+            return pd.DataFrame(columns=SNAPSHOT_FIELDS).set_index('code')
+
+        batch_size = max(1, min(batch_size, SNAPSHOT_BATCH_SIZE))
+        batches = [contracts[i:i + batch_size] for i in range(0, len(contracts), batch_size)]
+        log(f"💰 批次獲取 {len(contracts)} 檔報價，共 {len(batches)} 批...")
+
+        def fetch_batch(batch):
+            return self._query('snapshots', self.api.snapshots, batch)
+
+        snapshots = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(fetch_batch, batch) for batch in batches]
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    snapshots.extend(future.result() or [])
+                except Exception as e:
+                    log(f"⚠️ 批次報價獲取失敗: {e}", level="warning")
+
+        # 直接以欄位建立 DataFrame，避免逐列轉換
+        columns = {field: [getattr(snap, field, None) for snap in snapshots] for field in SNAPSHOT_FIELDS}
+        df = pd.DataFrame(columns)
+        df['ts'] = pd.to_datetime(df['ts'], unit='ns')
+        df['exchange'] = df['exchange'].astype(str)
+        df = df.set_index('code').reindex([code for code in codes if code not in missing])
+
+        log(f"✅ 成功獲取 {df['close'].notna().sum()} 檔報價")
+        return df
+
     def get_realtime_ticks(self, stock_code, last_cnt=10):
         """獲取即時逐筆交易資料 (使用 api.ticks)"""
         if not self.is_connected:
@@ -142,11 +274,14 @@ class ShioajiExtended:
                 print(f"❌ 找不到股票代碼: {stock_code}")
                 return None
             
+            import shioaji as sj
+
             # 獲取今日日期
             today = datetime.now().strftime('%Y-%m-%d')
             
             # 獲取即時逐筆資料
-            ticks = self.api.ticks(
+            ticks = self._query(
+                'ticks', self.api.ticks,
                 contract=contract,
                 date=today,
                 query_type=sj.constant.TicksQueryType.AllDay,
@@ -208,11 +343,14 @@ class ShioajiExtended:
                 print(f"❌ 找不到股票代碼: {stock_code}")
                 return None
             
+            import shioaji as sj
+
             # 獲取今日日期
             today = datetime.now().strftime('%Y-%m-%d')
             
             # 獲取指定時間範圍的逐筆資料
-            ticks = self.api.ticks(
+            ticks = self._query(
+                'ticks', self.api.ticks,
                 contract=contract,
                 date=today,
                 query_type=sj.constant.TicksQueryType.Range,
@@ -289,7 +427,8 @@ class ShioajiExtended:
             start_date = end_date - timedelta(days=days-1)
             
             # 獲取歷史數據
-            kbars = self.api.kbars(
+            kbars = self._query(
+                'kbars', self.api.kbars,
                 contract=contract,
                 start=start_date.strftime('%Y-%m-%d'),
                 end=end_date.strftime('%Y-%m-%d')
@@ -310,6 +449,59 @@ class ShioajiExtended:
             print(f"   錯誤詳情: {str(e)}")
             return None
     
+    @timed('shioaji_request_seconds', kind='kbars')
+    def get_kbars(self, stock_code, start, end, priority=PRIORITY_INTERACTIVE, reroute=False):
+        """
+        獲取 1 分 K 線並轉為以時間為索引的 OHLCV DataFrame（不打印明細）。
+        priority / reroute 傳給流量配額排程器，見 _query()。
+        """
+        if not self.is_connected:
+            return None
+
+        contract = self._find_contract(stock_code)
+        if contract is None:
+            log(f"❌ 在 Shioaji 中找不到股票代碼: {stock_code}", level="error")
+            return None
+
+        kbars = self._query('kbars', self.api.kbars, contract=contract, start=start, end=end,
+                            priority=priority, reroute=reroute)
+        if not kbars:
+            return None
+
+        data = pd.DataFrame({**kbars})
+        if data.empty:
+            return None
+        data['ts'] = pd.to_datetime(data['ts'])
+        data = data.rename(columns={'ts': 'Date'}).set_index('Date')
+        return data[['Open', 'High', 'Low', 'Close', 'Volume']]
+
+    @timed('shioaji_request_seconds', kind='ticks')
+    def get_ticks(self, stock_code, date, priority=PRIORITY_BATCH):
+        """獲取單日逐筆資料，回傳 {欄位: 陣列}（與 GatewayClient.get_ticks 相同格式）"""
+        contract = self._find_contract(stock_code)
+        if contract is None:
+            raise ValueError(f"找不到股票代碼: {stock_code}")
+        ticks = self._query('ticks', self.api.ticks, contract=contract, date=date, priority=priority)
+        return {name: getattr(ticks, name) for name in TICK_FIELDS if hasattr(ticks, name)}
+
+    def get_stock_universe(self):
+        """列出所有上市（.TW）與上櫃（.TWO）普通股代碼"""
+        if not self.is_connected:
+            log("❌ 請先連接 API", level="error")
+            return []
+
+        symbols = []
+        for exchange, suffix in (('TSE', '.TW'), ('OTC', '.TWO')):
+            stocks = getattr(self.api.Contracts.Stocks, exchange, None)
+            if stocks is None:
+                continue
+            for contract in stocks:
+                code = getattr(contract, 'code', '')
+                # 僅保留 4 碼數字的普通股，排除權證與 ETF 衍生商品
+                if len(code) == 4 and code.isdigit():
+                    symbols.append(code + suffix)
+        return sorted(symbols)
+
     def get_account_info(self):
         """獲取帳戶資訊"""
         if not self.is_connected:
@@ -383,7 +575,7 @@ class ShioajiExtended:
         """尋找股票合約"""
         try:
             if not hasattr(self.api.Contracts, 'Stocks'):
-                print("❌ 合約資訊未載入")
+                log("❌ 合約資訊未載入", level="error")
                 return None
             
             stocks = self.api.Contracts.Stocks
@@ -414,17 +606,17 @@ class ShioajiExtended:
                     if hasattr(contract, 'code') and contract.code == stock_code:
                         return contract
             
-            print(f"💡 提示：嘗試使用 api.Contracts.Stocks.{stock_code}")
+            log(f"💡 提示：嘗試使用 api.Contracts.Stocks.{stock_code}")
             return getattr(stocks, stock_code, None)
             
         except Exception as e:
-            print(f"⚠️ 查找合約時發生錯誤: {e}")
+            log(f"⚠️ 查找合約時發生錯誤: {e}", level="warning")
             return None
     
     def _alternative_search(self, keyword):
         """替代搜尋方法"""
         try:
-            print("🔄 嘗試直接訪問合約...")
+            log("🔄 嘗試直接訪問合約...")
             
             # 嘗試直接訪問
             if hasattr(self.api.Contracts, 'Stocks'):
@@ -444,18 +636,21 @@ class ShioajiExtended:
             return []
             
         except Exception as e:
-            print(f"⚠️ 替代搜尋失敗: {e}")
+            log(f"⚠️ 替代搜尋失敗: {e}", level="warning")
             return []
     
     def logout(self):
         """登出並斷開連接"""
+        if self.scheduler is not None:
+            self.scheduler.stop()
+            self.scheduler = None
         if self.api and self.is_connected:
             try:
                 self.api.logout()
                 self.is_connected = False
-                print("✅ 已成功登出並斷開 Shioaji API 連接")
+                log("✅ 已成功登出並斷開 Shioaji API 連接")
             except Exception as e:
-                print(f"❌ 登出時發生錯誤: {e}")
+                log(f"❌ 登出時發生錯誤: {e}", level="error")
 
 def interactive_menu():
     """互動式選單"""
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shioaji 本機閘道
+由單一程序持有 Shioaji 登入、合約表與行情訂閱，其他本機程序（Streamlit、篩選器、CLI）
+透過 Unix socket（Windows 為 named pipe）呼叫 kbars / snapshots / ticks，
+逐筆行情則經由共享記憶體環形緩衝區分送給所有訂閱者。
+連線以每個使用者隨機產生的 authkey（權限 0600 的檔案）驗證，socket 放在只有本人可存取（0700）的目錄，
+避免其他本機使用者把 pickle 送進已登入的程序，或搶先建立同名 socket 冒充閘道。
+"""
+
+import os
+import secrets
+import stat
+import threading
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+from multiprocessing.connection import Listener, Client
+from metrics import inc, timed
+from quota_scheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE
+
+# 每個使用者的執行期目錄：優先使用 $XDG_RUNTIME_DIR，否則為 ~/.shioaji；可由 GATEWAY_DIR 指定
+RUNTIME_DIR = os.getenv('GATEWAY_DIR') or (
+    os.path.join(os.environ['XDG_RUNTIME_DIR'], 'shioaji') if os.environ.get('XDG_RUNTIME_DIR')
+    else os.path.join(os.path.expanduser('~'), '.shioaji')
+)
+AUTHKEY_FILE = os.path.join(RUNTIME_DIR, 'gateway.key')
+AUTHKEY_BYTES = 32
+
+if os.name == 'nt':
+    DEFAULT_ADDRESS = rf'\\.\pipe\shioaji_gateway_{os.getenv("USERNAME", "user")}'
+else:
+    DEFAULT_ADDRESS = os.path.join(RUNTIME_DIR, 'gateway.sock')
+
+# 環形緩衝區中每筆逐筆資料的格式
+TICK_DTYPE = np.dtype([
+    ('ts', 'i8'),
+    ('close', 'f8'),
+    ('volume', 'i8'),
+    ('bid_price', 'f8'),
+    ('ask_price', 'f8'),
+    ('tick_type', 'i1'),
+])
+
+
+def _check_owner(path, st):
+    """路徑必須屬於目前使用者，且群組與其他人沒有存取權"""
+    if os.name == 'nt':
+        return
+    if st.st_uid != os.getuid():
+        raise PermissionError(f"{path} 不屬於目前使用者，拒絕使用")
+    if st.st_mode & 0o077:
+        raise PermissionError(f"{path} 的權限過寬（{stat.filemode(st.st_mode)}），應只有本人可存取")
+
+
+def ensure_runtime_dir(path=RUNTIME_DIR):
+    """建立權限 0700 的執行期目錄；已存在時必須屬於目前使用者，權限過寬則收緊"""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if os.name != 'nt':
+        st = os.stat(path)
+        if st.st_uid == os.getuid() and st.st_mode & 0o077:
+            os.chmod(path, 0o700)
+            st = os.stat(path)
+        _check_owner(path, st)
+    return path
+
+
+def load_authkey(create=False, path=AUTHKEY_FILE):
+    """
+    讀取閘道 authkey（GATEWAY_AUTHKEY 環境變數優先）；
+    create=True 時若檔案不存在則以隨機值建立權限 0600 的檔案，否則回傳 None。
+    """
+    if os.environ.get('GATEWAY_AUTHKEY'):
+        return os.environ['GATEWAY_AUTHKEY'].encode()
+    ensure_runtime_dir(os.path.dirname(path))
+    if not os.path.exists(path):
+        if not create:
+            return None
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass
+        else:
+            with os.fdopen(fd, 'w') as f:
+                f.write(secrets.token_hex(AUTHKEY_BYTES))
+    with open(path, 'rb') as f:
+        _check_owner(path, os.fstat(f.fileno()))
+        return f.read().strip()
+
+
+def _check_socket(address):
+    """Unix socket 必須是目前使用者建立的 socket（Windows named pipe 不適用）"""
+    if os.name == 'nt':
+        return
+    st = os.lstat(address)
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        raise PermissionError(f"{address} 不是目前使用者建立的 socket，拒絕使用")
+
+
+class TickRingBuffer:
+    """
+    共享記憶體逐筆環形緩衝區（單一寫入者、多個讀取者）。
+    表頭存放累計寫入筆數與容量，讀取者各自保存游標，落後超過容量時從最舊的一筆續讀。
+    """
+
+    HEADER_SIZE = 16
+
+    def __init__(self, name=None, capacity=65536, create=False):
+        if create:
+            size = self.HEADER_SIZE + capacity * TICK_DTYPE.itemsize
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # 讀取端不負責回收共享記憶體，避免程序結束時被 resource_tracker 提前刪除
+            if os.name != 'nt':
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+
+        self._header = np.ndarray((2,), dtype='u8', buffer=self.shm.buf, offset=0)
+        if create:
+            self._header[:] = (0, capacity)
+        self.capacity = int(self._header[1])
+        self._slots = np.ndarray((self.capacity,), dtype=TICK_DTYPE, buffer=self.shm.buf, offset=self.HEADER_SIZE)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def count(self):
+        return int(self._header[0])
+
+    def write(self, ts, close, volume, bid_price=0.0, ask_price=0.0, tick_type=0):
+        """寫入一筆逐筆資料（僅由閘道呼叫）"""
+        count = int(self._header[0])
+        self._slots[count % self.capacity] = (ts, close, volume, bid_price, ask_price, tick_type)
+        self._header[0] = count + 1
+
+    def read_since(self, cursor):
+        """讀取游標之後的新資料，回傳 (結構化陣列, 新游標)"""
+        count = self.count
+        cursor = max(cursor, count - self.capacity)
+        if cursor >= count:
+            return np.empty(0, dtype=TICK_DTYPE), count
+
+        positions = np.arange(cursor, count) % self.capacity
+        records = self._slots[positions].copy()
+
+        # 複製期間若被寫入者覆蓋，丟棄可能已損壞的最舊幾筆
+        overwritten = self.count - self.capacity - cursor
+        if overwritten > 0:
+            records = records[overwritten:]
+        return records, count
+
+    def close(self):
+        del self._header, self._slots
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class ShioajiGateway:
+    """持有唯一 Shioaji 登入並服務本機客戶端的閘道程序"""
+
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None, ring_capacity=65536):
+        self.address = address
+        self.authkey = authkey
+        self.ring_capacity = ring_capacity
+        self.client = None
+        self.rings = {}            # 股票代碼 -> TickRingBuffer
+        self.subscribers = {}      # 股票代碼 -> 訂閱數
+        self._lock = threading.Lock()
+
+    def start(self):
+        """登入 Shioaji 並開始接受本機連線（阻塞執行）"""
+        from shioaji_extended import ShioajiExtended
+
+        self.client = ShioajiExtended()
+        if not self.client.connect():
+            print("❌ 閘道無法登入 Shioaji，結束")
+            return False
+        self.client.api.quote.set_on_tick_stk_v1_callback(self._on_tick)
+
+        if self.authkey is None:
+            self.authkey = load_authkey(create=True)
+        if os.name != 'nt':
+            ensure_runtime_dir(os.path.dirname(self.address))
+            # 只移除自己先前留下的 socket，其他檔案一律拒絕
+            if os.path.lexists(self.address):
+                _check_socket(self.address)
+                os.remove(self.address)
+
+        listener = Listener(self.address, authkey=self.authkey)
+        print(f"🔌 Shioaji 閘道已啟動: {self.address}")
+        try:
+            while True:
+                conn = listener.accept()
+                threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+        except KeyboardInterrupt:
+            print("\n⚠️ 閘道收到中斷訊號")
+        finally:
+            listener.close()
+            self.shutdown()
+        return True
+
+    def shutdown(self):
+        """取消所有訂閱、釋放共享記憶體並登出"""
+        with self._lock:
+            for code in list(self.subscribers):
+                self._unsubscribe_contract(code)
+            for ring in self.rings.values():
+                ring.close()
+                ring.unlink()
+            self.rings.clear()
+            self.subscribers.clear()
+        if self.client:
+            self.client.logout()
+
+    def _serve(self, conn):
+        """處理單一客戶端連線的請求迴圈"""
+        with conn:
+            while True:
+                try:
+                    method, args, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    return
+                handler = getattr(self, f"rpc_{method}", None)
+                try:
+                    if handler is None:
+                        raise ValueError(f"不支援的閘道方法: {method}")
+                    conn.send(('ok', handler(*args, **kwargs)))
+                except Exception as e:
+                    conn.send(('error', str(e)))
+
+    # --- RPC 方法 ---
+    def rpc_ping(self):
+        return True
+
+    def rpc_usage(self):
+        status = self.client.api.usage()
+        return {name: getattr(status, name, None) for name in ('connections', 'bytes', 'limit_bytes', 'remaining_bytes')}
+
+    def rpc_kbars(self, stock_code, start, end, priority=PRIORITY_INTERACTIVE, reroute=False):
+        return self.client.get_kbars(stock_code, start, end, priority=priority, reroute=reroute)
+
+    def rpc_snapshots(self, stock_codes):
+        return self.client.get_quotes(stock_codes)
+
+    def rpc_ticks(self, stock_code, date, priority=PRIORITY_BATCH):
+        return {name: list(values) for name, values in self.client.get_ticks(stock_code, date, priority).items()}
+
+    def rpc_universe(self):
+        return self.client.get_stock_universe()
+
+    def rpc_subscribe(self, stock_code):
+        """訂閱逐筆行情，回傳共享記憶體緩衝區名稱；同一股票只向 Shioaji 訂閱一次"""
+        with self._lock:
+            if stock_code not in self.rings:
+                self.rings[stock_code] = TickRingBuffer(capacity=self.ring_capacity, create=True)
+            if self.subscribers.get(stock_code, 0) == 0:
+                contract = self.client._find_contract(stock_code)
+                if contract is None:
+                    raise ValueError(f"找不到股票代碼: {stock_code}")
+                self.client.api.quote.subscribe(contract, quote_type='tick', version='v1')
+                print(f"📡 已訂閱 {stock_code} 逐筆行情")
+            self.subscribers[stock_code] = self.subscribers.get(stock_code, 0) + 1
+            return self.rings[stock_code].name
+
+    def rpc_unsubscribe(self, stock_code):
+        """取消一個訂閱者，最後一個訂閱者離開時才向 Shioaji 取消訂閱"""
+        with self._lock:
+            remaining = self.subscribers.get(stock_code, 0) - 1
+            if remaining <= 0:
+                self._unsubscribe_contract(stock_code)
+                self.subscribers.pop(stock_code, None)
+            else:
+                self.subscribers[stock_code] = remaining
+        return True
+
+    def _unsubscribe_contract(self, stock_code):
+        contract = self.client._find_contract(stock_code)
+        if contract is not None:
+            self.client.api.quote.unsubscribe(contract, quote_type='tick', version='v1')
+            print(f"📴 已取消訂閱 {stock_code} 逐筆行情")
+
+    @timed('tick_handler_seconds', handler='gateway')
+    def _on_tick(self, exchange, tick):
+        """Shioaji 逐筆回呼：寫入對應股票的環形緩衝區"""
+        ring = self.rings.get(tick.code)
+        if ring is None:
+            return
+        ring.write(
+            pd.Timestamp(tick.datetime).value,
+            float(tick.close),
+            int(tick.volume),
+            float(getattr(tick, 'bid_price', 0) or 0),
+            float(getattr(tick, 'ask_price', 0) or 0),
+            int(tick.tick_type),
+        )
+        inc('ticks_total', source='gateway')
+
+
+class GatewayTickStream:
+    """客戶端的逐筆行情讀取器"""
+
+    def __init__(self, gateway_client, stock_code, ring_name):
+        self.gateway_client = gateway_client
+        self.stock_code = stock_code
+        self.ring = TickRingBuffer(name=ring_name)
+        # 從目前位置開始讀取，不重播歷史資料
+        self.cursor = self.ring.count
+
+    def poll(self):
+        """取得自上次呼叫以來的新逐筆資料（DataFrame）"""
+        records, self.cursor = self.ring.read_since(self.cursor)
+        df = pd.DataFrame(records)
+        df['ts'] = pd.to_datetime(df['ts'], unit='ns')
+        return df
+
+    def close(self):
+        self.ring.close()
+        self.gateway_client._call('unsubscribe', self.stock_code)
+
+
+class GatewayClient:
+    """
+    本機閘道客戶端，提供與 ShioajiExtended 相同的查詢介面，
+    可直接替代 StockDataFetcher 中的 shioaji_client。
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None):
+        self.address = address
+        _check_socket(address)
+        authkey = authkey if authkey is not None else load_authkey()
+        if authkey is None:
+            raise PermissionError(f"找不到閘道 authkey: {AUTHKEY_FILE}")
+        self.conn = Client(address, authkey=authkey)
+        self.is_connected = True
+        self._lock = threading.Lock()
+
+    @classmethod
+    def try_connect(cls, address=DEFAULT_ADDRESS, authkey=None):
+        """嘗試連接閘道，閘道未啟動、authkey 不存在或 socket 擁有者不符時回傳 None"""
+        if os.name != 'nt' and not os.path.exists(address):
+            return None
+        try:
+            client = cls(address, authkey)
+            client._call('ping')
+            return client
+        except Exception:
+            return None
+
+    def _call(self, method, *args, **kwargs):
+        with self._lock:
+            self.conn.send((method, args, kwargs))
+            status, payload = self.conn.recv()
+        if status == 'error':
+            raise RuntimeError(f"閘道錯誤: {payload}")
+        return payload
+
+    def usage(self):
+        return self._call('usage')
+
+    def get_kbars(self, stock_code, start, end, priority=PRIORITY_INTERACTIVE, reroute=False):
+        return self._call('kbars', stock_code, start, end, priority=priority, reroute=reroute)
+
+    def get_quotes(self, stock_codes):
+        return self._call('snapshots', list(stock_codes))
+
+    def get_ticks(self, stock_code, date, priority=PRIORITY_BATCH):
+        return self._call('ticks', stock_code, date, priority=priority)
+
+    def get_stock_universe(self):
+        return self._call('universe')
+
+    def subscribe_ticks(self, stock_code):
+        """訂閱逐筆行情，回傳可輪詢的 GatewayTickStream"""
+        ring_name = self._call('subscribe', stock_code)
+        return GatewayTickStream(self, stock_code, ring_name)
+
+    def logout(self):
+        """關閉與閘道的連線（閘道本身保持登入）"""
+        if self.is_connected:
+            self.conn.close()
+            self.is_connected = False
+
+
+def main():
+    """啟動閘道程序"""
+    print("=== Shioaji 本機閘道 ===")
+    ShioajiGateway().start()
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+數據源路由與熔斷
+記錄各數據源（本地儲存區、Shioaji kbars、yfinance）近期的延遲、錯誤率與被限流次數，
+每個請求依延遲排序送往最快且健康的數據源；連續失敗或錯誤率過高的數據源會開啟熔斷，
+冷卻後只放行一個探測請求，成功才恢復。重試改用含抖動的指數退避，取代固定等待。
+健康狀態為程序內共用，各 StockDataFetcher 實例看到相同的統計；
+同時進行中的請求數由各數據源的自適應併發上限（adaptive_concurrency）控制。
+"""
+
+import random
+import threading
+import time
+from collections import deque
+from adaptive_concurrency import ERROR, SUCCESS, THROTTLED, source_limit
+from metrics import inc, log, observe, register_collector, set_gauge
+
+# 指數退避：第 n 次重試等待 uniform(0, min(上限, 基準 × 2^n)) 秒（full jitter）
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 8.0
+
+# 熔斷條件：近 HEALTH_WINDOW 次請求中至少 MIN_SAMPLES 次且錯誤率達 ERROR_RATE_THRESHOLD，或連續失敗 FAILURE_THRESHOLD 次
+HEALTH_WINDOW = 20
+MIN_SAMPLES = 5
+ERROR_RATE_THRESHOLD = 0.5
+FAILURE_THRESHOLD = 3
+# 熔斷冷卻秒數（探測失敗時加倍，最多 OPEN_MAX_SECONDS）；被限流時使用較長的冷卻
+OPEN_SECONDS = 30
+THROTTLE_OPEN_SECONDS = 60
+OPEN_MAX_SECONDS = 300
+# 延遲的指數移動平均權重
+LATENCY_ALPHA = 0.2
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# 判定為限流的錯誤訊息
+THROTTLE_MARKERS = ('429', 'too many requests', 'rate limit', 'ratelimit')
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """第 attempt 次（從 0 起算）重試前的等待秒數"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def is_throttle_error(error):
+    """錯誤是否代表被數據源限流"""
+    text = f"{type(error).__name__} {error}".lower()
+    return any(marker in text for marker in THROTTLE_MARKERS)
+
+
+class SourceHealth:
+    """單一數據源的滾動健康統計與熔斷狀態（執行緒安全）"""
+
+    def __init__(self, name, prior_latency=1.0):
+        self.name = name
+        self.latency = prior_latency
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=HEALTH_WINDOW)  # True 為成功
+        self._consecutive_failures = 0
+        self._open_seconds = OPEN_SECONDS
+        self._opened_at = 0.0
+        self._probing = False
+        self.state = CLOSED
+        self.counters = {'success': 0, 'empty': 0, 'error': 0, 'throttled': 0, 'rejected': 0}
+
+    def allow(self):
+        """是否可送出請求；熔斷冷卻結束後只放行一個探測請求"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self._open_seconds:
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.counters['rejected'] += 1
+            return False
+
+    def record_success(self, latency, empty=False):
+        with self._lock:
+            self.latency += LATENCY_ALPHA * (latency - self.latency)
+            self._outcomes.append(True)
+            self._consecutive_failures = 0
+            self.counters['empty' if empty else 'success'] += 1
+            if self.state != CLOSED:
+                log(f"✅ 數據源 {self.name} 恢復，關閉熔斷")
+                self._open_seconds = OPEN_SECONDS
+                self._set_state(CLOSED)
+            self._probing = False
+        observe('source_latency_seconds', latency, source=self.name)
+
+    def record_failure(self, latency, throttled=False):
+        with self._lock:
+            self.latency += LATENCY_ALPHA * (latency - self.latency)
+            self._outcomes.append(False)
+            self._consecutive_failures += 1
+            self.counters['throttled' if throttled else 'error'] += 1
+            failures = self._outcomes.count(False)
+            tripped = (throttled or self._consecutive_failures >= FAILURE_THRESHOLD
+                       or (len(self._outcomes) >= MIN_SAMPLES
+                           and failures / len(self._outcomes) >= ERROR_RATE_THRESHOLD))
+            if self.state == HALF_OPEN:
+                # 探測失敗：冷卻時間加倍
+                self._open_seconds = min(self._open_seconds * 2, OPEN_MAX_SECONDS)
+                self._trip()
+            elif self.state == CLOSED and tripped:
+                self._open_seconds = max(self._open_seconds, THROTTLE_OPEN_SECONDS if throttled else OPEN_SECONDS)
+                self._trip()
+            self._probing = False
+        observe('source_latency_seconds', latency, source=self.name)
+
+    def _trip(self):
+        self._opened_at = time.monotonic()
+        self._set_state(OPEN)
+        inc('source_circuit_open_total', source=self.name)
+        log(f"⛔ 數據源 {self.name} 開啟熔斷 {self._open_seconds:.0f} 秒", level="warning")
+
+    def _set_state(self, state):
+        self.state = state
+        set_gauge('source_circuit_state', STATE_CODES[state], source=self.name)
+
+    def stats(self):
+        with self._lock:
+            total = len(self._outcomes)
+            return {
+                'state': STATE_CODES[self.state],
+                'latency_ms': self.latency * 1000,
+                'error_rate': self._outcomes.count(False) / total if total else 0.0,
+                **self.counters,
+            }
+
+
+_health = {}
+_health_lock = threading.Lock()
+
+
+def source_health(name, prior_latency=1.0):
+    """取得程序內共用的數據源健康統計（第一次取得時以 prior_latency 作為延遲初值）"""
+    with _health_lock:
+        if not _health:
+            register_collector('sources', _collect_stats)
+        if name not in _health:
+            _health[name] = SourceHealth(name, prior_latency)
+        return _health[name]
+
+
+def _collect_stats():
+    with _health_lock:
+        sources = list(_health.values())
+    return {f"{health.name}_{key}": value for health in sources for key, value in health.stats().items()}
+
+
+def health_report():
+    """{數據源: 健康統計}，供介面或命令列顯示"""
+    with _health_lock:
+        sources = list(_health.values())
+    return {health.name: health.stats() for health in sources}
+
+
+class DataSource:
+    """
+    可路由的數據源。
+    fetch(symbol, period, interval) 失敗時應拋出例外；回傳 None 或空表代表此來源沒有該數據（不計為錯誤）。
+    supports(symbol, period, interval) 判斷此來源是否適用於該請求。
+    max_concurrency 為此來源的最大併發數，未指定時使用 SOURCE_MAX_CONCURRENCY。
+    """
+
+    def __init__(self, name, fetch, supports=None, prior_latency=1.0, retries=2, max_concurrency=None):
+        self.name = name
+        self.fetch = fetch
+        self.supports = supports or (lambda symbol, period, interval: True)
+        self.retries = retries
+        self.health = source_health(name, prior_latency)
+        self.limit = source_limit(name, max_concurrency)
+
+
+class SourceRouter:
+    """依延遲與健康狀態選擇數據源，失敗時以指數退避重試並改用下一個來源"""
+
+    def __init__(self, sources):
+        self.sources = list(sources)
+
+    def fetch(self, symbol, period="6mo", interval="1d"):
+        """回傳 (數據, 數據源名稱)；所有來源都失敗或沒有數據時回傳 (None, None)"""
+        ranked = sorted(
+            (source for source in self.sources if source.supports(symbol, period, interval)),
+            key=lambda source: source.health.latency,
+        )
+        for source in ranked:
+            for attempt in range(source.retries + 1):
+                if not source.health.allow():
+                    break
+                source.limit.acquire()
+                start = time.perf_counter()
+                try:
+                    data = source.fetch(symbol, period, interval)
+                except Exception as e:
+                    latency = time.perf_counter() - start
+                    throttled = is_throttle_error(e)
+                    source.limit.release(latency, THROTTLED if throttled else ERROR)
+                    log(f"❌ {source.name} 獲取 {symbol} 失敗（第 {attempt + 1} 次）: {e}", level="error")
+                    inc('source_requests_total', source=source.name, outcome='throttled' if throttled else 'error')
+                    source.health.record_failure(latency, throttled)
+                    if attempt < source.retries and source.health.state == CLOSED:
+                        time.sleep(backoff_delay(attempt))
+                    continue
+
+                latency = time.perf_counter() - start
+                source.limit.release(latency, SUCCESS)
+                empty = data is None or data.empty
+                source.health.record_success(latency, empty=empty)
+                inc('source_requests_total', source=source.name, outcome='empty' if empty else 'success')
+                if not empty:
+                    return data, source.name
+                break
+        return None, None
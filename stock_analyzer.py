@@ -1,34 +1,91 @@
-import yfinance as yf
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-import ta
 from datetime import datetime, timedelta
-from stock_data_fetcher import StockDataFetcher
+from stock_data_fetcher import shared_fetcher
+from bar_pyramid import aggregate
+from trading_calendar import exchange_for
+from chart_utils import DEFAULT_MAX_POINTS, aggregate_ohlc, axis_labels, line_trace_class
+from metrics import log, timed
 import warnings
 warnings.filterwarnings('ignore')
 
+# 緩坡爬升的預設門檻：趨勢斜率範圍（每根K線的價格變化）與最少持續K線數
+GENTLE_MIN_SLOPE = 0.1
+GENTLE_MAX_SLOPE = 2.0
+GENTLE_MIN_DAYS = 10
+
+def crossover_masks(yellow, blue):
+    """
+    黃金交叉（黃線上穿藍線）與死亡交叉（黃線下穿藍線）的布林陣列，與前一根比較。
+    沿最後一軸計算，可傳入單檔 (K線數,) 或面板 (股票數, K線數)；第一根恆為 False。
+    """
+    yellow = np.asarray(yellow)
+    blue = np.asarray(blue)
+    golden = np.zeros(yellow.shape, dtype=bool)
+    death = np.zeros(yellow.shape, dtype=bool)
+    golden[..., 1:] = (yellow[..., 1:] > blue[..., 1:]) & (yellow[..., :-1] <= blue[..., :-1])
+    death[..., 1:] = (yellow[..., 1:] < blue[..., 1:]) & (yellow[..., :-1] >= blue[..., :-1])
+    return golden, death
+
+def indicator_dtype(prices):
+    """指標欄位的儲存型別：精簡的價格（float32 或整數跳動單位）對應 float32，float64 價格維持 float64"""
+    return np.float64 if np.asarray(prices).dtype == np.float64 else np.float32
+
+# 尚未指定數據獲取器的標記（與明確設為 None 區分）
+_UNSET = object()
+
 class StockAnalyzer:
+    """
+    單一請求的技術分析。分析器只保存該次請求的狀態（數據與 FetchResult），
+    預設共用程序內的數據獲取器，因此可在 reset() 後重複使用或放入池中供多個執行緒輪流使用
+    （同一實例同時只處理一個請求）。
+    """
+
     def __init__(self):
+        self._data_fetcher = _UNSET
+        self.reset()
+
+    def reset(self):
+        """清除上一個請求的數據與獲取結果"""
         self.data = None
         self.symbol = None
-        self.data_fetcher = StockDataFetcher()
+        self.fetch_result = None
+
+    @property
+    def data_fetcher(self):
+        """預設使用程序內共用的數據獲取器；設為 None 表示不再獲取數據（例如快取中的分析器）"""
+        if getattr(self, '_data_fetcher', _UNSET) is _UNSET:
+            return shared_fetcher()
+        return self._data_fetcher
+
+    @data_fetcher.setter
+    def data_fetcher(self, fetcher):
+        self._data_fetcher = fetcher
         
+    @timed('analysis_seconds', stage='fetch')
     def fetch_data(self, symbol, period="1y", interval="1d", use_demo_data=False):
         """獲取並處理股票數據，支援不同時間週期"""
+        self.reset()
+        self.symbol = symbol
         try:
-            self.symbol = symbol
-            # 從 data_fetcher 獲取原始數據
-            raw_data = self.data_fetcher.fetch_data(symbol, period, interval, use_demo_data)
-            
-            if raw_data is None or raw_data.empty:
-                print(f"❌ 無法獲取 {symbol} 的數據")
-                self.data = None
-                return False
+            result = self.data_fetcher.fetch(symbol, period, interval, use_demo_data)
+        except Exception as e:
+            log(f"數據獲取錯誤: {e}", level="error")
+            return False
+        return self.load(result)
 
-            self.data = raw_data
+    def load(self, result):
+        """載入 FetchResult（複製數據，不修改結果本身），必要時重採樣為請求的週期"""
+        self.reset()
+        self.symbol = result.symbol
+        self.fetch_result = result
+        if result.empty:
+            log(f"❌ 無法獲取 {result.symbol} 的數據", level="error")
+            return False
+
+        try:
+            self.data = result.data.copy()
+            interval = result.interval
             
             # --- 數據重採樣邏輯 ---
             # 檢查數據的時間間隔，以判斷是否為日內數據
@@ -47,81 +104,65 @@ class StockAnalyzer:
                 self.resample_data(interval)
 
             if self.data is None or self.data.empty:
-                print(f"❌ 處理後 {symbol} 數據為空")
+                log(f"❌ 處理後 {result.symbol} 數據為空", level="error")
                 return False
             
-            print(f"✅ 數據載入成功: {len(self.data)} 筆記錄")
+            log(f"✅ 數據載入成功: {len(self.data)} 筆記錄（來源 {result.source}，{result.elapsed:.2f} 秒）")
             return True
             
         except Exception as e:
-            print(f"數據獲取錯誤: {e}")
+            log(f"數據獲取錯誤: {e}", level="error")
             return False
 
+    @timed('analysis_seconds', stage='analyze')
     def analyze(self):
         """對已獲取的數據執行所有技術分析計算，並在最後裁剪到用戶請求的日期範圍"""
         if self.data is None:
-            print("⚠️ 沒有數據可供分析，請先 fetch_data")
+            log("⚠️ 沒有數據可供分析，請先 fetch_data", level="warning")
             return False
         
-        print("🔬 開始執行技術分析 (使用擴展數據)...")
+        log("🔬 開始執行技術分析 (使用擴展數據)...")
         self.calculate_moving_averages()
         self.calculate_support_resistance()
         self.detect_trend_slope()
-        print("✅ 技術分析計算完成")
+        log("✅ 技術分析計算完成")
 
-        # 裁剪數據到原始請求的範圍
-        if hasattr(self.data_fetcher, 'original_start_date'):
-            print(f"🔪 正在將數據裁剪回 {self.data_fetcher.original_start_date.strftime('%Y-%m-%d')} 之後...")
-            original_start_date_aware = pd.to_datetime(self.data_fetcher.original_start_date).tz_localize(self.data.index.tz)
-            self.data = self.data[self.data.index >= original_start_date_aware]
-            print(f"✅ 數據裁剪完成，剩下 {len(self.data)} 筆記錄用於顯示")
+        # 裁剪數據到原始請求的範圍（暖機期間只用於計算指標）
+        if self.fetch_result is not None:
+            log(f"🔪 正在將數據裁剪回 {self.fetch_result.requested_start.strftime('%Y-%m-%d')} 之後...")
+            self.data = self.fetch_result.trim(self.data)
+            log(f"✅ 數據裁剪完成，剩下 {len(self.data)} 筆記錄用於顯示")
         
         return True
     
+    @timed('analysis_seconds', stage='resample')
     def resample_data(self, interval):
-        """將數據重採樣為指定的K線週期 (日/週/月)"""
+        """將數據依交易時段聚合為指定的K線週期（分鐘/日/週/月，見 bar_pyramid）"""
         if self.data is None or self.data.empty:
             return
 
-        print(f"🔄 正在將數據重採樣為 {interval} 週期...")
-        
-        # 定義重採樣規則
-        rule_map = {
-            '1d': 'D',
-            '1wk': 'W',
-            '1mo': 'M'
-        }
-        rule = rule_map.get(interval)
-        if not rule:
-            print(f"⚠️ 不支援的重採樣週期: {interval}")
-            return
-
-        # 定義OHLCV的聚合方式
-        ohlc_dict = {
-            'Open': 'first',
-            'High': 'max',
-            'Low': 'min',
-            'Close': 'last',
-            'Volume': 'sum'
-        }
-        
+        log(f"🔄 正在將數據重採樣為 {interval} 週期...")
         try:
-            resampled_data = self.data.resample(rule).apply(ohlc_dict)
-            # 移除沒有交易的行
-            self.data = resampled_data.dropna()
-            print(f"✅ 重採樣完成，剩下 {len(self.data)} 筆記錄")
+            self.data = aggregate(self.data, interval, exchange_for(self.symbol))
+            log(f"✅ 重採樣完成，剩下 {len(self.data)} 筆記錄")
+        except ValueError as e:
+            log(f"⚠️ {e}", level="warning")
         except Exception as e:
-            print(f"❌ 重採樣失敗: {e}")
+            log(f"❌ 重採樣失敗: {e}", level="error")
 
+    @timed('analysis_seconds', stage='moving_averages')
     def calculate_moving_averages(self):
         """計算移動平均線（優化為EMA）"""
         if self.data is None:
             return None
             
-        # 計算不同週期的指數移動平均線 (EMA)，反應更靈敏
-        self.data['MA5'] = ta.trend.ema_indicator(self.data['Close'], window=5)
-        self.data['MA20'] = ta.trend.ema_indicator(self.data['Close'], window=20)
-        self.data['MA60'] = ta.trend.ema_indicator(self.data['Close'], window=60)
+        import ta
+
+        # 計算不同週期的指數移動平均線 (EMA)，反應更靈敏；以 float64 計算後存為與價格相同精度
+        dtype = indicator_dtype(self.data['Close'])
+        self.data['MA5'] = ta.trend.ema_indicator(self.data['Close'], window=5).astype(dtype)
+        self.data['MA20'] = ta.trend.ema_indicator(self.data['Close'], window=20).astype(dtype)
+        self.data['MA60'] = ta.trend.ema_indicator(self.data['Close'], window=60).astype(dtype)
         
         # 黃線（短期）和藍線（長期）
         self.data['Yellow_Line'] = self.data['MA5']  # 黃線 - 5日EMA
@@ -129,26 +170,32 @@ class StockAnalyzer:
         
         return self.data
     
+    @timed('analysis_seconds', stage='support_resistance')
     def calculate_support_resistance(self, window=20):
         """計算支撐和阻力線"""
         if self.data is None:
             return None
             
+        dtype = indicator_dtype(self.data['Close'])
+        
         # 計算支撐線（低點的移動平均）
-        self.data['Support'] = self.data['Low'].rolling(window=window).min()
+        self.data['Support'] = self.data['Low'].rolling(window=window).min().astype(dtype)
         
         # 計算阻力線（高點的移動平均）
-        self.data['Resistance'] = self.data['High'].rolling(window=window).max()
+        self.data['Resistance'] = self.data['High'].rolling(window=window).max().astype(dtype)
         
         return self.data
     
+    @timed('analysis_seconds', stage='trend_slope')
     def detect_trend_slope(self, period=20):
         """檢測趨勢斜率（緩坡爬升）"""
         if self.data is None:
             return None
             
+        dtype = indicator_dtype(self.data['Close'])
+        
         # 計算價格變化率
-        self.data['Price_Change'] = self.data['Close'].pct_change()
+        self.data['Price_Change'] = self.data['Close'].pct_change().astype(dtype)
         
         # 定義一個輔助函數來計算斜率
         def calculate_slope(y):
@@ -170,40 +217,33 @@ class StockAnalyzer:
         self.data['Trend_Slope'] = self.data['Close'].rolling(
             window=period,
             min_periods=2  # 至少需要兩個點才能計算斜率
-        ).apply(calculate_slope, raw=False)
+        ).apply(calculate_slope, raw=False).astype(dtype)
         
         return self.data
     
+    @timed('analysis_seconds', stage='crossovers')
     def find_crossover_points(self):
         """找到黃藍線交叉點"""
         if self.data is None or 'Yellow_Line' not in self.data.columns:
             return None
             
-        crossovers = []
+        golden, death = crossover_masks(self.data['Yellow_Line'].to_numpy(), self.data['Blue_Line'].to_numpy())
+        positions = np.flatnonzero(golden | death)
         
-        for i in range(1, len(self.data)):
-            # 黃金交叉（黃線上穿藍線）
-            if (self.data['Yellow_Line'].iloc[i] > self.data['Blue_Line'].iloc[i] and 
-                self.data['Yellow_Line'].iloc[i-1] <= self.data['Blue_Line'].iloc[i-1]):
-                crossovers.append({
-                    'date': self.data.index[i],
-                    'price': self.data['Close'].iloc[i],
-                    'type': '黃金交叉',
-                    'signal': 'BUY'
-                })
-            
-            # 死亡交叉（黃線下穿藍線）
-            elif (self.data['Yellow_Line'].iloc[i] < self.data['Blue_Line'].iloc[i] and 
-                  self.data['Yellow_Line'].iloc[i-1] >= self.data['Blue_Line'].iloc[i-1]):
-                crossovers.append({
-                    'date': self.data.index[i],
-                    'price': self.data['Close'].iloc[i],
-                    'type': '死亡交叉',
-                    'signal': 'SELL'
-                })
+        closes = self.data['Close'].to_numpy()
+        crossovers = []
+        for i in positions:
+            is_golden = golden[i]
+            crossovers.append({
+                'date': self.data.index[i],
+                'price': closes[i],
+                'type': '黃金交叉' if is_golden else '死亡交叉',
+                'signal': 'BUY' if is_golden else 'SELL'
+            })
         
         return crossovers
     
+    @timed('analysis_seconds', stage='profit_potential')
     def calculate_profit_potential(self, crossover_points):
         """計算利潤空間（天花板與交叉點距離）"""
         if not crossover_points:
@@ -236,7 +276,8 @@ class StockAnalyzer:
         
         return profit_analysis
     
-    def identify_gentle_uptrend(self, min_slope=0.1, max_slope=2.0, min_days=10):
+    @timed('analysis_seconds', stage='gentle_uptrend')
+    def identify_gentle_uptrend(self, min_slope=GENTLE_MIN_SLOPE, max_slope=GENTLE_MAX_SLOPE, min_days=GENTLE_MIN_DAYS):
         """識別緩坡爬升模式"""
         if self.data is None or 'Trend_Slope' not in self.data.columns:
             return []
@@ -264,6 +305,7 @@ class StockAnalyzer:
         
         return uptrend_periods
     
+    @timed('analysis_seconds', stage='signals')
     def generate_trading_signals(self):
         """生成交易信號（假設 analyze 已被調用）"""
         if self.data is None:
@@ -280,13 +322,27 @@ class StockAnalyzer:
             'profit_analysis': profit_potential
         }
     
-    def create_interactive_chart(self):
-        """創建互動式圖表（假設 analyze 已被調用）"""
+    @timed('analysis_seconds', stage='backtest')
+    def backtest(self, **kwargs):
+        """以黃藍線交叉信號實際模擬交易（下一根開盤成交、含手續費與證交稅），回傳 BacktestResult"""
+        if self.data is None or self.data.empty:
+            return None
+        from backtest import backtest_frame
+        return backtest_frame(self.data, self.symbol or "", **kwargs)
+    
+    @timed('analysis_seconds', stage='chart')
+    def create_interactive_chart(self, max_points=DEFAULT_MAX_POINTS):
+        """創建互動式圖表（假設 analyze 已被調用），超過 max_points 根K線時降採樣"""
         if self.data is None:
             return None
             
-        # 格式化日期為只顯示日期部分
-        formatted_dates = [date.strftime('%Y-%m-%d') for date in self.data.index]
+        import plotly.graph_objects as go
+        from plotly.subplots import make_subplots
+
+        # 依畫面解析度聚合K線（區段內保留最高/最低），指標取區段最後一筆
+        view, starts = aggregate_ohlc(self.data, max_points)
+        formatted_dates = axis_labels(view.index)
+        Line = line_trace_class(len(view))
         
         # 創建子圖
         fig = make_subplots(
@@ -299,89 +355,63 @@ class StockAnalyzer:
         # K線圖
         fig.add_trace(go.Candlestick(
             x=formatted_dates,
-            open=self.data['Open'],
-            high=self.data['High'],
-            low=self.data['Low'],
-            close=self.data['Close'],
+            open=view['Open'],
+            high=view['High'],
+            low=view['Low'],
+            close=view['Close'],
             name='K線',
             increasing_line_color='red',
             decreasing_line_color='green'
         ), row=1, col=1)
         
-        # 移動平均線
-        fig.add_trace(go.Scatter(
-            x=formatted_dates,
-            y=self.data['Yellow_Line'],
-            mode='lines',
-            name='黃線(EMA5)',
-            line=dict(color='yellow', width=2)
-        ), row=1, col=1)
-        
-        fig.add_trace(go.Scatter(
-            x=formatted_dates,
-            y=self.data['Blue_Line'],
-            mode='lines',
-            name='藍線(EMA20)',
-            line=dict(color='blue', width=2)
-        ), row=1, col=1)
-        
-        fig.add_trace(go.Scatter(
-            x=formatted_dates,
-            y=self.data['MA60'],
-            mode='lines',
-            name='EMA60',
-            line=dict(color='purple', width=1)
-        ), row=1, col=1)
-        
-        # 支撐阻力線
-        fig.add_trace(go.Scatter(
-            x=formatted_dates,
-            y=self.data['Support'],
-            mode='lines',
-            name='支撐線',
-            line=dict(color='green', width=1, dash='dash')
-        ), row=1, col=1)
-        
-        fig.add_trace(go.Scatter(
-            x=formatted_dates,
-            y=self.data['Resistance'],
-            mode='lines',
-            name='阻力線',
-            line=dict(color='red', width=1, dash='dash')
-        ), row=1, col=1)
+        # 移動平均線與支撐阻力線
+        line_specs = [
+            ('Yellow_Line', '黃線(EMA5)', dict(color='yellow', width=2)),
+            ('Blue_Line', '藍線(EMA20)', dict(color='blue', width=2)),
+            ('MA60', 'EMA60', dict(color='purple', width=1)),
+            ('Support', '支撐線', dict(color='green', width=1, dash='dash')),
+            ('Resistance', '阻力線', dict(color='red', width=1, dash='dash')),
+        ]
+        for column, name, line in line_specs:
+            fig.add_trace(Line(
+                x=formatted_dates,
+                y=view[column],
+                mode='lines',
+                name=name,
+                line=line
+            ), row=1, col=1)
         
         # 成交量
-        colors = ['red' if close > open else 'green'
-                 for close, open in zip(self.data['Close'], self.data['Open'])]
+        colors = np.where(view['Close'].to_numpy() > view['Open'].to_numpy(), 'red', 'green')
         
         fig.add_trace(go.Bar(
             x=formatted_dates,
-            y=self.data['Volume'],
+            y=view['Volume'],
             name='成交量',
             marker_color=colors
         ), row=2, col=1)
         
-        # 標記交叉點
+        # 標記交叉點（對應到所在的聚合區段）
         crossovers = self.find_crossover_points()
         if crossovers:
-            buy_dates = [c['date'].strftime('%Y-%m-%d') for c in crossovers if c['signal'] == 'BUY']
-            buy_prices = [c['price'] for c in crossovers if c['signal'] == 'BUY']
-            sell_dates = [c['date'].strftime('%Y-%m-%d') for c in crossovers if c['signal'] == 'SELL']
-            sell_prices = [c['price'] for c in crossovers if c['signal'] == 'SELL']
+            positions = self.data.index.get_indexer([c['date'] for c in crossovers])
+            buckets = np.searchsorted(starts, positions, side='right') - 1
+            is_buy = np.array([c['signal'] == 'BUY' for c in crossovers])
+            prices = np.array([c['price'] for c in crossovers])
             
-            if buy_dates:
+            if is_buy.any():
                 fig.add_trace(go.Scatter(
-                    x=buy_dates,
-                    y=buy_prices,
+                    x=formatted_dates[buckets[is_buy]],
+                    y=prices[is_buy],
                     mode='markers',
                     name='買入信號',
                     marker=dict(symbol='triangle-up', size=15, color='lime')
                 ), row=1, col=1)
             
-            if sell_dates:
+            if (~is_buy).any():
                 fig.add_trace(go.Scatter(
-                    x=sell_dates,
-                    y=sell_prices,
+                    x=formatted_dates[buckets[~is_buy]],
+                    y=prices[~is_buy],
                     mode='markers',
                     name='賣出信號',
                     marker=dict(symbol='triangle-down', size=15, color='red')
@@ -5,193 +5,399 @@
 支援多個數據源和錯誤處理
 """
 
-import yfinance as yf
 import pandas as pd
 import numpy as np
-import requests
+import threading
 import time
+import concurrent.futures
+from collections import namedtuple
 from datetime import datetime, timedelta
 import warnings
-from shioaji_extended import ShioajiExtended
+from metrics import inc, log, timed
+from source_router import DataSource, SourceRouter, backoff_delay
+from quota_scheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE
+from shioaji_extended import shioaji_code
+from trading_calendar import calendar_for, get_calendar, is_taiwan
 warnings.filterwarnings('ignore')
 
+# yfinance 日內資料限制：(單次請求最大天數, 可回溯天數)，略小於官方上限以保留餘裕
+YF_INTRADAY_LIMITS = {
+    "1m": (7, 29),
+    "2m": (59, 59), "5m": (59, 59), "15m": (59, 59), "30m": (59, 59), "90m": (59, 59),
+    "60m": (729, 729), "1h": (729, 729),
+}
+
+# 日內週期對應的 pandas 重採樣規則（由 Shioaji 1 分 K 合成）
+INTRADAY_RULES = {
+    "1m": "1min", "2m": "2min", "5m": "5min", "15m": "15min",
+    "30m": "30min", "60m": "60min", "90m": "90min", "1h": "60min",
+}
+
+# Shioaji kbars 每個並行視窗涵蓋的天數
+SHIOAJI_KBAR_WINDOW_DAYS = 30
+
+# 額外抓取的暖機交易日數，用於指標計算（日內 / 日K以上）
+INTRADAY_WARMUP_SESSIONS = 3
+DAILY_WARMUP_SESSIONS = 60
+# Shioaji 以 1 分 K 合成日K，僅用於不超過此天數的期間
+SHIOAJI_MAX_DAYS = 365
+
+# 正規化後保留的欄位（捨棄 Adj Close、Dividends、Stock Splits 等）
+OHLCV_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+PRICE_COLUMNS = ['Open', 'High', 'Low', 'Close']
+# 價格儲存型別：台股價格最多兩位小數，十萬元以下 float32 可精確還原到跳動單位
+PRICE_DTYPE = 'float32'
+VOLUME_DTYPE = 'int64'
+# price_dtype='ticks' 時價格以 0.01 元為單位的整數儲存
+PRICE_SCALE = 100
+
+
+def request_window(period="6mo", interval="1d", end=None, symbol=None):
+    """
+    請求的 (暖機開始, 請求開始, 結束) 時間，依該股票交易所的日曆計算：
+    請求開始為期間內的第一個交易日，暖機期間（只用於計算指標，分析後裁剪）往前推
+    INTRADAY_WARMUP_SESSIONS 或 DAILY_WARMUP_SESSIONS 個交易日。
+    結束時間以交易所時鐘計算（與 market_store 規劃缺口相同），回傳無時區的交易所當地時間。
+    """
+    calendar = calendar_for(symbol)
+    end = (calendar.localize(end) if end is not None else calendar.now()).tz_localize(None)
+    requested_start = calendar.period_start(period, end)
+    sessions = INTRADAY_WARMUP_SESSIONS if interval in INTRADAY_RULES else DAILY_WARMUP_SESSIONS
+    return calendar.warmup_start(requested_start, sessions), requested_start, end
+
+
+class FetchResult(namedtuple('FetchResult', [
+        'symbol', 'period', 'interval', 'data', 'requested_start', 'warmup_start', 'end', 'source', 'elapsed'])):
+    """
+    一次數據獲取的結果（不可變）：OHLCV、請求期間、暖機期間、數據源名稱與耗時秒數。
+    data 含暖機期間；同一個結果可被多個執行緒讀取，需要修改時請先複製。
+    """
+    __slots__ = ()
+
+    @property
+    def empty(self):
+        return self.data is None or self.data.empty
+
+    def trim(self, data=None):
+        """將 data（預設為本結果的數據）裁剪到請求開始之後"""
+        data = self.data if data is None else data
+        start = pd.Timestamp(self.requested_start)
+        if data.index.tz is not None and start.tz is None:
+            start = start.tz_localize(data.index.tz)
+        return data[data.index >= start]
+
+
+def split_date_windows(start, end, max_days, calendar=None):
+    """將 [start, end) 切成每段不超過 max_days 天的連續視窗；指定 calendar 時略過沒有交易日的視窗"""
+    windows = []
+    cursor = start
+    while cursor < end:
+        window_end = min(cursor + timedelta(days=max_days), end)
+        # 視窗結束時間不在午夜時，結束當日也在視窗內
+        if calendar is None or calendar.has_session(cursor, pd.Timestamp(window_end).ceil('D')):
+            windows.append((cursor, window_end))
+        cursor = window_end
+    return windows
+
+
+def normalize_ohlcv(data, price_dtype=PRICE_DTYPE):
+    """
+    將數據源回傳的 K 線整理為精簡格式：只保留 OHLCV，價格轉為 price_dtype，成交量轉為整數。
+    price_dtype='ticks' 時價格為 0.01 元單位的 int32（精確但需以 PRICE_SCALE 換算，適合儲存而非直接分析）。
+    """
+    if data is None or data.empty:
+        return data
+    columns = [column for column in OHLCV_COLUMNS if column in data.columns]
+    prices = [column for column in PRICE_COLUMNS if column in columns]
+    data = data[columns]
+    if price_dtype == 'ticks':
+        converted = {column: np.round(data[column].to_numpy(dtype='float64') * PRICE_SCALE).astype('int32')
+                     for column in prices}
+    else:
+        converted = {column: data[column].to_numpy(dtype=price_dtype) for column in prices}
+    if 'Volume' in columns:
+        converted['Volume'] = np.nan_to_num(data['Volume'].to_numpy(dtype='float64')).astype(VOLUME_DTYPE)
+    return pd.DataFrame(converted, index=data.index)[columns]
+
+
+def stitch_frames(frames):
+    """合併多個視窗的數據，依時間排序並移除重疊的重複K線"""
+    frames = [f for f in frames if f is not None and not f.empty]
+    if not frames:
+        return None
+    data = pd.concat(frames).sort_index()
+    return data[~data.index.duplicated(keep='last')]
+
+
+# Shioaji 連線在程序內共用，只嘗試建立一次
+_shioaji = {'attempted': False, 'client': None}
+_shioaji_lock = threading.Lock()
+
+
+def close_shared_shioaji():
+    """登出程序內共用的 Shioaji 連線（閘道客戶端只關閉連線，閘道本身保持登入）"""
+    with _shioaji_lock:
+        client, _shioaji['client'] = _shioaji['client'], None
+        _shioaji['attempted'] = False
+    if client is not None:
+        client.logout()
+
+
 class StockDataFetcher:
     def __init__(self):
+        import requests
+
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         })
-        self.shioaji_client = ShioajiExtended()
-        if not self.shioaji_client.connect():
-            print("⚠️ Shioaji API 連接失敗，將僅使用 yfinance 作為數據源")
-            self.shioaji_client = None
+        self._store = None
+        self._store_lock = threading.Lock()
+        # 日/週/月K的數據源，依延遲與健康狀態路由（健康統計為程序內共用）
+        self.router = SourceRouter([
+            DataSource('store', self._store_history, self._store_supports, prior_latency=0.01, retries=0),
+            DataSource('yfinance', self._yfinance_history, prior_latency=1.0, retries=2),
+            DataSource('shioaji', self._shioaji_history, self._shioaji_supports, prior_latency=1.5, retries=1),
+        ])
+
+    @property
+    def shioaji_client(self):
+        """Shioaji 連線在第一次需要台股數據時才建立（同一程序只嘗試一次）"""
+        if not _shioaji['attempted']:
+            with _shioaji_lock:
+                if not _shioaji['attempted']:
+                    _shioaji['client'] = self._connect_shioaji()
+                    _shioaji['attempted'] = True
+        return _shioaji['client']
+
+    def _connect_shioaji(self):
+        """優先使用本機 Shioaji 閘道共用登入，閘道未啟動時才自行登入"""
+        from shioaji_extended import ShioajiExtended
+        from shioaji_gateway import GatewayClient
+
+        gateway = GatewayClient.try_connect()
+        if gateway is not None:
+            log("🔌 已連接本機 Shioaji 閘道")
+            return gateway
+
+        client = ShioajiExtended()
+        if not client.connect():
+            log("⚠️ Shioaji API 連接失敗，將僅使用 yfinance 作為數據源", level="warning")
+            return None
+        return client
     
-    def fetch_data_yfinance(self, symbol, period="6mo", interval="1d", retry_count=3, buffer_days=90):
+    def _yfinance_history(self, symbol, period="6mo", interval="1d", warmup=True):
         """
-        使用yfinance獲取數據，包含重試機制和緩衝期。
-        buffer_days: 額外獲取的歷史數據天數，用於確保技術指標計算的準確性。
+        單次 yfinance 請求（失敗時拋出例外，沒有數據時回傳 None）。
+        warmup: 是否額外獲取暖機期間的數據，用於確保技術指標計算的準確性。
         """
-        # 將期間轉換為天數
-        period_map = {
-            "1d": 1, "5d": 5, "1mo": 30, "3mo": 90, "6mo": 180,
-            "1y": 365, "2y": 730, "5y": 1825, "max": 36500 # max設為一個很大的數
-        }
-        requested_days = period_map.get(period, 180)
-        
-        # 加上緩衝期
-        total_days = requested_days + buffer_days
-        
-        # yfinance 的 period 參數不接受天數，我們需要計算開始和結束日期
-        end_date = datetime.now()
-        start_date = end_date - timedelta(days=total_days)
-        
-        start_str = start_date.strftime('%Y-%m-%d')
-        end_str = end_date.strftime('%Y-%m-%d')
+        # 以交易日曆計算開始日期（yfinance 的 end 不含當日，因此取隔日）
+        warmup_start, requested_start, end_date = request_window(period, interval, symbol=symbol)
+        start_str = (warmup_start if warmup else requested_start).strftime('%Y-%m-%d')
+        end_str = (end_date + timedelta(days=1)).strftime('%Y-%m-%d')
+
+        log(f"嘗試獲取 {symbol} 數據從 {start_str} 到 {end_str} (含緩衝), interval={interval} ...")
+        import yfinance as yf
+        data = yf.Ticker(symbol).history(start=start_str, end=end_str, interval=interval)
+        if data.empty:
+            log(f"⚠️ {symbol} 返回空數據", level="warning")
+            return None
 
-        # 根據 yfinance 的限制調整 interval 和數據範圍
-        # ... (此處可保留原有的 intraday 週期限制檢查，但為簡化，暫時專注於日線)
+        log(f"✅ 成功獲取 {symbol} 擴展數據: {len(data)} 筆記錄")
+        inc('fetch_bars_total', len(data), source='yfinance')
+        return data
 
+    @timed('fetch_seconds', source='yfinance')
+    def fetch_data_yfinance(self, symbol, period="6mo", interval="1d", retry_count=3, warmup=True):
+        """使用yfinance獲取數據，失敗時以含抖動的指數退避重試"""
         for attempt in range(retry_count):
             try:
-                print(f"嘗試獲取 {symbol} 數據從 {start_str} 到 {end_str} (含緩衝), interval={interval} ... (第 {attempt + 1} 次)")
-                
-                ticker = yf.Ticker(symbol)
-                # 使用 start 和 end 來獲取擴展後的數據
-                data = ticker.history(start=start_str, end=end_str, interval=interval)
-                
-                if not data.empty:
-                    print(f"✅ 成功獲取 {symbol} 擴展數據: {len(data)} 筆記錄")
-                    
-                    # 儲存原始請求的開始日期，用於後續裁剪
-                    self.original_start_date = end_date - timedelta(days=requested_days)
-                    
+                data = self._yfinance_history(symbol, period, interval, warmup)
+                if data is not None:
                     return data
-                else:
-                    print(f"⚠️ {symbol} 返回空數據")
-                    
             except Exception as e:
-                print(f"❌ 第 {attempt + 1} 次嘗試失敗: {e}")
+                log(f"❌ 第 {attempt + 1} 次嘗試失敗: {e}", level="error")
+                inc('fetch_errors_total', source='yfinance')
                 if attempt < retry_count - 1:
-                    time.sleep(2)  # 等待2秒後重試
+                    time.sleep(backoff_delay(attempt))
         
         return None
 
-    def fetch_data_shioaji(self, symbol, period="6mo"):
+    def _shioaji_supports(self, symbol, period, interval):
+        """Shioaji 僅適用於台股（上市、上櫃）日K且期間不超過 SHIOAJI_MAX_DAYS（需已連線）"""
+        if not is_taiwan(symbol) or interval != "1d":
+            return False
+        _, requested_start, end_date = request_window(period, interval, symbol=symbol)
+        return ((end_date - requested_start).days <= SHIOAJI_MAX_DAYS
+                and self.shioaji_client is not None and self.shioaji_client.is_connected)
+
+    def _shioaji_history(self, symbol, period="6mo", interval="1d"):
+        """單次 Shioaji kbars 請求，1 分 K 合成為日K（失敗時拋出例外，沒有數據時回傳 None）"""
+        stock_code = shioaji_code(symbol)
+        start_date, _, end_date = request_window(period, interval, symbol=symbol)
+        start_str = start_date.strftime('%Y-%m-%d')
+        end_str = end_date.strftime('%Y-%m-%d')
+
+        log(f"嘗試從 Shioaji 獲取 {stock_code} 從 {start_str} 到 {end_str} 的數據...")
+        # 本機登入與閘道客戶端皆提供 get_kbars；日K可由 yfinance 取代，流量吃緊時最先讓路（回傳 None 改走下一個數據源）
+        data = self.shioaji_client.get_kbars(stock_code, start_str, end_str, priority=PRIORITY_BATCH, reroute=True)
+        if data is None or data.empty:
+            return None
+
+        log(f"✅ 成功從 Shioaji 獲取 {stock_code} 數據: {len(data)} 筆記錄")
+        inc('fetch_bars_total', len(data), source='shioaji')
+        if interval == "1d":
+            ohlc_dict = {'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last', 'Volume': 'sum'}
+            data = data.resample('1D').agg(ohlc_dict).dropna(subset=['Close'])
+        return data
+
+    @timed('fetch_seconds', source='shioaji')
+    def fetch_data_shioaji(self, symbol, period="6mo", interval="1d"):
         """使用 Shioaji API 的 kbars 方法獲取歷史 K 線數據"""
+        # 先判斷市場，非台股不需建立 Shioaji 連線
+        if not is_taiwan(symbol):
+            log(f"⚠️ {symbol} 非台股，跳過 Shioaji 數據源", level="warning")
+            return None
+
         if not self.shioaji_client or not self.shioaji_client.is_connected:
             return None
-        
-        api = self.shioaji_client.api
-        
-        # 移除 .TW 後綴
-        if symbol.endswith(".TW"):
-            stock_code = symbol[:-3]
-        else:
-            print(f"⚠️ {symbol} 非台股，跳過 Shioaji 數據源")
+
+        try:
+            return self._shioaji_history(symbol, period, interval)
+        except Exception as e:
+            log(f"❌ 從 Shioaji 獲取數據失敗: {e}", level="error")
+            inc('fetch_errors_total', source='shioaji')
             return None
 
-        # 將期間轉換為開始和結束日期
-        end_date = datetime.now()
-        period_map = {
-            "1d": 1, "5d": 5, "1mo": 30, "3mo": 90,
-            "6mo": 180, "1y": 365, "2y": 730, "5y": 1825, "max": 3650
-        }
-        days = period_map.get(period, 180)
-        start_date = end_date - timedelta(days=days)
-        
-        start_str = start_date.strftime('%Y-%m-%d')
-        end_str = end_date.strftime('%Y-%m-%d')
+    def _market_store(self):
+        """開啟（或重新讀取）本地市場儲存區，不存在時回傳 None"""
+        with self._store_lock:
+            if self._store is None:
+                from market_store import open_store
+                self._store = open_store()
+                return self._store
+            return self._store.refresh()
 
-        try:
-            print(f"嘗試從 Shioaji 獲取 {stock_code} 從 {start_str} 到 {end_str} 的數據...")
-            
-            # 獲取合約
-            contract = self._find_contract(api, stock_code)
-            if contract is None:
-                print(f"❌ 在 Shioaji 中找不到股票代碼: {stock_code}")
-                return None
-
-            # 使用 api.kbars 獲取數據
-            kbars = api.kbars(contract, start=start_str, end=end_str)
-            
-            if kbars:
-                data = pd.DataFrame({**kbars})
-                
-                # 轉換格式以符合 StockAnalyzer 的需求
-                data = data.rename(columns={
-                    'ts': 'Date',
-                    'Open': 'Open',
-                    'High': 'High',
-                    'Low': 'Low',
-                    'Close': 'Close',
-                    'Volume': 'Volume'
-                })
-                data['Date'] = pd.to_datetime(data['Date'])
-                data = data.set_index('Date')
-                
-                # 確保欄位完整
-                if all(col in data.columns for col in ['Open', 'High', 'Low', 'Close', 'Volume']):
-                    print(f"✅ 成功從 Shioaji 獲取 {stock_code} 數據: {len(data)} 筆記錄")
-                    return data
+    def _store_supports(self, symbol, period, interval):
+        """本地市場儲存區適用於日K，且須涵蓋請求期間並更新到最近一個交易日"""
+        if interval != "1d":
+            return False
+        store = self._market_store()
+        if store is None or symbol not in store or store.n_days == 0:
+            return False
+        # 該股票自己的最後交易日到最近一個已收盤的交易日之間沒有缺漏，且最早的日期涵蓋暖機期間
+        calendar = calendar_for(symbol)
+        last_date = store.symbol_last_date(symbol)
+        if last_date is None or calendar.session_count(last_date, calendar.last_close()) > 0:
+            return False
+        warmup_start, _, _ = request_window(period, interval, symbol=symbol)
+        return store.dates[0] <= np.datetime64(warmup_start, 'D')
 
+    def _store_history(self, symbol, period="6mo", interval="1d"):
+        """從本地市場儲存區讀取日K"""
+        warmup_start, _, _ = request_window(period, interval, symbol=symbol)
+        with self._store_lock:
+            data = self._store.frame(symbol, start=warmup_start)
+        if data is None or data.empty:
             return None
+        inc('fetch_bars_total', len(data), source='store')
+        return data
+
+    def fetch_data_intraday(self, symbol, period="6mo", interval="5m", max_workers=4):
+        """
+        獲取長期間的日內K線：依數據源限制切成最大視窗並行下載，再合併去重。
+        台股優先使用 Shioaji 1 分 K 合成指定週期，否則使用 yfinance（受可回溯天數限制）。
+        """
+        return self._intraday_history(symbol, period, interval, max_workers)[0]
+
+    @timed('fetch_seconds', source='intraday')
+    def _intraday_history(self, symbol, period="6mo", interval="5m", max_workers=4):
+        """回傳 (日內數據, 數據源名稱)；沒有數據時回傳 (None, None)"""
+        start_date, _, end_date = request_window(period, interval, symbol=symbol)
+
+        data, source = None, None
+        if is_taiwan(symbol) and self.shioaji_client and self.shioaji_client.is_connected:
+            data, source = self._fetch_intraday_shioaji(shioaji_code(symbol), start_date, end_date, interval, max_workers), 'shioaji'
+
+        if data is None or data.empty:
+            data, source = self._fetch_intraday_yfinance(symbol, start_date, end_date, interval, max_workers), 'yfinance'
+
+        if data is None or data.empty:
+            return None, None
+
+        inc('fetch_bars_total', len(data), source='intraday')
+        log(f"✅ 成功獲取 {symbol} {interval} 日內數據: {len(data)} 筆記錄 ({data.index[0]} ~ {data.index[-1]})")
+        return data, source
+
+    def _fetch_intraday_shioaji(self, stock_code, start_date, end_date, interval, max_workers):
+        """以 Shioaji 1 分 K 並行下載各視窗並重採樣為指定週期"""
+        windows = split_date_windows(start_date, end_date, SHIOAJI_KBAR_WINDOW_DAYS, get_calendar('TWSE'))
+        log(f"🌀 從 Shioaji 並行下載 {stock_code} 1 分K，共 {len(windows)} 個視窗...")
+
+        def fetch_window(window):
+            # kbars 的 start/end 皆為包含的日期：視窗結束於午夜時不含當日，否則（最後一個視窗結束於現在）包含當日
+            start, end = window
+            last_day = end - timedelta(days=1) if pd.Timestamp(end) == pd.Timestamp(end).normalize() else end
+            return self.shioaji_client.get_kbars(
+                stock_code, start.strftime('%Y-%m-%d'), last_day.strftime('%Y-%m-%d')
+            )
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                data = stitch_frames(list(executor.map(fetch_window, windows)))
         except Exception as e:
-            print(f"❌ 從 Shioaji 獲取數據失敗: {e}")
+            log(f"❌ 從 Shioaji 獲取日內數據失敗: {e}", level="error")
+            inc('fetch_errors_total', source='shioaji')
             return None
 
-    def _find_contract(self, api, stock_code):
-        """尋找股票合約"""
-        try:
-            if not hasattr(api.Contracts, 'Stocks'):
-                print("❌ 合約資訊未載入")
-                return None
-            
-            stocks = api.Contracts.Stocks
-            
-            # 方法1: 如果是字典結構
-            if isinstance(stocks, dict):
-                # 直接用股票代碼查找
-                if stock_code in stocks:
-                    return stocks[stock_code]
-                
-                # 遍歷查找
-                for key, contract in stocks.items():
-                    if hasattr(contract, 'code') and contract.code == stock_code:
-                        return contract
-                    if key == stock_code:
-                        return contract
-            
-            # 方法2: 如果有 __getitem__ 方法
-            elif hasattr(stocks, '__getitem__'):
+        if data is None or interval == "1m":
+            return data
+
+        # Shioaji 的 K 線時間為該分鐘的結束時間，因此以右側為標籤聚合
+        rule = INTRADAY_RULES[interval]
+        ohlc_dict = {'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last', 'Volume': 'sum'}
+        return data.resample(rule, closed='right', label='right').agg(ohlc_dict).dropna(subset=['Close'])
+
+    def _fetch_intraday_yfinance(self, symbol, start_date, end_date, interval, max_workers, retry_count=3):
+        """依 yfinance 日內限制切割視窗並行下載"""
+        max_window, max_lookback = YF_INTRADAY_LIMITS.get(interval, (59, 59))
+        earliest = end_date - timedelta(days=max_lookback)
+        if start_date < earliest:
+            log(f"⚠️ yfinance 的 {interval} 數據僅能回溯 {max_lookback} 天，起始日調整為 {earliest.strftime('%Y-%m-%d')}", level="warning")
+            start_date = earliest
+
+        windows = split_date_windows(start_date, end_date, max_window, calendar_for(symbol))
+        log(f"🌀 從 yfinance 並行下載 {symbol} {interval} 數據，共 {len(windows)} 個視窗...")
+
+        import yfinance as yf
+
+        def fetch_window(window):
+            start, end = window
+            for attempt in range(retry_count):
                 try:
-                    return stocks[stock_code]
-                except (KeyError, TypeError):
-                    pass
-            
-            # 方法3: 如果是可迭代的
-            elif hasattr(stocks, '__iter__'):
-                for contract in stocks:
-                    if hasattr(contract, 'code') and contract.code == stock_code:
-                        return contract
-            
-            print(f"💡 提示：嘗試使用 api.Contracts.Stocks.{stock_code}")
-            return getattr(stocks, stock_code, None)
-            
-        except Exception as e:
-            print(f"⚠️ 查找合約時發生錯誤: {e}")
+                    return yf.Ticker(symbol).history(start=start, end=end, interval=interval)
+                except Exception as e:
+                    log(f"❌ {symbol} {start.strftime('%Y-%m-%d')} 視窗第 {attempt + 1} 次嘗試失敗: {e}", level="error")
+                    inc('fetch_errors_total', source='yfinance')
+                    if attempt < retry_count - 1:
+                        time.sleep(backoff_delay(attempt))
             return None
 
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return stitch_frames(list(executor.map(fetch_window, windows)))
+
     def generate_sample_data(self, symbol, days=180):
         """生成示範數據（當無法獲取真實數據時使用）"""
-        print(f"🔧 為 {symbol} 生成示範數據...")
+        log(f"🔧 為 {symbol} 生成示範數據...")
         
         # 創建日期範圍
         end_date = datetime(2024, 8, 19) # 使用固定的過去日期以避免未來日期問題
         start_date = end_date - timedelta(days=days)
         dates = pd.date_range(start=start_date, end=end_date, freq='D')
+        n = len(dates)
         
-        # 模擬股價走勢
-        np.random.seed(42)  # 固定隨機種子以獲得一致的結果
+        # 每次呼叫使用獨立的亂數產生器（固定種子以獲得一致的結果，且不影響其他執行緒）
+        rng = np.random.default_rng(42)
         
         # 基礎價格（根據股票代碼設定）
         if '2330' in symbol:  # 台積電
@@ -203,107 +409,107 @@ class StockDataFetcher:
         else:
             base_price = 100
         
-        # 生成價格序列
-        returns = np.random.normal(0.001, 0.02, len(dates))  # 日報酬率
-        prices = [base_price]
-        
-        for i in range(1, len(dates)):
-            # 加入趨勢（緩慢上升）
-            trend = 0.0005 if i > len(dates) * 0.3 else 0
-            new_price = prices[-1] * (1 + returns[i] + trend)
-            prices.append(max(new_price, base_price * 0.7))  # 設定最低價格
+        # 生成價格序列：日報酬率加上緩慢上升趨勢，並設定最低價格
+        returns = rng.normal(0.001, 0.02, n)
+        trend = np.where(np.arange(n) > n * 0.3, 0.0005, 0)
+        growth = np.concatenate([[1.0], 1 + returns[1:] + trend[1:]])
+        close = np.maximum(base_price * np.cumprod(growth), base_price * 0.7)
         
-        # 創建OHLC數據
-        data = []
-        for i, (date, close) in enumerate(zip(dates, prices)):
-            # 生成開高低價
-            daily_range = close * 0.03  # 日內波動3%
-            high = close + np.random.uniform(0, daily_range)
-            low = close - np.random.uniform(0, daily_range)
-            open_price = low + np.random.uniform(0, high - low)
-            
-            # 生成成交量
-            volume = np.random.randint(1000000, 5000000)
-            
-            data.append({
-                'Open': round(open_price, 2),
-                'High': round(high, 2),
-                'Low': round(low, 2),
-                'Close': round(close, 2),
-                'Adj Close': round(close, 2),
-                'Volume': volume
-            })
+        # 生成開高低價（日內波動3%）與成交量
+        daily_range = close * 0.03
+        high = close + rng.uniform(0, 1, n) * daily_range
+        low = close - rng.uniform(0, 1, n) * daily_range
+        open_price = low + rng.uniform(0, 1, n) * (high - low)
+        volume = rng.integers(1000000, 5000000, n)
         
-        df = pd.DataFrame(data, index=dates)
+        df = pd.DataFrame({
+            'Open': np.round(open_price, 2),
+            'High': np.round(high, 2),
+            'Low': np.round(low, 2),
+            'Close': np.round(close, 2),
+            'Adj Close': np.round(close, 2),
+            'Volume': volume
+        }, index=dates)
         
         # 添加一些特殊模式
         self.add_golden_cross_pattern(df)
         self.add_uptrend_pattern(df)
         
-        print(f"✅ 示範數據生成完成: {len(df)} 筆記錄")
+        log(f"✅ 示範數據生成完成: {len(df)} 筆記錄")
         return df
     
+    @staticmethod
+    def _apply_ramp(df, start_frac, end_frac, step, low_factor):
+        """將 [start_frac, end_frac) 區間的價格乘上逐步遞增的倍數"""
+        start_idx = int(len(df) * start_frac)
+        end_idx = int(len(df) * end_frac)
+        if end_idx <= start_idx:
+            return
+        multiplier = 1 + np.arange(end_idx - start_idx) * step
+        rows = df.index[start_idx:end_idx]
+        for column in ('Close', 'High', 'Open'):
+            df.loc[rows, column] = df.loc[rows, column].to_numpy() * multiplier
+        df.loc[rows, 'Low'] = df.loc[rows, 'Low'].to_numpy() * multiplier * low_factor
+    
     def add_golden_cross_pattern(self, df):
         """在示範數據中添加黃金交叉模式"""
         # 在數據的後1/3部分添加明顯的上升趨勢
-        start_idx = int(len(df) * 0.6)
-        end_idx = int(len(df) * 0.9)
-        
-        if end_idx > start_idx:
-            for i in range(start_idx, end_idx):
-                # 逐步提高價格
-                multiplier = 1 + (i - start_idx) * 0.002
-                df.iloc[i, df.columns.get_loc('Close')] *= multiplier
-                df.iloc[i, df.columns.get_loc('High')] *= multiplier
-                df.iloc[i, df.columns.get_loc('Open')] *= multiplier
-                df.iloc[i, df.columns.get_loc('Low')] *= multiplier * 0.98
+        self._apply_ramp(df, 0.6, 0.9, 0.002, 0.98)
     
     def add_uptrend_pattern(self, df):
         """添加緩坡爬升模式"""
         # 在數據的中間部分添加穩定上升
-        start_idx = int(len(df) * 0.3)
-        end_idx = int(len(df) * 0.7)
-        
-        if end_idx > start_idx:
-            for i in range(start_idx, end_idx):
-                # 溫和上升
-                multiplier = 1 + (i - start_idx) * 0.0008
-                df.iloc[i, df.columns.get_loc('Close')] *= multiplier
-                df.iloc[i, df.columns.get_loc('High')] *= multiplier
-                df.iloc[i, df.columns.get_loc('Open')] *= multiplier
-                df.iloc[i, df.columns.get_loc('Low')] *= multiplier * 0.99
+        self._apply_ramp(df, 0.3, 0.7, 0.0008, 0.99)
     
-    def fetch_data(self, symbol, period="6mo", interval="1d", use_demo_data=False):
-        """主要的數據獲取方法，支援不同時間週期"""
-        if use_demo_data:
-            return self.generate_sample_data(symbol)
-
-        data = None
-        # 對於分鐘線數據，優先使用 yfinance
-        if interval in ["1mo", "1wk"]:
-            print("🌀 " + interval + " 優先使用 yfinance 獲取分鐘線數據...")
-            data = self.fetch_data_yfinance(symbol, period, interval)
+    def fetch(self, symbol, period="6mo", interval="1d", use_demo_data=False):
+        """
+        主要的數據獲取方法，支援不同時間週期；回傳 FetchResult（數據經 normalize_ohlcv 精簡，含暖機期間）。
+        不在獲取器上保存任何請求狀態，同一個獲取器可由多個執行緒同時使用。
+        """
+        start = time.perf_counter()
+        warmup_start, requested_start, end = request_window(period, interval, symbol=symbol)
+        data, source = None, None
+        if not use_demo_data:
+            # 分鐘線數據：依數據源限制分段並行下載
+            if interval in INTRADAY_RULES:
+                data, source = self._intraday_history(symbol, period, interval)
+            # 日/週/月K：送往最快且健康的數據源，失敗時自動改用下一個
+            else:
+                data, source = self.router.fetch(symbol, period, interval)
+                if data is not None:
+                    log(f"📡 {symbol} 數據來源: {source}")
 
-        # 如果不是分鐘線，或 yfinance 失敗，則走原有邏輯
-        if data is None or data.empty:
-            # 優先使用 Shioaji API (目前僅支援日線)
-            #if interval == "1m":
-            #    data = self.fetch_data_shioaji(symbol, period)
-            
-            # 如果 Shioaji 失敗或不適用，則嘗試 yfinance
+            # 如果所有真實數據源都失敗，則使用示範數據
             if data is None or data.empty:
-                print(f"⚠️ Shioaji 數據獲取失敗或不適用，嘗試使用 yfinance 作為備援...")
-                # 對於週線和月線，yfinance可以直接獲取
-                yfinance_interval = interval if interval in ["1wk", "1mo"] else "1d"
-                data = self.fetch_data_yfinance(symbol, period, yfinance_interval)
-        
-        # 如果所有真實數據源都失敗，則使用示範數據
+                log(f"⚠️ 無法獲取 {symbol} 的真實數據，將使用示範數據", level="warning")
+                log("💡 提示：示範數據包含了理想的技術分析模式，用於展示系統功能")
+                inc('fetch_fallback_total', source='demo')
+
         if data is None or data.empty:
-            print(f"⚠️ 無法獲取 {symbol} 的真實數據，將使用示範數據")
-            print("💡 提示：示範數據包含了理想的技術分析模式，用於展示系統功能")
-            return self.generate_sample_data(symbol)
-        
-        return data
+            data, source = self.generate_sample_data(symbol), 'demo'
+            # 示範數據使用固定日期且不含暖機期間，整段皆為請求期間
+            warmup_start = requested_start = data.index[0].to_pydatetime()
+            end = data.index[-1].to_pydatetime()
+
+        return FetchResult(symbol, period, interval, normalize_ohlcv(data), requested_start, warmup_start, end,
+                           source, time.perf_counter() - start)
+
+    def fetch_data(self, symbol, period="6mo", interval="1d", use_demo_data=False):
+        """只回傳 fetch() 的 OHLCV DataFrame（含暖機期間）"""
+        return self.fetch(symbol, period, interval, use_demo_data).data
+
+
+_shared_fetcher = None
+_shared_fetcher_lock = threading.Lock()
+
+
+def shared_fetcher():
+    """程序內共用的數據獲取器（獲取器不保存請求狀態，可安全地跨執行緒共用）"""
+    global _shared_fetcher
+    with _shared_fetcher_lock:
+        if _shared_fetcher is None:
+            _shared_fetcher = StockDataFetcher()
+        return _shared_fetcher
 
 # 測試函數
 def test_data_fetcher():
@@ -1,107 +1,165 @@
 import pandas as pd
 import numpy as np
-from stock_analyzer import StockAnalyzer
+from adaptive_concurrency import limits_report, pool_size
+from analysis_cache import get_analysis
+from chart_utils import DEFAULT_MAX_POINTS, lttb_indices, line_trace_class
+from metrics import log, timed
+from trading_calendar import calendar_for
 import concurrent.futures
 import time
 
+# 台股熱門股票代碼（範例）
+DEFAULT_STOCK_LIST = [
+    '2330.TW',  # 台積電
+    '2454.TW',  # 聯發科
+    '2317.TW',  # 鴻海
+    '2382.TW',  # 廣達
+    '3711.TW',  # 日月光投控
+    '2408.TW',  # 南亞科
+    '2881.TW',  # 富邦金
+    '2882.TW',  # 國泰金
+    '2412.TW',  # 中華電
+    '1301.TW',  # 台塑
+    '1303.TW',  # 南亞
+    '2207.TW',  # 和泰車
+    '2303.TW',  # 聯電
+    '3008.TW',  # 大立光
+    '6505.TW',  # 台塑化
+]
+
+# 評分各項目的滿分（合計 100），可由 walk_forward 最佳化後傳入 StockScreener(weights=...)
+SCORE_WEIGHTS = {
+    'uptrend': 30,     # 緩坡爬升趨勢
+    'crossover': 25,   # 近期黃金交叉
+    'profit': 25,      # 利潤空間
+    'technical': 20,   # 技術指標
+}
+
+# 排序依據：評分，或利潤空間信賴區間下界
+RANK_KEYS = ('score', 'profit_lower')
+
+# 「近期」的交易日數（約一個月、三週）：趨勢結束與黃金交叉距最後一根K線的交易日數
+RECENT_UPTREND_SESSIONS = 21
+RECENT_CROSS_SESSIONS = 14
+
 class StockScreener:
-    def __init__(self):
+    def __init__(self, weights=None, confidence=None, store=None):
+        """
+        confidence: 設定時（例如 0.9）以區塊自助法估計利潤空間的信賴區間，
+        評分的利潤空間項目改用下界，避免單次暴漲主導評分
+        store: MarketStore，已在儲存區的股票直接讀取本地日K
+        """
         self.stock_list = []
         self.results = []
+        self.weights = {**SCORE_WEIGHTS, **(weights or {})}
+        self.confidence = confidence
+        self.store = store
         
     def load_stock_list(self, stocks=None):
-        """載入股票清單"""
+        """載入股票清單（未指定時使用儲存區內的全部股票，沒有儲存區則用預設清單）"""
         if stocks is None:
-            # 台股熱門股票代碼（範例）
-            self.stock_list = [
-                '2330.TW',  # 台積電
-                '2454.TW',  # 聯發科
-                '2317.TW',  # 鴻海
-                '2382.TW',  # 廣達
-                '3711.TW',  # 日月光投控
-                '2408.TW',  # 南亞科
-                '2881.TW',  # 富邦金
-                '2882.TW',  # 國泰金
-                '2412.TW',  # 中華電
-                '1301.TW',  # 台塑
-                '1303.TW',  # 南亞
-                '2207.TW',  # 和泰車
-                '2303.TW',  # 聯電
-                '3008.TW',  # 大立光
-                '6505.TW',  # 台塑化
-            ]
+            self.stock_list = list(self.store.symbols if self.store is not None else DEFAULT_STOCK_LIST)
         else:
             self.stock_list = stocks
             
+    @timed('screen_symbol_seconds')
     def analyze_single_stock(self, symbol):
         """分析單一股票"""
         try:
-            analyzer = StockAnalyzer()
-            if analyzer.fetch_data(symbol, period="6mo"):  # 6個月數據
-                signals = analyzer.generate_trading_signals()
+            if self.store is not None and symbol in self.store:
+                from market_store import analyze_from_store
+                result = analyze_from_store(self.store, symbol, period="6mo")
+            else:
+                result = get_analysis(symbol, period="6mo")  # 6個月數據，優先使用共用快取
+            if result:
+                analyzer = result['analyzer']
+                signals = result['signals']
+                
+                profit_ci = None
+                if self.confidence:
+                    from bootstrap import profit_potential_ci
+                    profit_ci = profit_potential_ci(analyzer.data, confidence=self.confidence)
                 
                 # 評估股票品質
-                score = self.calculate_stock_score(analyzer, signals)
+                score = self.calculate_stock_score(analyzer, signals, profit_ci)
                 
                 return {
                     'symbol': symbol,
-                    'current_price': analyzer.data['Close'][-1],
+                    'current_price': analyzer.data['Close'].iloc[-1],
                     'signals': signals,
                     'score': score,
+                    'profit_ci': profit_ci,
                     'analyzer': analyzer
                 }
         except Exception as e:
             print(f"分析 {symbol} 時發生錯誤: {e}")
             return None
     
-    def calculate_stock_score(self, analyzer, signals):
-        """計算股票評分（0-100分）"""
+    @timed('scoring_seconds')
+    def calculate_stock_score(self, analyzer, signals, profit_ci=None):
+        """計算股票評分（0-100分），各項目滿分依 self.weights；傳入 profit_ci 時利潤空間以信賴區間下界計分"""
+        w = self.weights
         score = 0
+        calendar = calendar_for(analyzer.symbol)
+        last = analyzer.data.index[-1]
         
-        # 1. 緩坡爬升趨勢評分（30分）
+        # 1. 緩坡爬升趨勢評分（預設30分）
         if signals['uptrends']:
             recent_trends = [t for t in signals['uptrends'] 
-                           if (analyzer.data.index[-1] - t['end_date']).days <= 30]
+                           if calendar.session_count(t['end_date'], last) <= RECENT_UPTREND_SESSIONS]
             if recent_trends:
                 avg_slope = np.mean([t['avg_slope'] for t in recent_trends])
-                score += min(30, avg_slope * 15)  # 斜率越大分數越高
+                score += w['uptrend'] * min(1, avg_slope * 0.5)  # 斜率越大分數越高
         
-        # 2. 黃金交叉評分（25分）
+        # 2. 黃金交叉評分（預設25分）
         if signals['crossovers']:
             recent_crosses = [c for c in signals['crossovers'] 
                             if c['signal'] == 'BUY' and 
-                            (analyzer.data.index[-1] - c['date']).days <= 20]
+                            calendar.session_count(c['date'], last) <= RECENT_CROSS_SESSIONS]
             if recent_crosses:
-                score += 25
+                score += w['crossover']
         
-        # 3. 利潤空間評分（25分）
-        if signals['profit_analysis']:
+        # 3. 利潤空間評分（預設25分）
+        if profit_ci is not None:
+            if np.isfinite(profit_ci['lower']):
+                score += w['profit'] * min(1, max(0, profit_ci['lower']) / 50)
+        elif signals['profit_analysis']:
             avg_profit = np.mean([p['profit_potential'] for p in signals['profit_analysis']])
-            score += min(25, avg_profit / 2)  # 利潤空間越大分數越高
+            score += w['profit'] * min(1, avg_profit / 50)  # 利潤空間越大分數越高
         
-        # 4. 技術指標評分（20分）
+        # 4. 技術指標評分（預設20分，四項各佔四分之一）
         current_data = analyzer.data.iloc[-1]
+        technical = 0
         
         # 價格在均線之上
         if current_data['Close'] > current_data['Yellow_Line']:
-            score += 5
+            technical += 1
         if current_data['Close'] > current_data['Blue_Line']:
-            score += 5
+            technical += 1
         if current_data['Close'] > current_data['MA60']:
-            score += 5
+            technical += 1
             
         # 均線排列
         if (current_data['Yellow_Line'] > current_data['Blue_Line'] > current_data['MA60']):
-            score += 5
+            technical += 1
+        score += w['technical'] * technical / 4
         
         return min(100, score)
     
-    def screen_stocks(self, min_score=60, max_workers=5):
-        """篩選股票"""
+    @timed('screen_run_seconds')
+    def screen_stocks(self, min_score=60, max_workers=None, rank_by='score'):
+        """
+        篩選股票；rank_by='profit_lower' 時依利潤空間信賴區間下界排序（需設定 confidence）。
+        實際同時進行的數據請求數由各數據源的自適應併發上限決定，max_workers 只是執行緒數的上限。
+        """
+        if rank_by not in RANK_KEYS:
+            raise ValueError(f"不支援的排序依據: {rank_by}")
+        if rank_by == 'profit_lower' and not self.confidence:
+            raise ValueError("依信賴區間下界排序需設定 confidence")
         print(f"開始篩選 {len(self.stock_list)} 檔股票...")
         
         results = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or pool_size()) as executor:
             # 提交所有任務
             future_to_symbol = {
                 executor.submit(self.analyze_single_stock, symbol): symbol 
@@ -120,9 +178,16 @@ class StockScreener:
                         print(f"✗ {symbol}: 評分過低或分析失敗")
                 except Exception as e:
                     print(f"✗ {symbol}: 處理錯誤 - {e}")
+
+        limits = ", ".join(f"{name} {stats['limit']:.1f}/{stats['max_limit']}" for name, stats in limits_report().items())
+        if limits:
+            log(f"📶 數據源併發上限: {limits}")
         
-        # 按評分排序
-        results.sort(key=lambda x: x['score'], reverse=True)
+        # 按評分（或利潤空間下界）排序
+        if rank_by == 'profit_lower':
+            results.sort(key=lambda x: np.nan_to_num(x['profit_ci']['lower'], nan=-np.inf), reverse=True)
+        else:
+            results.sort(key=lambda x: x['score'], reverse=True)
         self.results = results
         
         return results
@@ -145,15 +210,20 @@ class StockScreener:
             # 生成特徵描述
             features = []
             if result['signals']['crossovers']:
+                calendar = calendar_for(symbol)
+                last_close = calendar.last_close()
                 recent_crosses = [c for c in result['signals']['crossovers'] 
-                                if (pd.Timestamp.now() - c['date']).days <= 30]
+                                if calendar.session_count(c['date'], last_close) <= RECENT_UPTREND_SESSIONS]
                 if recent_crosses:
                     features.append("近期黃金交叉")
             
             if result['signals']['uptrends']:
                 features.append("緩坡上升")
                 
-            if result['signals']['profit_analysis']:
+            if result.get('profit_ci') and np.isfinite(result['profit_ci']['lower']):
+                ci = result['profit_ci']
+                features.append(f"利潤空間{ci['confidence'] * 100:.0f}%區間({ci['lower']:.1f}%~{ci['upper']:.1f}%)")
+            elif result['signals']['profit_analysis']:
                 avg_profit = np.mean([p['profit_potential'] 
                                     for p in result['signals']['profit_analysis']])
                 if avg_profit > 10:
@@ -177,8 +247,8 @@ class StockScreener:
         
         return analyzer
     
-    def create_comparison_chart(self, top_n=5):
-        """創建前N名股票的比較圖表"""
+    def create_comparison_chart(self, top_n=5, max_points=DEFAULT_MAX_POINTS):
+        """創建前N名股票的比較圖表（每檔最多 max_points 個點）"""
         if not self.results:
             print("沒有結果可以比較")
             return None
@@ -200,31 +270,33 @@ class StockScreener:
             analyzer = stock['analyzer']
             data = analyzer.data
             
-            # 格式化日期為只顯示日期部分
-            formatted_dates = [date.strftime('%Y-%m-%d') for date in data.index]
+            # 以 LTTB 依收盤價形狀挑選保留點，黃藍線使用相同的點以對齊
+            keep = lttb_indices(data['Close'].to_numpy(), max_points)
+            dates = data.index[keep]
+            Line = line_trace_class(len(keep))
             
             # 添加價格線
-            fig.add_trace(go.Scatter(
-                x=formatted_dates,
-                y=data['Close'],
+            fig.add_trace(Line(
+                x=dates,
+                y=data['Close'].to_numpy()[keep],
                 mode='lines',
                 name=f"{stock['symbol']} 收盤價",
                 line=dict(width=2)
             ), row=i, col=1)
             
             # 添加黃藍線
-            fig.add_trace(go.Scatter(
-                x=formatted_dates,
-                y=data['Yellow_Line'],
+            fig.add_trace(Line(
+                x=dates,
+                y=data['Yellow_Line'].to_numpy()[keep],
                 mode='lines',
                 name='黃線',
                 line=dict(color='yellow', width=1),
                 showlegend=(i==1)
             ), row=i, col=1)
             
-            fig.add_trace(go.Scatter(
-                x=formatted_dates,
-                y=data['Blue_Line'],
+            fig.add_trace(Line(
+                x=dates,
+                y=data['Blue_Line'].to_numpy()[keep],
                 mode='lines',
                 name='藍線',
                 line=dict(color='blue', width=1),
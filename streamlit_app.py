@@ -2,12 +2,27 @@ import streamlit as st
 import plotly.graph_objects as go
 import pandas as pd
 import numpy as np
-from stock_analyzer import StockAnalyzer
 from stock_screener import StockScreener
+from analysis_cache import get_analysis, get_analysis_cache
+from batch_analysis import analyze_batch, comparison_table, normalized_prices
+from market_store import open_store
+from trading_calendar import calendar_for
+from prewarm import start_background_prewarm
+import functools
+import os
 import time
 from shioaji_extended import ShioajiExtended
-from shioaji import TickSTKv1, Exchange
-import threading
+from shioaji_gateway import GatewayClient
+from live_ticks import LiveTickBuffer, MinuteBarAggregator
+import metrics
+
+# 即時頁面的刷新間隔範圍（秒）
+LIVE_MIN_REFRESH = 0.5
+LIVE_MAX_REFRESH = 5.0
+# 即時頁面每輪更新的最長秒數，之後以 st.rerun() 重新執行腳本（讓停止訂閱、切換頁面與關閉的工作階段能及時結束）
+LIVE_RERUN_SECONDS = 60
+# 交易建議只參考最近幾個交易日內的交叉信號
+RECENT_SIGNAL_SESSIONS = 7
 
 # 設置頁面配置
 st.set_page_config(
@@ -17,6 +32,14 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# 啟用時在伺服器程序內執行盤前預熱排程（整個程序只會啟動一次）
+if os.environ.get("PREWARM_ENABLED") == "1":
+    start_background_prewarm()
+
+# 設定 METRICS_PORT 時提供 Prometheus 指標端點
+if os.environ.get("METRICS_PORT"):
+    metrics.start_http_server(int(os.environ["METRICS_PORT"]))
+
 # 自定義CSS樣式
 st.markdown("""
 <style>
@@ -63,6 +86,9 @@ app_mode = st.sidebar.selectbox(
     ["個股分析", "當日即時分析", "股票篩選器", "批量比較", "關於系統"]
 )
 
+# 即時頁面的更新迴圈，於側邊欄繪製完成後才執行
+live_loop = None
+
 if app_mode == "個股分析":
     st.header("📊 個股技術分析")
     col1, col2, col3, col4 = st.columns([2, 1, 1, 1])
@@ -93,31 +119,28 @@ if app_mode == "個股分析":
     with col4:
         resample_to = st.selectbox(
             "轉換為",
-            ["(不轉換)", "1d", "1wk", "1mo"],
-            index=1,
-            help="將獲取的數據轉換為指定的K線週期"
+            ["(不轉換)", "5m", "15m", "60m", "1d", "1wk", "1mo"],
+            index=4,
+            help="將獲取的數據依交易時段轉換為指定的K線週期（同一數據的各週期共用快取，切換不需重新下載）"
         )
     
     if st.button("🔍 開始分析", type="primary"):
         if symbol:
             with st.spinner("正在獲取數據並進行分析..."):
-                analyzer = StockAnalyzer()
+                # 從共用快取取得分析結果（未命中時才獲取數據、重採樣並計算指標與信號）
+                result = get_analysis(
+                    symbol, period=period, interval=interval,
+                    resample_to=None if resample_to == "(不轉換)" else resample_to
+                )
                 
-                if analyzer.fetch_data(symbol, period=period, interval=interval):
-                    # 如果使用者選擇了轉換週期，則執行重採樣
-                    if resample_to != "(不轉換)":
-                        analyzer.resample_data(resample_to)
-
-                    # 執行分析 (這一步會計算所有指標)
-                    analyzer.analyze()
-                    
-                    # 生成交易信號
-                    signals = analyzer.generate_trading_signals()
+                if result:
+                    analyzer = result['analyzer']
+                    signals = result['signals']
                     
                     # 顯示基本信息
-                    current_price = analyzer.data['Close'][-1]
-                    price_change = analyzer.data['Close'][-1] - analyzer.data['Close'][-2]
-                    price_change_pct = (price_change / analyzer.data['Close'][-2]) * 100
+                    current_price = analyzer.data['Close'].iloc[-1]
+                    price_change = analyzer.data['Close'].iloc[-1] - analyzer.data['Close'].iloc[-2]
+                    price_change_pct = (price_change / analyzer.data['Close'].iloc[-2]) * 100
                     
                     col1, col2, col3, col4 = st.columns(4)
                     
@@ -211,8 +234,9 @@ if app_mode == "個股分析":
                     
                     # 交易建議
                     st.subheader("💡 交易建議")
+                    calendar = calendar_for(analyzer.symbol)
                     recent_crossovers = [c for c in signals['crossovers'] 
-                                       if (analyzer.data.index[-1] - c['date']).days <= 10]
+                                       if calendar.session_count(c['date'], analyzer.data.index[-1]) <= RECENT_SIGNAL_SESSIONS]
                     
                     if recent_crossovers:
                         latest_signal = recent_crossovers[-1]
@@ -244,19 +268,27 @@ elif app_mode == "當日即時分析":
     # --- 狀態初始化 ---
     if 'shioaji_client' not in st.session_state:
         st.session_state.shioaji_client = None
-    if 'tick_data' not in st.session_state:
-        st.session_state.tick_data = []
+    if 'tick_buffer' not in st.session_state:
+        st.session_state.tick_buffer = LiveTickBuffer()
     if 'subscribed_stock' not in st.session_state:
         st.session_state.subscribed_stock = None
-    if 'lock' not in st.session_state:
-        st.session_state.lock = threading.Lock()
+    if 'callback_registered' not in st.session_state:
+        st.session_state.callback_registered = False
+    if 'tick_stream' not in st.session_state:
+        st.session_state.tick_stream = None
 
-    # --- 連接 API ---
+    # --- 連接 API（優先經由本機閘道共用登入，閘道未啟動時才自行登入）---
     if st.session_state.shioaji_client is None:
         with st.spinner("正在連接 Shioaji API..."):
+            client = GatewayClient.try_connect()
+            if client is not None:
+                st.session_state.shioaji_client = client
+                st.success("已連接本機 Shioaji 閘道！")
+                st.rerun()
             client = ShioajiExtended()
             if client.connect():
                 st.session_state.shioaji_client = client
+                st.session_state.callback_registered = False
                 client.api.usage()
                 st.success("Shioaji API 連接成功！")
                 st.rerun()
@@ -264,24 +296,19 @@ elif app_mode == "當日即時分析":
                 st.error("Shioaji API 連接失敗，請檢查 .env 設定檔。")
                 st.stop()
     
-    api = st.session_state.shioaji_client.api
-
-    # --- 定義 Callback 函數 ---
-    def quote_callback(exchange: Exchange, tick: TickSTKv1):
-        with st.session_state.lock:
-            # 確保 tick_data 是最新的
-            if len(st.session_state.tick_data) > 500: # 最多保留最近500筆
-                st.session_state.tick_data.pop(0)
-            
-            st.session_state.tick_data.append({
-                '時間': pd.to_datetime(tick.ts, unit='ns').strftime('%H:%M:%S.%f')[:-3],
-                '價格': tick.close,
-                '成交量': tick.volume,
-                '買賣別': '買盤' if tick.tick_type == 1 else '賣盤' if tick.tick_type == -1 else '中性'
-            })
+    client = st.session_state.shioaji_client
+    via_gateway = isinstance(client, GatewayClient)
+    tick_buffer = st.session_state.tick_buffer
 
-    #api.set_on_tick_stk_v1(quote_callback)
-    api.quote.set_on_tick_stk_v1_callback(quote_callback)
+    # --- 註冊 Callback（自行登入時每個連線只註冊一次，回呼直接寫入緩衝區，不經過 session_state）---
+    if not via_gateway and not st.session_state.callback_registered:
+        client.api.quote.set_on_tick_stk_v1_callback(tick_buffer.on_tick)
+        st.session_state.callback_registered = True
+
+    def pump_ticks():
+        """經由閘道訂閱時，將共享記憶體中的新逐筆資料搬入緩衝區"""
+        if st.session_state.tick_stream is not None:
+            tick_buffer.extend(st.session_state.tick_stream.poll())
 
     # --- UI 介面 ---
     stock_code = st.text_input("輸入股票代碼 (例: 2330)", value=st.session_state.get("subscribed_stock", "2330"))
@@ -293,64 +320,98 @@ elif app_mode == "當日即時分析":
         if st.button("🚀 開始訂閱", disabled=is_subscribed, type="primary"):
             if stock_code:
                 with st.spinner(f"正在訂閱 {stock_code}..."):
-                    with st.session_state.lock:
-                        st.session_state.tick_data.clear()
+                    tick_buffer.clear()
                     
                     st.session_state.subscribed_stock = stock_code
-                    contract = api.Contracts.Stocks[stock_code]
-                    api.quote.subscribe(contract, quote_type='tick', version='v1')
+                    if via_gateway:
+                        st.session_state.tick_stream = client.subscribe_ticks(stock_code)
+                    else:
+                        contract = client.api.Contracts.Stocks[stock_code]
+                        client.api.quote.subscribe(contract, quote_type='tick', version='v1')
                     st.rerun()
 
     with col2:
         if st.button("🛑 停止訂閱", disabled=not is_subscribed):
             if st.session_state.subscribed_stock:
                 with st.spinner(f"正在取消訂閱 {st.session_state.subscribed_stock}..."):
-                    contract = api.Contracts.Stocks[st.session_state.subscribed_stock]
-                    api.quote.unsubscribe(contract, quote_type='tick')
-                    st.session_state.shioaji_client.logout()
+                    if st.session_state.tick_stream is not None:
+                        st.session_state.tick_stream.close()
+                        st.session_state.tick_stream = None
+                    else:
+                        contract = client.api.Contracts.Stocks[st.session_state.subscribed_stock]
+                        client.api.quote.unsubscribe(contract, quote_type='tick')
+                    # 閘道客戶端只關閉連線，閘道本身保持登入
+                    client.logout()
                     st.session_state.shioaji_client = None
                     st.session_state.subscribed_stock = None
                     st.success("已成功登出並斷開連接。")
                     time.sleep(1) # 短暫延遲讓使用者看到訊息
                     st.rerun()
 
-    # --- 顯示即時數據與自動刷新 ---
+    # --- 顯示即時數據與增量更新 ---
     if st.session_state.subscribed_stock:
-        st.success(f"已訂閱 {st.session_state.subscribed_stock} 的即時 Tick 資訊。每秒自動更新...")
-        
-        placeholder = st.empty()
-
-        with st.session_state.lock:
-            df = pd.DataFrame(st.session_state.tick_data)
-
-        if not df.empty:
-            # 顯示指標
-            latest_price = df['價格'].iloc[-1]
-            high_price = df['價格'].max()
-            low_price = df['價格'].min()
-            total_volume = df['成交量'].sum()
-
-            c1, c2, c3, c4 = st.columns(4)
-            c1.metric("最新價格", f"{latest_price:.2f}")
-            c2.metric("今日最高", f"{high_price:.2f}")
-            c3.metric("今日最低", f"{low_price:.2f}")
-            c4.metric("總成交量", f"{total_volume:,}")
-
-            # 顯示圖表和表格
-            with placeholder.container():
-                st.subheader("價格走勢")
-                fig = go.Figure()
-                fig.add_trace(go.Scatter(x=df['時間'], y=df['價格'], mode='lines', name='價格'))
-                fig.update_layout(height=400, margin=dict(l=20, r=20, t=30, b=20))
-                st.plotly_chart(fig, use_container_width=True)
+        st.success(f"已訂閱 {st.session_state.subscribed_stock} 的即時 Tick 資訊，有新成交時自動更新...")
 
-                st.subheader("最新逐筆交易 (最近20筆)")
-                st.dataframe(df.tail(20).iloc[::-1], use_container_width=True) # 反轉順序，最新在最上面
-        else:
-            st.info("正在等待接收第一筆資料...")
+        c1, c2, c3, c4 = st.columns(4)
+        metric_slots = [c1.empty(), c2.empty(), c3.empty(), c4.empty()]
+        waiting = st.empty()
+
+        # 首次繪製時送出目前緩衝區內容，之後只以 add_rows 送出新增的逐筆與K線
+        pump_ticks()
+        ticks, cursor = tick_buffer.since(0)
+        aggregator = MinuteBarAggregator()
+        bars = aggregator.update(ticks)
+
+        st.subheader("價格走勢")
+        price_chart = st.line_chart(ticks[['價格']], height=400)
+
+        st.subheader("每分鐘成交量")
+        volume_chart = st.bar_chart(bars[['成交量']], height=200)
 
-        time.sleep(1)
-        st.rerun()
+        st.subheader("最新逐筆交易 (最近20筆)")
+        table_slot = st.empty()
+        recent = ticks.tail(20)
+
+        def render_summary(recent_ticks):
+            if tick_buffer.latest is None:
+                waiting.info("正在等待接收第一筆資料...")
+                return
+            waiting.empty()
+            metric_slots[0].metric("最新價格", f"{tick_buffer.latest:.2f}")
+            metric_slots[1].metric("今日最高", f"{tick_buffer.high:.2f}")
+            metric_slots[2].metric("今日最低", f"{tick_buffer.low:.2f}")
+            metric_slots[3].metric("總成交量", f"{tick_buffer.total_volume:,}")
+            table = recent_ticks.iloc[::-1].reset_index()  # 反轉順序，最新在最上面
+            table['時間'] = table['時間'].dt.strftime('%H:%M:%S.%f').str[:-3]
+            table_slot.dataframe(table, use_container_width=True)
+
+        render_summary(recent)
+        status = st.empty()
+
+        def live_updates(cursor, recent):
+            """自適應刷新：有新成交時縮短間隔，沒有時逐步放慢；最多執行 LIVE_RERUN_SECONDS 秒後重新執行腳本"""
+            refresh_interval = LIVE_MIN_REFRESH
+            deadline = time.monotonic() + LIVE_RERUN_SECONDS
+            while time.monotonic() < deadline:
+                time.sleep(refresh_interval)
+                pump_ticks()
+                new_ticks, cursor = tick_buffer.since(cursor)
+                # 每輪都更新一次頁面元素，Streamlit 才能在此處送達停止或重新執行的請求
+                status.caption(f"最後檢查: {time.strftime('%H:%M:%S')}")
+                if new_ticks.empty:
+                    refresh_interval = min(refresh_interval * 1.5, LIVE_MAX_REFRESH)
+                    continue
+
+                refresh_interval = LIVE_MIN_REFRESH
+                price_chart.add_rows(new_ticks[['價格']])
+                new_bars = aggregator.update(new_ticks)
+                if not new_bars.empty:
+                    volume_chart.add_rows(new_bars[['成交量']])
+                recent = pd.concat([recent, new_ticks]).tail(20)
+                render_summary(recent)
+            st.rerun()
+
+        live_loop = functools.partial(live_updates, cursor, recent)
 
 elif app_mode == "股票篩選器":
     st.header("🔍 智能股票篩選器")
@@ -360,6 +421,13 @@ elif app_mode == "股票篩選器":
     with col1:
         st.subheader("篩選條件")
         min_score = st.slider("最低評分", 0, 100, 60, help="設定股票評分的最低門檻")
+        use_confidence = st.checkbox("以利潤空間信賴區間下界評分與排序",
+                                     help="區塊自助法估計 90% 信賴區間，避免單次暴漲主導評分")
+        store = open_store()
+        use_store = False
+        if store is not None and store.n_days:
+            use_store = st.checkbox(f"使用本地市場儲存區（{len(store)} 檔，至 {store.last_date.strftime('%Y-%m-%d')}）",
+                                    value=True, help="未使用自定義清單時篩選儲存區內的全部股票")
         
     with col2:
         st.subheader("股票池")
@@ -377,14 +445,16 @@ elif app_mode == "股票篩選器":
     
     if st.button("🚀 開始篩選", type="primary"):
         with st.spinner("正在篩選股票，請稍候..."):
-            screener = StockScreener()
+            screener = StockScreener(confidence=0.9 if use_confidence else None,
+                                     store=store if use_store else None)
             screener.load_stock_list(stock_list)
             
             # 顯示進度
             progress_bar = st.progress(0)
             status_text = st.empty()
             
-            results = screener.screen_stocks(min_score=min_score)
+            results = screener.screen_stocks(min_score=min_score,
+                                             rank_by='profit_lower' if use_confidence else 'score')
             
             progress_bar.progress(100)
             status_text.text(f"篩選完成！找到 {len(results)} 檔符合條件的股票")
@@ -403,6 +473,8 @@ elif app_mode == "股票篩選器":
                         '交叉點': len(result['signals']['crossovers']),
                         '上升趨勢': len(result['signals']['uptrends'])
                     })
+                    if result.get('profit_ci'):
+                        result_data[-1]['利潤空間下界%'] = f"{result['profit_ci']['lower']:.1f}"
                 
                 result_df = pd.DataFrame(result_data)
                 st.dataframe(result_df, use_container_width=True)
@@ -444,57 +516,43 @@ elif app_mode == "批量比較":
     )
     
     period = st.selectbox("比較期間", ["1d", "1mo", "3mo", "6mo", "1y"], index=2)
+    store = open_store()
+    use_store = False
+    if store is not None and store.n_days:
+        use_store = st.checkbox(f"使用本地市場儲存區（{len(store)} 檔，至 {store.last_date.strftime('%Y-%m-%d')}）",
+                                value=True, help="已在儲存區的股票直接讀取本地日K，不經網路下載")
     
     if st.button("開始比較分析"):
         stock_list = [s.strip() for s in stocks_input.split('\n') if s.strip()]
         
         if stock_list:
-            comparison_data = []
-            charts_data = {}
-            
             progress_bar = st.progress(0)
-            
-            for i, symbol in enumerate(stock_list):
-                progress_bar.progress((i + 1) / len(stock_list))
-                
-                analyzer = StockAnalyzer()
-                if analyzer.fetch_data(symbol, period=period):
-                    signals = analyzer.generate_trading_signals()
-                    current_price = analyzer.data['Close'][-1]
-                    price_change_pct = ((current_price - analyzer.data['Close'][0]) / analyzer.data['Close'][0]) * 100
-                    
-                    comparison_data.append({
-                        '股票代碼': symbol,
-                        '當前價格': current_price,
-                        '期間漲跌(%)': price_change_pct,
-                        '交叉點數': len(signals['crossovers']),
-                        '上升趨勢數': len(signals['uptrends']),
-                        '平均利潤空間(%)': np.mean([p['profit_potential'] for p in signals['profit_analysis']]) if signals['profit_analysis'] else 0
-                    })
-                    
-                    charts_data[symbol] = analyzer.data
+            status_text = st.empty()
+
+            def update_progress(done, total, symbol, result):
+                progress_bar.progress(done / total)
+                status_text.text(f"{symbol} {'完成' if result else '失敗'} ({done}/{total})")
+
+            # 並行分析所有股票，每完成一檔即更新進度
+            results = analyze_batch(stock_list, period=period, on_progress=update_progress,
+                                    store=store if use_store else None)
             
             progress_bar.progress(100)
             
-            if comparison_data:
+            if results:
                 # 顯示比較表格
-                comparison_df = pd.DataFrame(comparison_data)
+                comparison_df = comparison_table(results)
                 st.subheader("📈 比較結果")
                 st.dataframe(comparison_df, use_container_width=True)
                 
-                # 創建比較圖表
+                # 創建比較圖表：各股價格一次對齊到共同交易日並標準化（以第一天為基準）
+                normalized = normalized_prices(results)
                 fig = go.Figure()
                 
-                for symbol, data in charts_data.items():
-                    # 標準化價格（以第一天為基準）
-                    normalized_price = (data['Close'] / data['Close'].iloc[0]) * 100
-                    
-                    # 格式化日期為只顯示日期部分
-                    formatted_dates = [date.strftime('%Y-%m-%d') for date in data.index]
-                    
+                for symbol in normalized.columns:
                     fig.add_trace(go.Scatter(
-                        x=formatted_dates,
-                        y=normalized_price,
+                        x=normalized.index,
+                        y=normalized[symbol],
                         mode='lines',
                         name=symbol,
                         line=dict(width=2)
@@ -603,8 +661,18 @@ st.sidebar.info(
     "本系統持續更新中，感謝您的使用！"
 )
 
+cache_stats = get_analysis_cache().stats()
+st.sidebar.caption(
+    f"分析快取：{cache_stats['entries']} 筆，命中率 {cache_stats['hit_rate'] * 100:.0f}% "
+    f"({cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']})，"
+    f"{cache_stats['bytes'] / 1024 / 1024:.1f} MB"
+)
+
 st.sidebar.markdown("### 📈 市場提醒")
 st.sidebar.warning(
     "投資有風險，入市需謹慎。\n\n"
     "技術分析僅供參考，請結合基本面分析做出投資決策。"
-) 
\ No newline at end of file
+) 
+
+if live_loop is not None:
+    live_loop()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+歷史逐筆交易批次回補模組
+將 (股票 × 日期) 拆成每日任務並行下載，以欄式格式按 股票/日期 分區儲存，
+中斷後重新執行會自動跳過已完成的分區。
+"""
+
+import os
+import concurrent.futures
+import numpy as np
+import pandas as pd
+from metrics import timed
+from quota_scheduler import PRIORITY_BATCH
+from shioaji_extended import shioaji_code
+from trading_calendar import get_calendar
+
+# 逐筆資料欄位與儲存型別
+TICK_COLUMNS = {
+    'ts': 'int64',
+    'close': 'float64',
+    'volume': 'int32',
+    'bid_price': 'float64',
+    'bid_volume': 'int32',
+    'ask_price': 'float64',
+    'ask_volume': 'int32',
+    'tick_type': 'int8',
+}
+
+
+class TickStore:
+    """以 股票/日期 分區的欄式逐筆資料儲存（每個分區一個 .npz 檔）"""
+
+    def __init__(self, root="data/ticks"):
+        self.root = root
+
+    def partition_path(self, symbol, date):
+        """取得分區檔案路徑"""
+        day = pd.Timestamp(date).strftime('%Y-%m-%d')
+        return os.path.join(self.root, f"symbol={symbol}", f"date={day}.npz")
+
+    def has(self, symbol, date):
+        """分區是否已存在（只有下載到逐筆資料的交易日才會寫入分區）"""
+        return os.path.exists(self.partition_path(symbol, date))
+
+    def write(self, symbol, date, columns):
+        """寫入單一分區，先寫暫存檔再改名，避免中斷時留下殘缺檔案"""
+        path = self.partition_path(symbol, date)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        count = len(columns.get('ts', []))
+        # 缺少的欄位以 0 補齊，確保各欄長度一致
+        arrays = {
+            name: np.asarray(columns[name], dtype=dtype) if name in columns else np.zeros(count, dtype=dtype)
+            for name, dtype in TICK_COLUMNS.items()
+        }
+        tmp_path = path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        return len(arrays['ts'])
+
+    def dates(self, symbol):
+        """列出某檔股票已儲存的日期"""
+        folder = os.path.join(self.root, f"symbol={symbol}")
+        if not os.path.isdir(folder):
+            return []
+        return sorted(
+            pd.Timestamp(name[len('date='):-len('.npz')])
+            for name in os.listdir(folder)
+            if name.startswith('date=') and name.endswith('.npz') and '.tmp' not in name
+        )
+
+    def read(self, symbol, start=None, end=None):
+        """讀取某檔股票在日期區間內的逐筆資料，回傳以時間為索引的 DataFrame"""
+        frames = []
+        for day in self.dates(symbol):
+            if start is not None and day < pd.Timestamp(start):
+                continue
+            if end is not None and day > pd.Timestamp(end):
+                continue
+            with np.load(self.partition_path(symbol, day)) as npz:
+                if len(npz['ts']):
+                    frames.append({name: npz[name] for name in TICK_COLUMNS})
+
+        if not frames:
+            return pd.DataFrame(columns=list(TICK_COLUMNS)[1:], index=pd.DatetimeIndex([], name='ts'))
+
+        columns = {name: np.concatenate([f[name] for f in frames]) for name in TICK_COLUMNS}
+        df = pd.DataFrame(columns)
+        df['ts'] = pd.to_datetime(df['ts'], unit='ns')
+        return df.set_index('ts')
+
+
+class TickBackfiller:
+    """批次回補歷史逐筆資料"""
+
+    def __init__(self, client, store=None, max_workers=4):
+        self.client = client
+        self.store = store or TickStore()
+        self.max_workers = max_workers
+
+    def plan(self, symbols, start, end):
+        """產生尚未儲存的 (股票, 日期) 任務，僅包含交易日（跳過週末與休市日）"""
+        days = get_calendar('TWSE').sessions(start, end)
+        return [
+            (symbol, day)
+            for symbol in symbols
+            for day in days
+            if not self.store.has(symbol, day)
+        ]
+
+    @timed('tick_backfill_seconds')
+    def fetch_day(self, symbol, day):
+        """
+        下載單日逐筆資料並寫入儲存區，回傳筆數。
+        沒有資料時（臨時停市、API 回傳空結果）不寫入分區，下次執行會重新嘗試。
+        """
+        # 以批次優先權排入流量配額排程器（流量吃緊時延後，讓互動查詢先執行）；直接以陣列寫入，不逐筆轉換
+        columns = self.client.get_ticks(symbol, day.strftime('%Y-%m-%d'), priority=PRIORITY_BATCH)
+        if not len(columns.get('ts', [])):
+            return 0
+        return self.store.write(symbol, day, columns)
+
+    def run(self, symbols, start, end=None):
+        """
+        並行回補 (股票 × 日期區間) 的逐筆資料，回傳執行摘要。
+        結束日期不晚於最近一個已收盤的交易日，避免盤中寫入不完整的當日分區。
+        """
+        if not self.client or not self.client.is_connected:
+            print("❌ 請先連接 API")
+            return None
+
+        symbols = [shioaji_code(s) for s in symbols]
+        last_close = get_calendar('TWSE').last_close().strftime('%Y-%m-%d')
+        end = min(pd.Timestamp(end).strftime('%Y-%m-%d'), last_close) if end else last_close
+        jobs = self.plan(symbols, start, end)
+        print(f"⚡ 逐筆回補 {len(symbols)} 檔股票 {start} ~ {end}，待下載 {len(jobs)} 個分區")
+
+        summary = {'jobs': len(jobs), 'completed': 0, 'empty': 0, 'failed': 0, 'ticks': 0}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            future_to_job = {executor.submit(self.fetch_day, symbol, day): (symbol, day) for symbol, day in jobs}
+            for future in concurrent.futures.as_completed(future_to_job):
+                symbol, day = future_to_job[future]
+                try:
+                    count = future.result()
+                    summary['ticks'] += count
+                    summary['completed' if count else 'empty'] += 1
+                except Exception as e:
+                    summary['failed'] += 1
+                    print(f"⚠️ {symbol} {day.strftime('%Y-%m-%d')} 回補失敗: {e}")
+
+        print(f"✅ 回補完成: {summary['completed']}/{summary['jobs']} 個分區，共 {summary['ticks']:,} 筆逐筆資料")
+        if summary['empty']:
+            print(f"⚠️ {summary['empty']} 個分區沒有資料，下次執行時重試")
+        return summary
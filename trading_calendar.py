@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+離線交易日曆
+提供台灣證券交易所（TWSE）、櫃買中心（TPEx）與紐約證券交易所（NYSE）的交易時段、休市日與提前收盤日，
+用於數據獲取期間規劃（不向數據源請求不可能有數據的日子）、快取存活時間、儲存區新鮮度判斷與K線對齊。
+內建休市表涵蓋 HOLIDAYS 中的年份（含已知的颱風停市），表外年份只排除週末；
+臨時停市或新年度的休市日可寫入 TRADING_CALENDAR 指定的 JSON 檔（預設 data/trading_calendar.json）：
+    {"TWSE": {"holidays": ["2026-08-01"], "half_days": {"2026-12-31": "12:00"}}}
+"""
+
+import json
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+CALENDAR_FILE = os.getenv('TRADING_CALENDAR', os.path.join('data', 'trading_calendar.json'))
+
+# 交易所時段：(時區, 開盤, 收盤)
+SESSIONS = {
+    'TWSE': ('Asia/Taipei', (9, 0), (13, 30)),
+    'TPEx': ('Asia/Taipei', (9, 0), (13, 30)),
+    'NYSE': ('America/New_York', (9, 30), (16, 0)),
+}
+
+# 平日休市（含農曆春節前僅辦理結算交割的無交易日與颱風停市）
+_TW_HOLIDAYS = {
+    2024: ['01-01', '02-06', '02-07', '02-08', '02-09', '02-12', '02-13', '02-14', '02-28', '04-04', '04-05',
+           '05-01', '06-10', '07-24', '07-25', '09-17', '10-02', '10-03', '10-10', '10-31'],
+    2025: ['01-01', '01-23', '01-24', '01-27', '01-28', '01-29', '01-30', '01-31', '02-28', '04-03', '04-04',
+           '05-01', '05-30', '09-29', '10-06', '10-10', '10-24', '12-25'],
+    2026: ['01-01', '02-12', '02-13', '02-16', '02-17', '02-18', '02-19', '02-20', '02-27', '04-03', '04-06',
+           '05-01', '06-19', '09-25', '09-28', '10-09', '10-26', '12-25'],
+}
+_NYSE_HOLIDAYS = {
+    2024: ['01-01', '01-15', '02-19', '03-29', '05-27', '06-19', '07-04', '09-02', '11-28', '12-25'],
+    2025: ['01-01', '01-09', '01-20', '02-17', '04-18', '05-26', '06-19', '07-04', '09-01', '11-27', '12-25'],
+    2026: ['01-01', '01-19', '02-16', '04-03', '05-25', '06-19', '07-03', '09-07', '11-26', '12-25'],
+}
+_NYSE_HALF_DAYS = {
+    2024: ['07-03', '11-29', '12-24'],
+    2025: ['07-03', '11-28', '12-24'],
+    2026: ['11-27', '12-24'],
+}
+NYSE_HALF_DAY_CLOSE = (13, 0)
+
+HOLIDAYS = {'TWSE': _TW_HOLIDAYS, 'TPEx': _TW_HOLIDAYS, 'NYSE': _NYSE_HOLIDAYS}
+HALF_DAYS = {'NYSE': {year: {day: NYSE_HALF_DAY_CLOSE for day in days} for year, days in _NYSE_HALF_DAYS.items()}}
+
+# 期間：以交易日數計算（與 yfinance 的 1d/5d 相同）或以月份回推後取第一個交易日
+PERIOD_SESSIONS = {'1d': 1, '5d': 5}
+PERIOD_MONTHS = {'1mo': 1, '3mo': 3, '6mo': 6, '1y': 12, '2y': 24, '5y': 60, '10y': 120}
+MAX_START = pd.Timestamp('1970-01-02')
+DEFAULT_PERIOD = '6mo'
+# 由短到長的期間，供 covering_period 選擇
+PERIODS = list(PERIOD_SESSIONS) + list(PERIOD_MONTHS) + ['max']
+
+_ONE_DAY = np.timedelta64(1, 'D')
+
+
+def _parse_time(value):
+    hour, minute = str(value).split(':')
+    return int(hour), int(minute)
+
+
+class TradingCalendar:
+    """單一交易所的交易日曆；日期參數可為字串、date、datetime 或 Timestamp（有時區時先轉為交易所時區）"""
+
+    def __init__(self, name, tz, open_time, close_time, holidays=(), half_days=None):
+        self.name = name
+        self.tz = tz
+        self.open_time = open_time
+        self.close_time = close_time
+        self.holidays = np.array(sorted(set(holidays)), dtype='datetime64[D]')
+        self.half_days = {np.datetime64(day, 'D'): close for day, close in (half_days or {}).items()}
+        self._half_day_array = np.array(sorted(self.half_days), dtype='datetime64[D]')
+        self._busdays = np.busdaycalendar(weekmask='1111100', holidays=self.holidays)
+
+    def day(self, value):
+        """交易所當地日期（numpy datetime64[D]）"""
+        ts = pd.Timestamp(value)
+        if ts.tz is not None:
+            ts = ts.tz_convert(self.tz)
+        return np.datetime64(ts.date(), 'D')
+
+    def now(self):
+        return pd.Timestamp.now(tz=self.tz)
+
+    def localize(self, value):
+        """轉為交易所時區的 Timestamp（無時區的時間視為當地時間）"""
+        ts = pd.Timestamp(value)
+        return ts.tz_localize(self.tz) if ts.tz is None else ts.tz_convert(self.tz)
+
+    # --- 交易日 ---
+    def is_session(self, value):
+        return bool(np.is_busday(self.day(value), busdaycal=self._busdays))
+
+    def sessions(self, start, end):
+        """[start, end] 之間的交易日（無時區的日期索引）"""
+        first, last = self.day(start), self.day(end)
+        if last < first:
+            return pd.DatetimeIndex([])
+        days = np.arange(first, last + _ONE_DAY)
+        return pd.DatetimeIndex(days[np.is_busday(days, busdaycal=self._busdays)].astype('datetime64[ns]'))
+
+    def session_count(self, start, end):
+        """(start, end] 之間的交易日數（start 當天不計）"""
+        return int(np.busday_count(self.day(start) + _ONE_DAY, self.day(end) + _ONE_DAY, busdaycal=self._busdays))
+
+    def has_session(self, start, end):
+        """[start, end) 之間是否有任何交易日"""
+        return np.busday_count(self.day(start), self.day(end), busdaycal=self._busdays) > 0
+
+    def previous_session(self, value, inclusive=True):
+        """不晚於 value（inclusive=False 時早於 value）的最後一個交易日"""
+        day = self.day(value) - (0 if inclusive else _ONE_DAY)
+        return pd.Timestamp(np.busday_offset(day, 0, roll='backward', busdaycal=self._busdays))
+
+    def next_session(self, value, inclusive=True):
+        """不早於 value（inclusive=False 時晚於 value）的第一個交易日"""
+        day = self.day(value) + (0 if inclusive else _ONE_DAY)
+        return pd.Timestamp(np.busday_offset(day, 0, roll='forward', busdaycal=self._busdays))
+
+    def offset_sessions(self, value, n):
+        """value 所在（或之前最近）的交易日往後 n 個交易日（n 為負時往前）"""
+        return pd.Timestamp(np.busday_offset(self.day(value), n, roll='backward', busdaycal=self._busdays))
+
+    # --- 交易時段 ---
+    def close_of(self, value):
+        """該日的收盤時間 (時, 分)，提前收盤日回傳提前的時間"""
+        return self.half_days.get(self.day(value), self.close_time)
+
+    def session_bounds(self, value):
+        """該日的 (開盤, 收盤) 時間（交易所時區）"""
+        day = pd.Timestamp(self.day(value)).tz_localize(self.tz)
+        close = self.close_of(value)
+        return (day + pd.Timedelta(hours=self.open_time[0], minutes=self.open_time[1]),
+                day + pd.Timedelta(hours=close[0], minutes=close[1]))
+
+    def is_open(self, now=None):
+        """目前是否在交易時段內"""
+        now = self.localize(now) if now is not None else self.now()
+        if not self.is_session(now):
+            return False
+        market_open, market_close = self.session_bounds(now)
+        return market_open <= now < market_close
+
+    def next_open(self, now=None):
+        """下一個交易時段的開盤時間（目前正在交易時回傳下一個交易日）"""
+        now = self.localize(now) if now is not None else self.now()
+        if self.is_session(now):
+            market_open, _ = self.session_bounds(now)
+            if now < market_open:
+                return market_open
+        return self.session_bounds(self.next_session(now, inclusive=False))[0]
+
+    def last_close(self, now=None):
+        """最近一次已收盤的交易時段收盤時間"""
+        now = self.localize(now) if now is not None else self.now()
+        if self.is_session(now):
+            _, market_close = self.session_bounds(now)
+            if now >= market_close:
+                return market_close
+        return self.session_bounds(self.previous_session(now, inclusive=False))[1]
+
+    def close_minutes(self, days):
+        """一組當地日期（datetime64）的收盤時間（當日第幾分鐘），供向量化的K線對齊使用"""
+        days = np.asarray(days).astype('datetime64[D]')
+        minutes = np.full(days.shape, self.close_time[0] * 60 + self.close_time[1], dtype=np.int64)
+        if self._half_day_array.size:
+            position = np.searchsorted(self._half_day_array, days)
+            found = (position < self._half_day_array.size) & (
+                self._half_day_array[np.minimum(position, self._half_day_array.size - 1)] == days)
+            for i in np.flatnonzero(found):
+                close = self.half_days[self._half_day_array[position[i]]]
+                minutes[i] = close[0] * 60 + close[1]
+        return minutes
+
+    # --- 期間規劃 ---
+    def period_start(self, period, end=None):
+        """
+        期間的第一個交易日：1d/5d 為含 end 當日在內的最後 N 個交易日，
+        月份期間為 end 往前推算後的第一個交易日，max 為 MAX_START。
+        """
+        end = end if end is not None else self.now()
+        if period == 'max':
+            return MAX_START
+        if period in PERIOD_SESSIONS:
+            return self.offset_sessions(end, -(PERIOD_SESSIONS[period] - 1))
+        months = PERIOD_MONTHS.get(period, PERIOD_MONTHS[DEFAULT_PERIOD])
+        return self.next_session(pd.Timestamp(self.day(end)) - pd.DateOffset(months=months))
+
+    def covering_period(self, value, end=None):
+        """範圍包含 value 當日的最短期間（只需補抓最近的數據時使用）"""
+        day = pd.Timestamp(self.day(value))
+        for period in PERIODS:
+            if self.period_start(period, end) <= day:
+                return period
+        return 'max'
+
+    def warmup_start(self, start, sessions):
+        """start 之前 sessions 個交易日（指標暖機期間的開始）"""
+        return self.offset_sessions(self.next_session(start), -sessions)
+
+
+def _load_overrides(path=CALENDAR_FILE):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _build(name, overrides):
+    tz, open_time, close_time = SESSIONS[name]
+    holidays = [f"{year}-{day}" for year, days in HOLIDAYS.get(name, {}).items() for day in days]
+    half_days = {f"{year}-{day}": close for year, days in HALF_DAYS.get(name, {}).items()
+                 for day, close in days.items()}
+    extra = overrides.get(name, {})
+    holidays += extra.get('holidays', [])
+    half_days.update({day: _parse_time(close) for day, close in extra.get('half_days', {}).items()})
+    return TradingCalendar(name, tz, open_time, close_time, holidays, half_days)
+
+
+_calendars = {}
+_calendars_lock = threading.Lock()
+
+
+def get_calendar(name='TWSE'):
+    """取得程序內共用的交易日曆"""
+    with _calendars_lock:
+        if not _calendars:
+            overrides = _load_overrides()
+            for exchange in SESSIONS:
+                _calendars[exchange] = _build(exchange, overrides)
+        return _calendars[name]
+
+
+def exchange_for(symbol):
+    """依股票代碼判斷交易所：.TW 為上市、.TWO 為上櫃，其餘視為美股"""
+    symbol = (symbol or '').upper()
+    if symbol.endswith('.TWO'):
+        return 'TPEx'
+    if symbol.endswith('.TW'):
+        return 'TWSE'
+    return 'NYSE'
+
+
+def is_taiwan(symbol):
+    """是否為台股（上市或上櫃）"""
+    return exchange_for(symbol) in ('TWSE', 'TPEx')
+
+
+def calendar_for(symbol):
+    return get_calendar(exchange_for(symbol))
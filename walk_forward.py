@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+策略參數的滾動前進（walk-forward）最佳化
+將歷史切成連續的訓練 / 測試視窗：在訓練視窗評估整個參數網格、挑出最佳參數，
+再以該參數在緊接的測試視窗計算樣本外績效。
+參數組合在多個程序中平行評估，價格陣列放在共享記憶體，每個任務只傳送視窗與參數；
+已完成的結果寫入檢查點檔，中斷後重新執行會略過已完成的任務。
+
+支援的策略：
+- uptrend：黃金交叉後持有，且須處於緩坡爬升（趨勢斜率在範圍內並持續足夠K線）才持倉，
+  最佳化 identify_gentle_uptrend 的 min_slope / max_slope / min_days
+- score：定期依 StockScreener 評分挑選前 N 檔持有，最佳化評分各項目的權重
+"""
+
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+import time
+from collections import Counter
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from backtest import (
+    BARS_PER_YEAR, COMMISSION_RATE, FAST_SPAN, SLOW_SPAN, TRANSACTION_TAX,
+    crossover_positions, ema, position_growth
+)
+from bootstrap import mean_profit_potential
+from stock_analyzer import GENTLE_MAX_SLOPE, GENTLE_MIN_DAYS, GENTLE_MIN_SLOPE, crossover_masks
+from stock_screener import RECENT_CROSS_SESSIONS, RECENT_UPTREND_SESSIONS, SCORE_WEIGHTS
+
+# 預設視窗：訓練 2 年、測試半年，每次前進一個測試視窗
+TRAIN_BARS = 2 * BARS_PER_YEAR
+TEST_BARS = BARS_PER_YEAR // 2
+# 趨勢斜率的回歸視窗，與 StockAnalyzer.detect_trend_slope 相同
+TREND_PERIOD = 20
+
+# 評分策略：評分回看K線數（約 6 個月，與篩選器相同）、持有K線數與持股數
+SCORE_LOOKBACK = 126
+SCORE_HOLD = 20
+SCORE_TOP_N = 10
+
+DEFAULT_GRIDS = {
+    'uptrend': {
+        'min_slope': [GENTLE_MIN_SLOPE / 2, GENTLE_MIN_SLOPE, GENTLE_MIN_SLOPE * 2],
+        'max_slope': [GENTLE_MAX_SLOPE / 2, GENTLE_MAX_SLOPE, GENTLE_MAX_SLOPE * 2],
+        'min_days': [GENTLE_MIN_DAYS // 2, GENTLE_MIN_DAYS, GENTLE_MIN_DAYS * 2],
+    },
+    'score': {name: [0, weight, weight * 2] for name, weight in SCORE_WEIGHTS.items()},
+}
+
+# 共享記憶體中的欄位順序
+PANEL_FIELDS = ('open', 'high', 'close')
+
+
+def rolling_slope(values, period=TREND_PERIOD):
+    """
+    沿最後一軸的滾動線性回歸斜率，以累積和一次算完所有視窗。
+    只計算完整且無缺值的視窗，其餘為 NaN；此時與 detect_trend_slope 的 np.polyfit 結果相同。
+    detect_trend_slope 對前 period-1 根或含缺值的視窗會先去除 NaN 再以剩餘點（至少 2 點）擬合，這裡不做此處理。
+    """
+    y = np.atleast_2d(np.asarray(values, dtype='float64'))
+    n = y.shape[-1]
+    result = np.full(y.shape, np.nan)
+    if n < period:
+        return result.reshape(np.shape(values))
+
+    valid = np.isfinite(y)
+    y0 = np.where(valid, y, 0.0)
+    j = np.arange(n, dtype='float64')
+
+    def window_sum(a):
+        c = np.concatenate([np.zeros((a.shape[0], 1)), np.cumsum(a, axis=-1)], axis=-1)
+        return c[:, period:] - c[:, :-period]
+
+    sy = window_sum(y0)
+    sjy = window_sum(y0 * j)
+    count = window_sum(valid.astype('float64'))
+    first = j[:n - period + 1]
+    # 視窗內 x = 0..period-1，Σxy = Σ j·y − 起點·Σy
+    sxy = sjy - first * sy
+    sx = period * (period - 1) / 2
+    sxx = (period - 1) * period * (2 * period - 1) / 6
+    slope = (period * sxy - sx * sy) / (period * sxx - sx ** 2)
+    result[:, period - 1:] = np.where(count == period, slope, np.nan)
+    return result.reshape(np.shape(values))
+
+
+def gentle_active(slope, min_slope=GENTLE_MIN_SLOPE, max_slope=GENTLE_MAX_SLOPE, min_days=GENTLE_MIN_DAYS):
+    """斜率持續落在 [min_slope, max_slope] 至少 min_days 根K線時為 True（只看過去，可用於交易）"""
+    with np.errstate(invalid='ignore'):
+        mask = (slope >= min_slope) & (slope <= max_slope)
+    n = mask.shape[-1]
+    position = np.arange(n)
+    last_break = np.where(mask, -1, position)
+    np.maximum.accumulate(last_break, axis=-1, out=last_break)
+    return position - last_break >= min_days
+
+
+class SharedPanel:
+    """放在共享記憶體中的 (欄位, 股票數, K線數) 價格陣列"""
+
+    def __init__(self, arrays=None, name=None, shape=None):
+        if arrays is not None:
+            shape = (len(PANEL_FIELDS),) + np.shape(arrays['close'])
+            self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 8)
+        else:
+            # 程序池的子程序與父程序共用同一個 resource_tracker，不需像 TickRingBuffer 那樣取消登錄，
+            # 由父程序 unlink 時一併清除
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.shape = tuple(shape)
+        self._block = np.ndarray(self.shape, dtype='float64', buffer=self.shm.buf)
+        if arrays is not None:
+            for i, field in enumerate(PANEL_FIELDS):
+                self._block[i] = arrays[field]
+        self.arrays = {field: self._block[i] for i, field in enumerate(PANEL_FIELDS)}
+
+    @property
+    def spec(self):
+        return self.shm.name, self.shape
+
+    def close(self):
+        del self.arrays, self._block
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+# --- 工作程序端 ---
+_worker_panel = None
+_worker_arrays = None
+_worker_indicators = None
+
+
+def _init_worker(name, shape):
+    global _worker_panel, _worker_arrays, _worker_indicators
+    _worker_panel = SharedPanel(name=name, shape=shape)
+    _worker_arrays = _worker_panel.arrays
+    _worker_indicators = None
+
+
+def _set_local_arrays(arrays):
+    """單程序執行時直接使用父程序的陣列"""
+    global _worker_arrays, _worker_indicators
+    _worker_arrays = arrays
+    _worker_indicators = None
+
+
+def _indicators():
+    """
+    各工作程序只計算一次全期間的指標。指標只依賴當根以前的數據，
+    因此對任一視窗切片的結果與只用該視窗以前數據計算的結果相同。
+    """
+    global _worker_indicators
+    if _worker_indicators is None:
+        close = _worker_arrays['close']
+        yellow, blue = ema(close, FAST_SPAN), ema(close, SLOW_SPAN)
+        golden, _ = crossover_masks(yellow, blue)
+        slope = rolling_slope(close)
+        _worker_indicators = {
+            'yellow': yellow,
+            'blue': blue,
+            'ma60': ema(close, 60),
+            'slope': slope,
+            'gentle': gentle_active(slope),
+            'crossover_target': crossover_positions(yellow, blue),
+            'golden_count': np.cumsum(golden, axis=-1),
+            'golden': golden,
+        }
+    return _worker_indicators
+
+
+def _portfolio_metrics(returns, periods_per_year, exposure=None):
+    """等權重組合的報酬序列 → 總報酬、夏普、最大回撤"""
+    returns = np.asarray(returns, dtype='float64')
+    equity = np.cumprod(1 + returns)
+    std = returns.std(ddof=1) if len(returns) > 1 else 0.0
+    metrics = {
+        'return': float(equity[-1] - 1) if len(equity) else 0.0,
+        'sharpe': float(returns.mean() / std * np.sqrt(periods_per_year)) if std > 0 else 0.0,
+        'max_drawdown': float((equity / np.maximum.accumulate(equity) - 1).min()) if len(equity) else 0.0,
+    }
+    if exposure is not None:
+        metrics['exposure'] = float(exposure)
+    return metrics
+
+
+def evaluate_uptrend(start, end, params):
+    """緩坡爬升過濾的交叉策略在 [start, end) 的等權重組合績效"""
+    arrays, ind = _worker_arrays, _indicators()
+    active = gentle_active(ind['slope'][:, :end], params['min_slope'], params['max_slope'], int(params['min_days']))
+    target = ind['crossover_target'][:, :end] & active
+    held, _, _, growth = position_growth(arrays['open'][:, :end], arrays['close'][:, :end], target)
+    daily = (growth[:, start:end] - 1).mean(axis=0)
+    return _portfolio_metrics(daily, BARS_PER_YEAR, held[:, start:end].mean())
+
+
+def _scores_at(t, weights):
+    """以 t 收盤以前的數據，向量化計算所有股票的篩選器評分（與 calculate_stock_score 的規則對應）"""
+    arrays, ind = _worker_arrays, _indicators()
+    close, high = arrays['close'], arrays['high']
+    w0 = max(0, t - SCORE_LOOKBACK + 1)
+
+    # 緩坡爬升：近 RECENT_UPTREND_SESSIONS 根（交易日）中處於緩坡爬升的K線平均斜率
+    recent = slice(max(w0, t - RECENT_UPTREND_SESSIONS), t + 1)
+    gentle = ind['gentle'][:, recent]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope_sum = np.where(gentle, ind['slope'][:, recent], 0).sum(axis=1)
+        gentle_count = gentle.sum(axis=1)
+        avg_slope = np.where(gentle_count > 0, slope_sum / gentle_count, 0.0)
+    uptrend = np.minimum(1, avg_slope * 0.5)
+
+    # 近 RECENT_CROSS_SESSIONS 根內出現黃金交叉
+    golden_count = ind['golden_count']
+    crossover = (golden_count[:, t] - golden_count[:, max(t - RECENT_CROSS_SESSIONS - 1, 0)]) > 0
+
+    # 利潤空間：回看期間內各黃金交叉之後到 t 的最高價漲幅平均
+    avg_profit = mean_profit_potential(close[:, w0:t + 1], high[:, w0:t + 1], ind['golden'][:, w0:t + 1])
+    profit_score = np.where(np.isfinite(avg_profit), np.minimum(1, avg_profit / 50), 0.0)
+
+    # 技術指標
+    c, y, b, m = close[:, t], ind['yellow'][:, t], ind['blue'][:, t], ind['ma60'][:, t]
+    with np.errstate(invalid='ignore'):
+        technical = ((c > y).astype(int) + (c > b) + (c > m) + ((y > b) & (b > m))) / 4
+
+    score = (weights['uptrend'] * uptrend + weights['crossover'] * crossover
+             + weights['profit'] * profit_score + weights['technical'] * technical)
+    return np.where(np.isfinite(c), score, -np.inf)
+
+
+def evaluate_score(start, end, params):
+    """每 SCORE_HOLD 根依評分買進前 SCORE_TOP_N 檔（下一根開盤進場、期末收盤出場，含成本）"""
+    arrays = _worker_arrays
+    open_, close = arrays['open'], arrays['close']
+    top_n = min(SCORE_TOP_N, close.shape[0])
+    period_returns = []
+    for t in range(start, end - 1, SCORE_HOLD):
+        exit_at = min(t + SCORE_HOLD, end - 1)
+        picks = np.argpartition(-_scores_at(t, params), top_n - 1)[:top_n]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            gross = close[picks, exit_at] / open_[picks, t + 1]
+        net = gross * (1 - COMMISSION_RATE) * (1 - COMMISSION_RATE - TRANSACTION_TAX) - 1
+        period_returns.append(np.nanmean(net) if np.isfinite(net).any() else 0.0)
+    return _portfolio_metrics(period_returns, BARS_PER_YEAR / SCORE_HOLD)
+
+
+STRATEGIES = {
+    'uptrend': evaluate_uptrend,
+    'score': evaluate_score,
+}
+
+
+def _run_task(strategy, start, end, params):
+    return STRATEGIES[strategy](start, end, params)
+
+
+# --- 主程序端 ---
+def panel_arrays(frames):
+    """將 {代碼: OHLC DataFrame} 對齊為共同交易日曆上的 open / high / close 陣列"""
+    frames = {symbol: data for symbol, data in frames.items() if data is not None and not data.empty}
+    columns = {}
+    for field, column in (('close', 'Close'), ('open', 'Open'), ('high', 'High')):
+        series = {}
+        for symbol, data in frames.items():
+            index = data.index.tz_localize(None) if data.index.tz is not None else data.index
+            series[symbol] = pd.Series(data[column].to_numpy(dtype='float64'), index=index)
+        matrix = pd.concat(series, axis=1).sort_index()
+        columns[field] = matrix[~matrix.index.duplicated(keep='last')]
+    close = columns['close'].ffill()
+    arrays = {
+        'close': close.to_numpy().T.copy(),
+        'open': columns['open'].reindex(close.index).fillna(close).to_numpy().T.copy(),
+        'high': columns['high'].reindex(close.index).fillna(close).to_numpy().T.copy(),
+    }
+    return arrays, close.index, list(close.columns)
+
+
+def _params_key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+class WalkForwardOptimizer:
+    """以程序池評估參數網格的滾動前進最佳化器"""
+
+    def __init__(self, arrays, strategy='uptrend', grid=None, train_bars=TRAIN_BARS, test_bars=TEST_BARS,
+                 step=None, objective='sharpe', max_workers=None, checkpoint=None, index=None):
+        """
+        arrays: {'open', 'high', 'close'}，形狀皆為 (股票數, K線數)
+        step: 每次前進的K線數，預設等於 test_bars（測試視窗不重疊）
+        checkpoint: 檢查點 JSON 路徑，None 表示不保存
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError(f"不支援的策略: {strategy}")
+        self.arrays = {field: np.ascontiguousarray(arrays[field], dtype='float64') for field in PANEL_FIELDS}
+        self.strategy = strategy
+        self.grid = grid or DEFAULT_GRIDS[strategy]
+        self.train_bars = train_bars
+        self.test_bars = test_bars
+        self.step = step or test_bars
+        self.objective = objective
+        self.max_workers = max_workers or os.cpu_count()
+        self.checkpoint = checkpoint
+        self.index = index
+        self.results = {}
+
+    def windows(self):
+        """[(訓練起點, 訓練終點 = 測試起點, 測試終點)]"""
+        n = self.arrays['close'].shape[1]
+        return [
+            (start, start + self.train_bars, start + self.train_bars + self.test_bars)
+            for start in range(0, n - self.train_bars - self.test_bars + 1, self.step)
+        ]
+
+    def param_sets(self):
+        names = sorted(self.grid)
+        return [dict(zip(names, values)) for values in itertools.product(*(self.grid[name] for name in names))]
+
+    def _fingerprint(self):
+        """數據與設定的指紋，檢查點只在完全相同時才沿用"""
+        digest = hashlib.sha1(self.arrays['close'].tobytes())
+        digest.update(json.dumps([self.strategy, self.grid, self.train_bars, self.test_bars, self.step],
+                                 sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def _load_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return {}
+        with open(self.checkpoint, encoding='utf-8') as f:
+            saved = json.load(f)
+        if saved.get('fingerprint') != self._fingerprint():
+            print("⚠️ 檢查點的數據或設定不同，重新計算")
+            return {}
+        print(f"♻️ 從檢查點恢復 {len(saved['results'])} 個已完成任務")
+        return saved['results']
+
+    def _save_checkpoint(self):
+        if not self.checkpoint:
+            return
+        tmp_path = f"{self.checkpoint}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'fingerprint': self._fingerprint(), 'results': self.results}, f)
+        os.replace(tmp_path, self.checkpoint)
+
+    def _execute(self, executor, tasks, label):
+        """執行尚未完成的任務 {key: (start, end, params)}，完成即寫入結果與檢查點"""
+        pending = {key: task for key, task in tasks.items() if key not in self.results}
+        if not pending:
+            return
+        print(f"🧮 {label}: {len(pending)} 個任務（已完成 {len(tasks) - len(pending)}）")
+        last_save = time.monotonic()
+        if executor is None:
+            for key, (start, end, params) in pending.items():
+                self.results[key] = _run_task(self.strategy, start, end, params)
+                if time.monotonic() - last_save > 5:
+                    self._save_checkpoint()
+                    last_save = time.monotonic()
+        else:
+            futures = {executor.submit(_run_task, self.strategy, *task): key for key, task in pending.items()}
+            for future in concurrent.futures.as_completed(futures):
+                self.results[futures[future]] = future.result()
+                if time.monotonic() - last_save > 5:
+                    self._save_checkpoint()
+                    last_save = time.monotonic()
+        self._save_checkpoint()
+
+    def _best(self, window_id, param_sets):
+        def value(params):
+            metric = self.results[f"train|{window_id}|{_params_key(params)}"][self.objective]
+            return metric if np.isfinite(metric) else -np.inf
+        return max(param_sets, key=value)
+
+    def run(self):
+        """執行最佳化並回傳報告 {'windows': DataFrame, 'summary': dict}"""
+        windows = self.windows()
+        if not windows:
+            raise ValueError("歷史數據不足一個訓練加測試視窗")
+        param_sets = self.param_sets()
+        self.results = self._load_checkpoint()
+
+        panel = None
+        executor = None
+        try:
+            if self.max_workers > 1:
+                panel = SharedPanel(self.arrays)
+                executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers, initializer=_init_worker, initargs=panel.spec)
+            else:
+                _set_local_arrays(self.arrays)
+
+            train_tasks = {
+                f"train|{w}|{_params_key(params)}": (train_start, train_end, params)
+                for w, (train_start, train_end, _) in enumerate(windows)
+                for params in param_sets
+            }
+            self._execute(executor, train_tasks, f"訓練 {len(windows)} 個視窗 × {len(param_sets)} 組參數")
+
+            best = {w: self._best(w, param_sets) for w in range(len(windows))}
+            test_tasks = {
+                f"test|{w}|{_params_key(best[w])}": (train_end, test_end, best[w])
+                for w, (_, train_end, test_end) in enumerate(windows)
+            }
+            self._execute(executor, test_tasks, "樣本外測試")
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if panel is not None:
+                panel.close()
+                panel.unlink()
+
+        return self._report(windows, best)
+
+    def _label(self, position):
+        if self.index is None:
+            return int(position)
+        return self.index[min(position, len(self.index) - 1)]
+
+    def _report(self, windows, best):
+        rows = []
+        for w, (train_start, train_end, test_end) in enumerate(windows):
+            key = _params_key(best[w])
+            train = self.results[f"train|{w}|{key}"]
+            test = self.results[f"test|{w}|{key}"]
+            rows.append({
+                'train_start': self._label(train_start),
+                'test_start': self._label(train_end),
+                'test_end': self._label(test_end - 1),
+                'params': best[w],
+                f'train_{self.objective}': train[self.objective],
+                f'test_{self.objective}': test[self.objective],
+                'test_return': test['return'],
+                'test_max_drawdown': test['max_drawdown'],
+            })
+        table = pd.DataFrame(rows)
+        chosen = Counter(_params_key(params) for params in table['params'])
+        summary = {
+            'strategy': self.strategy,
+            'objective': self.objective,
+            'windows': len(windows),
+            'oos_return': float(np.prod(1 + table['test_return']) - 1),
+            f'oos_mean_{self.objective}': float(table[f'test_{self.objective}'].mean()),
+            f'is_mean_{self.objective}': float(table[f'train_{self.objective}'].mean()),
+            'most_chosen_params': json.loads(chosen.most_common(1)[0][0]),
+            'most_chosen_share': chosen.most_common(1)[0][1] / len(windows),
+        }
+        return {'windows': table, 'summary': summary}
+
+
+def print_walk_forward(report):
+    """打印各視窗的最佳參數與樣本外績效"""
+    table, summary = report['windows'], report['summary']
+    objective = summary['objective']
+    print(f"\n=== 滾動前進最佳化: {summary['strategy']}（目標: {objective}）===")
+    for _, row in table.iterrows():
+        print(f"{str(row['test_start'])[:10]} ~ {str(row['test_end'])[:10]}  "
+              f"訓練 {row[f'train_{objective}']:>6.2f}  測試 {row[f'test_{objective}']:>6.2f}  "
+              f"報酬 {row['test_return'] * 100:>7.2f}%  參數 {row['params']}")
+    print(f"\n樣本外累積報酬: {summary['oos_return'] * 100:.2f}%")
+    print(f"平均 {objective}: 樣本內 {summary[f'is_mean_{objective}']:.2f} / 樣本外 {summary[f'oos_mean_{objective}']:.2f}")
+    print(f"最常入選參數 ({summary['most_chosen_share'] * 100:.0f}% 視窗): {summary['most_chosen_params']}")